@@ -3,23 +3,28 @@
 
 import re
 import json
+import base64
+import hashlib
+import uuid
+import zlib
 from logging import getLogger
 import datetime
 import os.path
+import threading
+import time
 from itertools import repeat
-from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
-from SocketServer import ThreadingMixIn
 
 import beanstalkc
 import bottle
-from bottle import route, hook, request, abort, error, \
-    post, delete, get, put, default_app, static_file
+from bottle import route, hook, request, response, abort, error, \
+    post, delete, get, put, default_app, static_file, HTTPResponse
 from bottle.ext import sqlalchemy as sabottle
-from . import execution, worker, authorization,\
-    gitutils, websocket, executils, database
+from . import worker, authorization,\
+    gitutils, websocket, executils, database, releasecache, topology, apiserver, logbuffer
 from . import samodels as m, schemas
-from .auth import issue_token, InvalidSession, NoMatchingUser, hash_token
+from .auth import issue_token, InvalidSession, NoMatchingUser, hash_token, principals, TOKEN_VALIDITY
 
+import sqlalchemy as sa
 from sqlalchemy import orm
 
 from . import inventory
@@ -34,6 +39,61 @@ def enforce(permission):
         abort(403)
 
 
+# Part of the ETags based on in-memory state (the topology version), which is specific to this process
+INSTANCE_ID = uuid.uuid4().hex
+# Smaller responses are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+
+def conditional_json(etag_parts, build):
+    """Return the response built by build(), unless the client already has it.
+
+    The ETag is computed from etag_parts, which must change whenever the response would,
+    so that the response is only built when the client does not have the current version.
+
+    Args:
+        etag_parts (tuple): cheap to compute values identifying the response (they must have a stable repr)
+        build (function): return the body of the response (a JSON string)
+    """
+    etag = '"{}"'.format(hashlib.sha1(repr(etag_parts)).hexdigest())
+    # Revalidate each time, but the client can keep its copy
+    response.set_header('Cache-Control', 'no-cache')
+    response.set_header('Vary', 'Accept-Encoding')
+    if _etag_matches(request.headers.get('If-None-Match'), etag):
+        return HTTPResponse(status=304, headers={'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'})
+    body = build()
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        # A strong ETag identifies a representation, so the compressed one has its own
+        etag = etag[:-1] + '-gzip"'
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+        response.set_header('Content-Encoding', 'gzip')
+    response.set_header('ETag', etag)
+    return body
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.endswith('-gzip"'):
+            candidate = candidate[:-len('-gzip"')] + '"'
+        if candidate == etag:
+            return True
+    return False
+
+
+def _topology_etag(route_name):
+    """ETag parts for the responses depending only on the topology and on the permissions of the user."""
+    return (INSTANCE_ID, route_name, topology.service.current().version,
+            request.account.id, request.account.permission_index().fingerprint)
+
+
 @bottle.error(405)
 def method_not_allowed(res):
     if request.method == 'OPTIONS':
@@ -64,6 +124,9 @@ def handle_500_error(http_error):
 
 
 def use_default_user():
+    request.account = principals.get(None)
+    if request.account is not None:
+        return
     with database.session_scope() as session:
         request.account = session.query(m.User).\
             filter(m.User.username == 'default').\
@@ -71,6 +134,8 @@ def use_default_user():
             one_or_none()
         if request.account is not None:
             _expunge_user(request.account, session)
+    if request.account is not None:
+        principals.put(None, request.account)
 
 
 def _expunge_user(user, session):
@@ -119,19 +184,27 @@ def check_auth():
         # Allow unprotected routes if no token is provided
         return use_default_user()
 
-    # If a token is provided, check it
+    # If a token is provided, check it (the cache only contains valid tokens)
+    user = principals.get(token)
+    if user is not None:
+        request.account = user
+        return
     with database.session_scope() as session:
-        user = session.query(m.User).filter(m.User.session_token == token).one_or_none()
+        user = session.query(m.User).\
+            filter(m.User.session_token == token).\
+            options(orm.subqueryload(m.User.roles)).\
+            one_or_none()
         if user is None:
             logger.info("Unauthorized access attempt with token: {}".format(token))
             abort(403)
-        if user.token_issued_at + datetime.timedelta(minutes=30) < datetime.datetime.utcnow():
+        if user.token_issued_at + TOKEN_VALIDITY < datetime.datetime.utcnow():
             logger.info("Token expired: {}".format(token))
             abort(403)
 
         request.account = user
         # Load roles, then remove them from the session so we can use them anywhere
         _expunge_user(request.account, session)
+    principals.put(token, request.account)
 
 
 def requires_admin(decorated):
@@ -245,6 +318,9 @@ def notification_updatedrepo(db):
 def notification_websocketevent(db):
     enforce(authorization.Deployer())
     event = websocket.WebSocketEvent.from_dict(request.json['event'])
+    if event.event_type == "topology.changed":
+        # Changed by another deployer instance: update our own snapshot
+        topology.service.apply(event.payload['changes'], notify=False)
     websocket_notifier = default_app().config["deployer.websocket_notifier"]
     websocket_notifier.publish(event)
 
@@ -270,13 +346,14 @@ def repositories_diff(repository_id, db):
 @requires_logged
 def environments_servers(environment_id, db):
     enforce(authorization.Read(environment_id))
-    env = db.query(m.Environment).get(environment_id)
+    env = topology.load_environment(db, environment_id)
     if env is None:
         abort(404)
     hosts = [executils.Host.from_server(s, env.remote_user) for s in env.servers]
 
-    releases = execution.concurrent_get_release_status(
-        zip(hosts, repeat(env.target_path))
+    releases = releasecache.cache.get_many(
+        zip(hosts, repeat(env.target_path)),
+        refresh=request.query.get('refresh') == '1'
     )
 
     servers_status = {}
@@ -294,7 +371,7 @@ def environments_fetch(environment_id, db):
     env = db.query(m.Environment).get(environment_id)
     if env is None:
         abort(404)
-    worker.AsyncFetchWorker.enqueue_job(env)
+    worker.AsyncFetchWorker.enqueue_job(env, default_app().config['general.local_repo_path'])
     return {'message': 'fetch job queued'}
 
 
@@ -334,20 +411,22 @@ def status():
     if health['degraded']:
         # using a non 200 code makes monitoring easier, no need to parse the response body
         abort(500, "this deployer instance is not healthy: {}".format(health['errors']))
-    return json.dumps({'message': 'Deployer API is up and running'})
+    return json.dumps({'message': 'Deployer API is up and running', 'metrics': default_app().config['health'].get_metrics()})
 
 
 @route('/api/repositories/', method=['GET'])
 @requires_logged
 def repositories_list(db):
-    q = db.query(m.Repository)
-    if not request.account.has_permission(authorization.ReadAllEnvironments()):
-        q = q.join(m.Repository.environments).\
-            filter(m.Environment.id.in_(request.account.readable_environments()))
-    repos = q.all()
-    schema = m.Repository.__marshmallow__(many=True)
-    schema.context = {'account': request.account}
-    return json.dumps({'repositories': schema.dump(repos).data})
+    def build():
+        q = db.query(m.Repository)
+        if not request.account.has_permission(authorization.ReadAllEnvironments()):
+            q = q.join(m.Repository.environments).\
+                filter(m.Environment.id.in_(request.account.readable_environments()))
+        repos = q.all()
+        schema = m.Repository.__marshmallow__(many=True)
+        schema.context = {'account': request.account}
+        return json.dumps({'repositories': schema.dump(repos).data})
+    return conditional_json(_topology_etag('repositories'), build)
 
 
 @get('/api/repositories/byname/<repo_name:re:.+>')
@@ -412,6 +491,119 @@ def deployments_list(repository_name, db):
     return json.dumps({'deployments': schema.dump(deploys).data})
 
 
+# Fields returned by default by the history (the log entries can be requested, but are better read with
+# /api/deployments/<id>/logs)
+HISTORY_DEFAULT_FIELDS = ('id', 'repository_name', 'environment_name', 'environment', 'cluster', 'server', 'branch',
+                          'commit', 'user', 'username', 'status', 'queued_date', 'date_start_deploy', 'date_end_deploy')
+HISTORY_FIELDS = HISTORY_DEFAULT_FIELDS + ('log_entries',)
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 500
+
+
+def _parse_datetime(value, name):
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    abort(400, "invalid {}: expected an ISO 8601 date".format(name))
+
+
+def _encode_cursor(deploy):
+    date = deploy.date_start_deploy.isoformat() if deploy.date_start_deploy is not None else ''
+    return base64.urlsafe_b64encode("{}|{}".format(date, deploy.id))
+
+
+def _decode_cursor(cursor):
+    """Return the (date_start_deploy, id) of the last deployment of the previous page."""
+    try:
+        date, deploy_id = base64.urlsafe_b64decode(str(cursor)).split('|')
+        return (_parse_datetime(date, 'cursor') if date != '' else None), int(deploy_id)
+    except (TypeError, ValueError):
+        abort(400, "invalid cursor")
+
+
+def _after_cursor(q, cursor):
+    """Filter the deployments listed after the cursor.
+
+    Deployments are listed by descending (date_start_deploy, id), queued deployments (without
+    date_start_deploy) last, as SQLite and MySQL sort NULLs.
+    """
+    date, deploy_id = _decode_cursor(cursor)
+    column = m.DeploymentView.date_start_deploy
+    if date is None:
+        return q.filter(column.is_(None), m.DeploymentView.id < deploy_id)
+    return q.filter(sa.or_(
+        column < date,
+        sa.and_(column == date, m.DeploymentView.id < deploy_id),
+        column.is_(None)))
+
+
+@get('/api/deployments/')
+@requires_logged
+def deployments_history(db):
+    """List the deployments, from the most recent one, by pages.
+
+    Query parameters (all optional):
+        repository, environment_id, status, user_id: filter the deployments (status may be a comma separated list)
+        since, until: only the deployments started in this range (ISO 8601 dates)
+        fields: comma separated list of the fields to return (the log entries are not returned by default)
+        limit: maximum number of deployments to return (50 by default)
+        cursor: next_cursor of the previous page
+    """
+    params = request.query
+    fields = HISTORY_DEFAULT_FIELDS
+    if params.get('fields'):
+        fields = tuple(f.strip() for f in params.get('fields').split(','))
+        unknown = [f for f in fields if f not in HISTORY_FIELDS]
+        if len(unknown) > 0:
+            abort(400, "unknown fields: {}".format(", ".join(unknown)))
+    try:
+        limit = min(int(params.get('limit', HISTORY_DEFAULT_LIMIT)), HISTORY_MAX_LIMIT)
+        environment_id = int(params['environment_id']) if params.get('environment_id') else None
+        user_id = int(params['user_id']) if params.get('user_id') else None
+    except ValueError:
+        abort(400, "limit, environment_id and user_id must be integers")
+    if limit <= 0:
+        abort(400, "limit must be positive")
+
+    q = db.query(m.DeploymentView)
+    if not request.account.has_permission(authorization.ReadAllEnvironments()):
+        q = q.filter(m.DeploymentView.environment_id.in_(request.account.readable_environments()))
+    if params.get('repository'):
+        q = q.filter(m.DeploymentView.repository_name == params.get('repository'))
+    if environment_id is not None:
+        q = q.filter(m.DeploymentView.environment_id == environment_id)
+    if params.get('status'):
+        q = q.filter(m.DeploymentView.status.in_(params.get('status').split(',')))
+    if user_id is not None:
+        q = q.filter(m.DeploymentView.user_id == user_id)
+    if params.get('since'):
+        q = q.filter(m.DeploymentView.date_start_deploy >= _parse_datetime(params.get('since'), 'since'))
+    if params.get('until'):
+        q = q.filter(m.DeploymentView.date_start_deploy < _parse_datetime(params.get('until'), 'until'))
+    if params.get('cursor'):
+        q = _after_cursor(q, params.get('cursor'))
+    if 'username' in fields:
+        q = q.options(orm.joinedload(m.DeploymentView.user))
+    if 'log_entries' in fields:
+        q = q.options(orm.subqueryload(m.DeploymentView.log_entries))
+
+    # One more, to know if there is a next page
+    deploys = q.order_by(m.DeploymentView.date_start_deploy.desc(), m.DeploymentView.id.desc()).\
+        limit(limit + 1).\
+        all()
+    next_cursor = None
+    if len(deploys) > limit:
+        deploys = deploys[:limit]
+        next_cursor = _encode_cursor(deploys[-1])
+    if 'username' in fields:
+        for deploy in deploys:
+            deploy.username = deploy.user.username if deploy.user is not None else None
+    schema = m.DeploymentView.__marshmallow__(many=True, only=fields)
+    return json.dumps({'deployments': schema.dump(deploys).data, 'next_cursor': next_cursor})
+
+
 @route('/api/deployments/<deploy_id:int>')
 @requires_logged
 def deployment_get(deploy_id, db):
@@ -425,6 +617,82 @@ def deployment_get(deploy_id, db):
     return json.dumps({'deployment': schema.dump(deploy).data})
 
 
+LOGS_DEFAULT_LIMIT = 500
+LOGS_MAX_LIMIT = 5000
+# Long polling holds a server thread, keep it short
+LOGS_MAX_WAIT = 30  # seconds
+# Entries written by other deployer instances are only seen by polling the database
+LOGS_POLL_INTERVAL = 2  # seconds
+# Requests allowed to long poll at the same time (the others return at once), so that they can not take all
+# the threads of the server. Set to half of api_server_threads when the API server starts.
+_logs_waiters = threading.BoundedSemaphore(10)
+
+
+def configure_logs_waiters(count):
+    global _logs_waiters
+    _logs_waiters = threading.BoundedSemaphore(max(1, count))
+
+
+@get('/api/deployments/<deploy_id:int>/logs')
+@requires_logged
+def deployment_logs(deploy_id, db):
+    """Return the log entries of a deployment written after a given entry.
+
+    Query parameters (all optional):
+        after: ID of the last entry already known by the client
+        limit: maximum number of entries to return (500 by default)
+        wait: if there is no new entry, wait at most this many seconds for one to be written (long polling).
+              Ignored when too many requests are already waiting.
+    """
+    try:
+        after = int(request.query.get('after', 0))
+        limit = min(int(request.query.get('limit', LOGS_DEFAULT_LIMIT)), LOGS_MAX_LIMIT)
+        wait = min(float(request.query.get('wait', 0)), LOGS_MAX_WAIT)
+    except ValueError:
+        abort(400, "after, limit and wait must be numbers")
+    if limit <= 0:
+        abort(400, "limit must be positive")
+    deploy = db.query(m.DeploymentView).get(deploy_id)
+    if deploy is None:
+        abort(404)
+    if not request.account.has_permission(authorization.ReadAllEnvironments()):
+        if deploy.environment_id not in request.account.readable_environments():
+            abort(403)
+    status = deploy.status
+    if m.DeploymentStatus.from_string(status).finished:
+        # All the entries are already written
+        wait = 0
+
+    waiters = _logs_waiters
+    waiting = wait > 0 and waiters.acquire(False)
+    if not waiting:
+        wait = 0
+    try:
+        deadline = time.time() + wait
+        while True:
+            sequence = logbuffer.watcher.sequence()
+            entries = db.query(m.LogEntry).\
+                filter(m.LogEntry.deploy_id == deploy_id, m.LogEntry.id > after).\
+                order_by(m.LogEntry.id).\
+                limit(limit).\
+                all()
+            remaining = deadline - time.time()
+            if len(entries) > 0 or remaining <= 0:
+                break
+            # End the transaction (and release its connection) while waiting, to see the entries committed since
+            db.rollback()
+            logbuffer.watcher.wait(sequence, min(remaining, LOGS_POLL_INTERVAL))
+    finally:
+        if waiting:
+            waiters.release()
+
+    return json.dumps({
+        'log_entries': m.LogEntry.__marshmallow__(many=True).dump(entries).data,
+        'last_id': entries[-1].id if len(entries) > 0 else after,
+        'status': status,
+    })
+
+
 @get('/api/backends/')
 @requires_admin
 def servers_get(db):
@@ -450,22 +718,23 @@ def servers_get_environments(server_id, db):
     server = db.query(m.Server).get(server_id)
     if server is None:
         abort(404)
-    environments = db.query(m.Environment).\
-        join(m.Environment.clusters).\
-        join(m.Cluster.servers).\
-        join(m.ClusterServerAssociation.server_def).\
-        filter(m.Server.id == server_id).\
-        all()
+    environments = topology.load_environments(
+        db.query(m.Environment).
+        join(m.Environment.clusters).
+        join(m.Cluster.servers).
+        join(m.ClusterServerAssociation.server_def).
+        filter(m.Server.id == server_id)
+    )
     to_inspect = []
-    # TODO: this will result in a LOT of SQL queries, fix that
     for env in environments:
         to_inspect += zip(
             [executils.Host.from_server(s, env.remote_user) for s in env.servers],
             repeat(env.target_path)
         )
-    releases = execution.concurrent_get_release_status(
+    releases = releasecache.cache.get_many(
         to_inspect,
-        timeout=5
+        timeout=5,
+        refresh=request.query.get('refresh') == '1'
     )
     # Build response
     out = {"releases": []}
@@ -547,9 +816,11 @@ def inventory_update_hook(db):
 @get('/api/clusters')
 @requires_logged
 def clusters_get(db):
-    clusters = db.query(m.Cluster).all()
-    schema = m.Cluster.__marshmallow__(many=True)
-    return json.dumps({'clusters': schema.dump(clusters).data})
+    def build():
+        clusters = db.query(m.Cluster).all()
+        schema = m.Cluster.__marshmallow__(many=True)
+        return json.dumps({'clusters': schema.dump(clusters).data})
+    return conditional_json(_topology_etag('clusters'), build)
 
 
 @post('/api/clusters')
@@ -560,7 +831,8 @@ def clusters_post(db):
         cluster_def = schema.load(request.json).data
         if cluster_def['haproxy_host'] == '':
             cluster_def['haproxy_host'] = None
-        cluster = m.Cluster(name=cluster_def['name'], haproxy_host=cluster_def['haproxy_host'])
+        cluster = m.Cluster(name=cluster_def['name'], haproxy_host=cluster_def['haproxy_host'],
+                            rollout_parallelism=cluster_def['rollout_parallelism'])
         servers = []
         for server in cluster_def['servers']:
             s = db.query(m.Server).get(server['server_id'])
@@ -634,6 +906,7 @@ def cluster_put(cluster_id, db):
     cluster.haproxy_host = cluster_def['haproxy_host']
     if cluster.haproxy_host == '':
         cluster.haproxy_host = None
+    cluster.rollout_parallelism = cluster_def['rollout_parallelism']
     for server_asso in cluster.servers:
         db.delete(server_asso)
     cluster.servers = []
@@ -702,15 +975,17 @@ def repository_delete(repository_id, db):
 @get('/api/environments')
 @requires_logged
 def environments_list(db):
-    if request.account.has_permission(authorization.ReadAllEnvironments()):
-        envs = db.query(m.Environment).all()
-    else:
-        envs = db.query(m.Environment).\
-            filter(m.Environment.id.in_(request.account.readable_environments())).\
-            all()
-    schema = m.Environment.__marshmallow__(many=True)
-    schema.context = {'account': request.account}
-    return json.dumps({'environments': schema.dump(envs).data})
+    def build():
+        if request.account.has_permission(authorization.ReadAllEnvironments()):
+            envs = db.query(m.Environment).all()
+        else:
+            envs = db.query(m.Environment).\
+                filter(m.Environment.id.in_(request.account.readable_environments())).\
+                all()
+        schema = m.Environment.__marshmallow__(many=True)
+        schema.context = {'account': request.account}
+        return json.dumps({'environments': schema.dump(envs).data})
+    return conditional_json(_topology_etag('environments'), build)
 
 
 @put('/api/environments/<environment_id:int>')
@@ -751,16 +1026,29 @@ def environment_delete(environment_id, db):
 @get('/api/deployments/recent')
 @requires_logged
 def deployments_recent(db):
-    q = db.query(m.DeploymentView).options(orm.joinedload('log_entries'))
-    if not request.account.has_permission(authorization.ReadAllEnvironments()):
-        q = q.filter(m.DeploymentView.environment_id.in_(request.account.readable_environments()))
-    deploys = q.order_by(m.DeploymentView.date_start_deploy.desc()).\
-        limit(70).\
-        all()
-    for deploy in deploys:
-        if deploy.user is not None:
-            deploy.username = deploy.user.username
-    return json.dumps({'deployments': m.DeploymentView.__marshmallow__(many=True).dump(deploys).data})
+    def restrict(q):
+        if not request.account.has_permission(authorization.ReadAllEnvironments()):
+            q = q.filter(m.DeploymentView.environment_id.in_(request.account.readable_environments()))
+        return q.order_by(m.DeploymentView.date_start_deploy.desc()).limit(70)
+
+    # Only the status, end date and log entries of a deployment change once it is created:
+    # look at them (and at the username), without loading the log entries
+    rows = restrict(db.query(m.DeploymentView.id, m.DeploymentView.status, m.DeploymentView.date_end_deploy, m.User.username).
+                    outerjoin(m.DeploymentView.user)).all()
+    last_log_entry_id = None
+    if len(rows) > 0:
+        last_log_entry_id = db.query(sa.func.max(m.LogEntry.id)).\
+            filter(m.LogEntry.deploy_id.in_([row[0] for row in rows])).\
+            scalar()
+    etag = ('deployments-recent', [tuple(row) for row in rows], last_log_entry_id)
+
+    def build():
+        deploys = restrict(db.query(m.DeploymentView).options(orm.joinedload('log_entries'))).all()
+        for deploy in deploys:
+            if deploy.user is not None:
+                deploy.username = deploy.user.username
+        return json.dumps({'deployments': m.DeploymentView.__marshmallow__(many=True).dump(deploys).data})
+    return conditional_json(etag, build)
 
 
 @post('/api/environments/<environment_id:int>/deployments')
@@ -841,6 +1129,7 @@ def users_post(db):
         auth_token=auth_token)
     db.add(user)
     db.commit()
+    principals.invalidate()
     return json.dumps({'user': m.User.__marshmallow__().dump(user).data})
 
 
@@ -876,6 +1165,7 @@ def users_put(user_id, db):
         else:
             user.auth_token = hash_token(request.json['auth_token'], default_app().config['deployer.bcrypt_log_rounds'])
     db.commit()
+    principals.invalidate()
     return json.dumps({'user': m.User.__marshmallow__().dump(user).data})
 
 
@@ -886,6 +1176,8 @@ def users_delete(user_id, db):
     if user is None:
         abort(404)
     db.delete(user)
+    db.commit()
+    principals.invalidate()
     return json.dumps({'user': m.User.__marshmallow__().dump(user).data})
 
 
@@ -912,6 +1204,7 @@ def roles_post(db):
     role = schema.load(request.json, session=db).data
     db.add(role)
     db.commit()
+    principals.invalidate()
     return json.dumps({'role': schema.dump(role).data})
 
 
@@ -924,6 +1217,7 @@ def roles_put(role_id, db):
         abort(404)
     role = schema.load(request.json, instance=existing, session=db).data
     db.commit()
+    principals.invalidate()
     return json.dumps({'role': schema.dump(role).data})
 
 
@@ -934,6 +1228,8 @@ def roles_delete(role_id, db):
     if role is None:
         abort(404)
     db.delete(role)
+    db.commit()
+    principals.invalidate()
     return json.dumps({'role': m.Role.__marshmallow__().dump(role).data})
 
 
@@ -963,28 +1259,8 @@ def catch_all(path, db):
     return static_file('index.html', html_root)
 
 
-class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
-    pass
-
-
-class LoggingWSGIRequestHandler(WSGIRequestHandler):
-
-    def log_message(self, format, *args):
-        code = args[1]
-        # Logging HTTP 200 responses is super verbose
-        if code == '200':
-            return
-        # But any non 200 reponse is suspicious and should be logger
-        logger.info(
-            "%s %s\n" % (
-                self.client_address[0], format % args
-            )
-        )
-
-
 # TODO: do not spawn the API ourselves ; instead, create an application.wsgi file defining
 # the WSGI app and let Apache or some other webserver serve it
-# TODO: or at least, use a better webserver than the standard WSGIServer
 class ApiWorker(object):
 
     # TODO: use our own config everywhere, do not rely on Bottle for that
@@ -1016,9 +1292,10 @@ class ApiWorker(object):
         app.config["health"] = health
         app.config["deployer.inventory"] = inventory_host
         app.config["deployer.inventory_auth"] = inventory_auth
-        self.httpd = make_server("0.0.0.0", config.getint('general', 'api_port'), app,
-                                 server_class=ThreadingWSGIServer,
-                                 handler_class=LoggingWSGIRequestHandler)
+        server_config = apiserver.ServerConfig.from_config(config)
+        logger.info("API server: {}".format(server_config.backend))
+        configure_logs_waiters(server_config.threads // 2)
+        self.httpd = apiserver.build_server("0.0.0.0", config.getint('general', 'api_port'), app, server_config)
 
     def _check_for_index_html(self, app):
         index_path = os.path.abspath(os.path.join(app.config['general.web_path'], "html", "index.html"))
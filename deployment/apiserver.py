@@ -0,0 +1,148 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+"""
+HTTP servers for the API.
+
+The server is chosen with the api_server option of deployer.ini:
+
+    - wsgiref: the standard library server, with one new thread per connection and no keep-alive.
+    - cherrypy: the CherryPy WSGI server (already used for the websockets), with a bounded pool
+      of threads, HTTP/1.1 keep-alive, a limited backlog, socket timeouts and a graceful shutdown.
+"""
+from logging import getLogger
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from SocketServer import ThreadingMixIn
+
+from cherrypy import wsgiserver
+
+logger = getLogger(__name__)
+
+
+class ServerConfig(object):
+    """Settings of the API server.
+
+    Args:
+        backend (str): 'wsgiref' or 'cherrypy'
+        threads (int): number of threads serving requests (cherrypy only)
+        backlog (int): maximum number of connections waiting to be accepted, and then to be served (cherrypy only)
+        timeout (float): timeout of the operations on the client sockets, in seconds (cherrypy only)
+        shutdown_timeout (float): how long in-flight requests can run once stop() is called, in seconds (cherrypy only)
+    """
+
+    BACKENDS = ('wsgiref', 'cherrypy')
+
+    def __init__(self, backend='wsgiref', threads=20, backlog=64, timeout=10, shutdown_timeout=10):
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown API server '{}', must be one of: {}".format(backend, ", ".join(self.BACKENDS)))
+        self.backend = backend
+        self.threads = threads
+        self.backlog = backlog
+        self.timeout = timeout
+        self.shutdown_timeout = shutdown_timeout
+
+    @classmethod
+    def from_config(klass, config):
+        """Read the api_server* options of the [general] section of deployer.ini (all optional)."""
+        kwargs = {}
+        for name, option, getter in (("backend", "api_server", config.get),
+                                     ("threads", "api_server_threads", config.getint),
+                                     ("backlog", "api_server_backlog", config.getint),
+                                     ("timeout", "api_server_timeout", config.getfloat),
+                                     ("shutdown_timeout", "api_server_shutdown_timeout", config.getfloat)):
+            if config.has_option("general", option):
+                kwargs[name] = getter("general", option)
+        return klass(**kwargs)
+
+
+def build_server(host, port, app, server_config):
+    """Return a server for this WSGI app, with serve_forever() and shutdown() methods."""
+    if server_config.backend == 'cherrypy':
+        return CherryPyServer(host, port, app, server_config)
+    return WSGIRefServer(host, port, app)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    pass
+
+
+class LoggingWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        code = args[1]
+        # Logging HTTP 200 responses is super verbose
+        if code == '200':
+            return
+        # But any non 200 reponse is suspicious and should be logger
+        logger.info(
+            "%s %s\n" % (
+                self.client_address[0], format % args
+            )
+        )
+
+
+class WSGIRefServer(object):
+
+    def __init__(self, host, port, app):
+        self.httpd = make_server(host, port, app,
+                                 server_class=ThreadingWSGIServer,
+                                 handler_class=LoggingWSGIRequestHandler)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+
+class LoggingCherryPyWSGIServer(wsgiserver.CherryPyWSGIServer):
+
+    def error_log(self, msg='', level=20, traceback=False):
+        logger.log(level, msg, exc_info=traceback)
+
+
+def log_responses(app):
+    """WSGI middleware logging the non 200 responses, like LoggingWSGIRequestHandler does."""
+    def logged_app(environ, start_response):
+        def logged_start_response(status, headers, exc_info=None):
+            if not status.startswith('200'):
+                logger.info("{} \"{} {}\" {}".format(
+                    environ.get('REMOTE_ADDR'), environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), status))
+            return start_response(status, headers, exc_info)
+        return app(environ, logged_start_response)
+    return logged_app
+
+
+class CherryPyServer(object):
+
+    def __init__(self, host, port, app, server_config):
+        # At most backlog connections are queued by the kernel, then at most backlog accepted connections
+        # wait for a thread: once both are full, new connections are refused.
+        self.server = LoggingCherryPyWSGIServer(
+            (host, port), log_responses(app),
+            numthreads=server_config.threads,
+            max=server_config.threads,
+            request_queue_size=server_config.backlog,
+            timeout=server_config.timeout,
+            shutdown_timeout=server_config.shutdown_timeout,
+            accepted_queue_size=server_config.backlog,
+            accepted_queue_timeout=server_config.timeout)
+
+    @property
+    def port(self):
+        """The port actually listened to (useful when binding to port 0), or None if not started yet."""
+        sock = getattr(self.server, 'socket', None)
+        return sock.getsockname()[1] if sock is not None else None
+
+    @property
+    def ready(self):
+        return self.server.ready
+
+    def serve_forever(self):
+        self.server.start()
+
+    def shutdown(self):
+        """Stop accepting connections, then wait for the in-flight requests (at most shutdown_timeout seconds)."""
+        self.server.stop()
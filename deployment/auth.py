@@ -1,11 +1,16 @@
 # Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+from collections import OrderedDict
 import datetime
+import threading
 import uuid
 import json
 import bcrypt
 
 from . import samodels as m
 
+# How long a session token is valid after being issued
+TOKEN_VALIDITY = datetime.timedelta(minutes=30)
+
 
 class AuthenticationError(Exception):
     pass
@@ -27,13 +32,69 @@ def issue_token(user, db):
     user.token_issued_at = issued_at
     user.session_token = token
     db.commit()
+    # The previous token of this user is no longer valid
+    principals.invalidate()
     return json.dumps({
         'token': token,
-        'expire_at': str(issued_at + datetime.timedelta(minutes=30)),
+        'expire_at': str(issued_at + TOKEN_VALIDITY),
         'user': m.User.__marshmallow__().dump(user).data
     })
 
 
+class PrincipalCache(object):
+    """Thread safe cache of authenticated users, by session token.
+
+    The cached users are detached from any session, with their roles (and parsed permissions) loaded:
+    they must only be read.
+    An entry expires with its session token, or max_age seconds after being cached, so that changes made
+    through another deployer instance are eventually seen. invalidate must be called when users or roles
+    are modified.
+    """
+
+    MAX_AGE = datetime.timedelta(seconds=60)
+    MAX_SIZE = 1000
+
+    def __init__(self, max_age=MAX_AGE, max_size=MAX_SIZE):
+        self.max_age = max_age
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, token, now=None):
+        """Return the cached user for this token (None for the default user), or None."""
+        now = now or datetime.datetime.utcnow()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            user, expire_at = entry
+            if expire_at <= now:
+                del self._entries[token]
+                return None
+            return user
+
+    def put(self, token, user, now=None):
+        """Cache a detached user. The token of the default user is None."""
+        now = now or datetime.datetime.utcnow()
+        expire_at = now + self.max_age
+        if token is not None:
+            expire_at = min(expire_at, user.token_issued_at + TOKEN_VALIDITY)
+        # Compile the permissions now rather than on each request
+        user.permission_index()
+        with self._lock:
+            self._entries.pop(token, None)
+            self._entries[token] = (user, expire_at)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principals = PrincipalCache()
+
+
 def check_hash(token, hashed):
     return bcrypt.hashpw(str(token), str(hashed)) == hashed
 
@@ -150,3 +150,54 @@ class Deployer(Permission):
 
     def to_dict(self):
         return {'deployer': True}
+
+
+class PermissionIndex(object):
+    """The permissions of several roles, compiled for fast checks.
+
+    allows(permission) gives the same answer as any(p.implies(permission) for p in permissions),
+    without going through every permission.
+
+    Args:
+        permissions (iterable of Permission)
+    """
+
+    def __init__(self, permissions):
+        self.permissions = list(permissions)
+        self.admin = any(isinstance(p, SuperAdmin) for p in self.permissions)
+        self.impersonate = any(isinstance(p, Impersonate) for p in self.permissions)
+        self.deployer = any(isinstance(p, Deployer) for p in self.permissions)
+        self.read_all = self.impersonate or any(isinstance(p, ReadAllEnvironments) for p in self.permissions)
+        # Deploy implies DeployBusinessHours, which implies Read
+        self.deploy = frozenset(p.environment_id for p in self.permissions if type(p) is Deploy)
+        self.deploy_business_hours = self.deploy | \
+            frozenset(p.environment_id for p in self.permissions if type(p) is DeployBusinessHours)
+        self.readable_environments = self.deploy_business_hours | \
+            frozenset(p.environment_id for p in self.permissions if type(p) is Read)
+        # Identical for indexes giving the same answers to allows() (for the permissions above)
+        self.fingerprint = hash((self.admin, self.impersonate, self.deployer, self.read_all,
+                                 tuple(sorted(self.deploy)), tuple(sorted(self.deploy_business_hours)),
+                                 tuple(sorted(self.readable_environments))))
+
+    def allows(self, permission):
+        if self.admin:
+            return True
+        kind = type(permission)
+        if self.deployer and isinstance(permission, Permission):
+            return True
+        if kind is Read:
+            return self.read_all or permission.environment_id in self.readable_environments
+        if kind is DeployBusinessHours:
+            return permission.environment_id in self.deploy_business_hours
+        if kind is Deploy:
+            return permission.environment_id in self.deploy
+        if kind is Default:
+            return self.read_all or len(self.readable_environments) > 0
+        if kind is ReadAllEnvironments:
+            return self.read_all
+        if kind is Impersonate:
+            return self.impersonate
+        if kind in (SuperAdmin, Deployer):
+            return False
+        # Unknown permission (or not a permission at all)
+        return any(p.implies(permission) for p in self.permissions)
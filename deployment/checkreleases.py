@@ -1,84 +1,226 @@
+from collections import namedtuple
 from logging import getLogger
 from datetime import timedelta, datetime
 from threading import Condition
+import multiprocessing.dummy
 import time
 
-from . import database, samodels as m
-from . import execution, executils
+from . import execution, executils, releasecache, topology
 
 logger = getLogger(__name__)
 
 
+# A server to check. environment is an environment name, and host an executils.Host
+ReleaseTarget = namedtuple('ReleaseTarget', ['repository', 'environment', 'server', 'host', 'target_path'])
+
+# Servers of a sweep to check again at a given time (results: ReleaseTarget -> (ReleaseStatus, latency))
+PendingRetry = namedtuple('PendingRetry', ['at', 'start', 'targets', 'results', 'to_retry'])
+
+
+def list_targets(snapshot, ignore_envs=()):
+    """Return the list of ReleaseTarget to check (servers of all the environments).
+
+    Deactivated servers and environments named in ignore_envs are skipped.
+
+    Args:
+        snapshot (topology.TopologySnapshot)
+    """
+    targets = []
+    environments = sorted(snapshot.environments.values(), key=lambda env: (env.repository_name, env.name))
+    for env in environments:
+        if env.name in ignore_envs:
+            continue
+        # A server may belong to several clusters of the same environment
+        servers = dict((server.id, server) for server in snapshot.environment_servers(env.id))
+        for server in sorted(servers.values(), key=lambda server: server.name):
+            if not server.activated:
+                logger.warning("Server:[{}] deactivated, do not check releases".format(server.name))
+                continue
+            host = executils.Host(server.name, env.remote_user, server.port)
+            targets.append(ReleaseTarget(env.repository_name, env.name, server.name, host, env.target_path))
+    return targets
+
+
 class CheckReleasesWorker(object):
-    """Check releases from every servers and update health info."""
+    """Check releases from every servers and update health info.
 
-    def __init__(self, frequency, ignore_envs, health):
+    All the servers are checked concurrently (at most max_parallel at the same time), each with its own SSH timeout.
+    The health info is updated at the end of each sweep. Servers that could not be checked are left out of it, and
+    retried once, retry_delay seconds later (unless the next sweep comes first): the health info is then updated
+    again with their results.
+    """
+
+    MAX_PARALLEL = 20
+    TIMEOUT = 10  # seconds, for each server
+    RETRY_DELAY = 30  # seconds
+
+    def __init__(self, frequency, ignore_envs, health, max_parallel=MAX_PARALLEL, timeout=TIMEOUT, retry_delay=RETRY_DELAY):
         logger.info("CheckReleases worker init. It will run every {} seconds, ignoring environments: {}".format(frequency, ignore_envs))
         self._running = True
         self._health = health
         self._ignore_envs = ignore_envs
         self._min_minutes = 30
+        self.max_parallel = max_parallel
+        self.timeout = timeout
+        self.retry_delay = retry_delay
         self.wakeup_period = timedelta(seconds=frequency)
         self.condition = Condition()
+        self._pending_retry = None
 
     def start(self):
-        get_release_status_timeout = 10
+        next_sweep = time.time()
         while self._running:
-            logger.info("CheckReleases worker wakeup")
-            self._health.set_ok("releases")
+            now = time.time()
+            if self._pending_retry is not None and self._pending_retry.at <= now:
+                try:
+                    self.retry()
+                except Exception:
+                    logger.exception("Unexpected error when trying to retrieve releases")
+            elif next_sweep <= now:
+                logger.info("CheckReleases worker wakeup")
+                next_sweep = now + self.wakeup_period.total_seconds()
+                try:
+                    self.sweep()
+                except Exception:
+                    logger.exception("Unexpected error when trying to retrieve releases")
+                logger.info("CheckReleases worker done")
+            else:
+                wakeup = next_sweep
+                if self._pending_retry is not None:
+                    wakeup = min(wakeup, self._pending_retry.at)
+                self._wait(wakeup - now)
+
+    def _wait(self, seconds):
+        with self.condition:
+            if self._running:
+                self.condition.wait(seconds)
+
+    def sweep(self):
+        """Check all the servers once, then update the health info and the metrics.
+
+        The servers to retry are not taken into account, see retry."""
+        start = time.time()
+        targets = list_targets(topology.service.current(), self._ignore_envs)
+
+        results = dict(zip(targets, self._probe(targets)))
+        to_retry = [t for t in targets if self._should_retry(results[t][0])]
+        self._pending_retry = None
+        if len(to_retry) > 0:
+            logger.warning("Could not get the release of {} servers, retrying in {}s".format(len(to_retry), self.retry_delay))
+            self._pending_retry = PendingRetry(time.time() + self.retry_delay, start, targets, results, to_retry)
+        return self._publish(start, targets, results, pending=to_retry, retried=[])
+
+    def retry(self):
+        """Check again the servers of the last sweep that could not be checked, then update the health info
+        and the metrics with the whole sweep.
+
+        Return:
+            the metrics, or None if there was nothing to retry
+        """
+        pending, self._pending_retry = self._pending_retry, None
+        if pending is None:
+            return None
+        results = dict(pending.results)
+        results.update(zip(pending.to_retry, self._probe(pending.to_retry)))
+        return self._publish(pending.start, pending.targets, results, pending=[], retried=pending.to_retry)
+
+    def _publish(self, start, targets, results, pending, retried):
+        errors = self._aggregate(targets, results, pending)
+        self._health.set_errors("releases", errors)
+
+        # Several environments may be deployed on a server
+        latencies = {}
+        for t in targets:
+            latencies.setdefault(t.environment, {})[t.server] = round(results[t][1], 3)
+        all_latencies = [latency for servers in latencies.values() for latency in servers.values()]
+        metrics = {
+            'sweep_duration': round(time.time() - start, 3),
+            'sweep_end': datetime.utcnow().isoformat(),
+            'servers': len(targets),
+            'pending_retry': len(pending),
+            'retried': len(retried),
+            'errors': len(errors),
+            'max_latency': max(all_latencies) if len(all_latencies) > 0 else 0,
+            'latencies': latencies,
+        }
+        self._health.set_metrics("releases", metrics)
+        logger.info("Checked the releases of {} servers in {}s ({} to retry, {} retried, {} errors)".format(
+            metrics['servers'], metrics['sweep_duration'], metrics['pending_retry'], metrics['retried'], metrics['errors']))
+        return metrics
+
+    def _probe(self, targets):
+        """Get the release status of the targets, concurrently.
+
+        Return:
+            a list of (ReleaseStatus, latency in seconds), in the same order as targets
+        """
+        if len(targets) == 0:
+            return []
+
+        # workaround for http://bugs.python.org/issue7980
+        import _strptime   # noqa
+
+        def probe(target):
+            start = time.time()
             try:
-                with database.session_scope() as session:
-                    repositories = session.query(m.Repository).all()
-                    for repo in repositories:
-                        try:
-                            for env in repo.environments:
-                                if env.name in self._ignore_envs:
-                                    logger.debug("Ignore environment {}".format(env.name))
-                                    continue
-                                releases = set()
-                                for srv in env.servers:
-                                    if srv.activated == 0:
-                                        logger.warning("Server:[{}] deactivated, do not check releases".format(srv.name))
-                                        continue
-                                    release_status = execution.get_release_status(executils.Host.from_server(srv, env.remote_user), env.target_path, get_release_status_timeout)
-                                    error_code = release_status.get_error_code()
-                                    if release_status.get_error():
-                                        logger.warning("Server:[{}] error executing ssh command (error_code:{})".format(srv.name, error_code))
-                                        if error_code in [1, 255]:
-                                            logger.warning("Server:[{}] error executing ssh command (error_code:{}), ignore releases check".format(srv.name, error_code))
-                                            continue
-                                        # retry after 30 seconds
-                                        time.sleep(30)
-                                        release_status = execution.get_release_status(executils.Host.from_server(srv, env.remote_user), env.target_path, get_release_status_timeout)
-                                        if release_status.get_error():
-                                            error = "No release found on server:[{}] repo:[{}] env:[{}]".format(srv.name, repo.name, env.name)
-                                            logger.error(error)
-                                            self._health.add_degraded("releases", error)
-                                            continue
-                                    age = datetime.utcnow() - release_status.get_release().deployment_date
-                                    if age < timedelta(minutes=self._min_minutes):
-                                        logger.debug("Ignore diff, commit was deployed less than {} minutes:[{}]".format(self._min_minutes, age))
-                                    else:
-                                        logger.debug("Add release:[{}:{}] repository:[{}] env:[{}] diff:[{}] ssh_error_code:[{}]".format(str(srv.id), release_status.get_release().commit, repo.name, env.name, age, error_code))
-                                        releases.add(release_status.get_release().commit)
-                                logger.info("Repository:[{}] env:[{}] releases_count:[{}]".format(repo.name, env.name, len(releases)))
-                                if len(releases) > 1:
-                                    self._health.add_degraded("releases", "at least one server is out of sync for repo:[{}] env:[{}]".format(repo.name, env.name))
-                        except Exception:
-                            logger.exception("Unexpected error when trying to retrieve releases for repo:[{}]".format(repo.name))
-            except Exception:
-                logger.exception("Unexpected error when trying to retrieve releases")
-            logger.info("CheckReleases worker done")
-            self.condition.acquire()
-            self.condition.wait(self.wakeup_period.total_seconds())
+                status = execution.get_release_status(target.host, target.target_path, self.timeout)
+            except Exception as e:
+                logger.exception("Server:[{}] error when getting the release".format(target.server))
+                status = execution.ReleaseStatus.error(str(e), -1)
+            else:
+                releasecache.cache.put(target.host, target.target_path, status, start)
+            return status, time.time() - start
+
+        pool = multiprocessing.dummy.Pool(min(self.max_parallel, len(targets)))
+        try:
+            return pool.map(probe, targets, chunksize=1)
+        finally:
+            pool.close()
+
+    def _should_retry(self, status):
+        if not status.get_error():
+            return False
+        # Connection errors (255) and missing release file (1) will not be fixed by retrying soon
+        return status.get_error_code() not in [1, 255]
+
+    def _aggregate(self, targets, results, pending=()):
+        """Return the list of health errors, ignoring the pending targets (not checked yet)."""
+        errors = []
+        releases = {}
+        for target in targets:
+            if target in pending:
+                continue
+            release_status = results[target][0]
+            key = (target.repository, target.environment)
+            releases.setdefault(key, set())
+            error_code = release_status.get_error_code()
+            if release_status.get_error():
+                if error_code in [1, 255]:
+                    logger.warning("Server:[{}] error executing ssh command (error_code:{}), ignore releases check".format(target.server, error_code))
+                else:
+                    error = "No release found on server:[{}] repo:[{}] env:[{}]".format(target.server, target.repository, target.environment)
+                    logger.error(error)
+                    errors.append(error)
+                continue
+            age = datetime.utcnow() - release_status.get_release().deployment_date
+            if age < timedelta(minutes=self._min_minutes):
+                logger.debug("Ignore diff, commit was deployed less than {} minutes:[{}]".format(self._min_minutes, age))
+            else:
+                logger.debug("Add release:[{}:{}] repository:[{}] env:[{}] diff:[{}] ssh_error_code:[{}]".format(target.server, release_status.get_release().commit, target.repository, target.environment, age, error_code))
+                releases[key].add(release_status.get_release().commit)
+        for (repository, environment), commits in sorted(releases.items()):
+            logger.info("Repository:[{}] env:[{}] releases_count:[{}]".format(repository, environment, len(commits)))
+            if len(commits) > 1:
+                errors.append("at least one server is out of sync for repo:[{}] env:[{}]".format(repository, environment))
+        return errors
 
     def stop(self):
         logger.info("CheckReleases worker stop")
         if self._running:
             self.condition.acquire()
+            self._running = False
             self.condition.notifyAll()
             self.condition.release()
-            self._running = False
 
     @property
     def name(self):
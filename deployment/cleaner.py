@@ -6,8 +6,9 @@ from threading import Condition
 
 from sqlalchemy import func
 
+from deployment import commitindex, gitutils
 from deployment.database import session_scope
-from deployment.gitutils import lock_repository_write, lock_repository_fetch
+from deployment.gitutils import lock_repository_write, lock_repository_fetch, repo_handles
 import deployment.samodels as m
 
 
@@ -49,14 +50,36 @@ class CleanerWorker():
                 filter(subquery.c.max_queued_date > now - self.max_unused_age).\
                 all()
             to_keep = set(e.local_repo_directory_name for e in recently_deployed_envs)
+            # Handled by _cleanup_mirrors
+            to_keep.add(gitutils.MIRRORS_FOLDER)
             for path in deletion_candidates - to_keep:
                 path = os.path.join(self.base_repos_path, path)
                 if os.path.exists(path):
                     with lock_repository_fetch(path), lock_repository_write(path):
+                        shared_repo_path = gitutils.storage_path(path)
+                        repo_handles.evict(path)
                         rmtree(path)
+                        commitindex.forget(path)
+                        if shared_repo_path != path:
+                            gitutils.prune_worktrees(shared_repo_path)
                     logger.info(
                         "Deleted unused directory {}".format(path)
                     )
+        self._cleanup_mirrors()
+
+    def _cleanup_mirrors(self):
+        """Delete the shared repositories (worktree layout) without worktrees left."""
+        mirrors_path = os.path.join(self.base_repos_path, gitutils.MIRRORS_FOLDER)
+        if not os.path.exists(mirrors_path):
+            return
+        for name in os.listdir(mirrors_path):
+            path = os.path.join(mirrors_path, name)
+            with gitutils.acquire_repo_lock("fetch", path):
+                if gitutils.prune_worktrees(path) > 0:
+                    continue
+                rmtree(path)
+                commitindex.forget(path)
+            logger.info("Deleted unused shared repository {}".format(path))
 
     def stop(self):
         self.running = False
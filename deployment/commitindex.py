@@ -0,0 +1,287 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+"""
+On-disk index of the commits of a local repository.
+
+Listing commits through GitPython spawns git and parses each commit object on every request.
+Instead, the metadata of the commits (parents, committer, dates, message) is kept in an append-only
+file next to the repository, updated after each fetch (under the fetch lock) with only the commits
+that were not indexed yet. Only the commit graph (parents, commit time) and the position of each record in
+the file are kept in memory: the records themselves are read from the file when needed, and the last
+RECORDS_CACHE_SIZE ones are cached.
+
+Files (in the git directory of the repository, shared by its worktrees):
+    deployer-commits: one JSON object per line and per commit, never rewritten
+    deployer-commits-refs: JSON object {ref name: hexsha} of the indexed remote refs, replaced atomically
+        once the commits reachable from these refs are in deployer-commits
+"""
+import datetime
+import heapq
+import json
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+COMMITS_FILE = 'deployer-commits'
+REFS_FILE = 'deployer-commits-refs'
+REMOTE_REFS_PREFIX = 'refs/remotes/origin/'
+
+# Fields of the git log format, separated by FIELD_SEPARATOR. The message (%B) must stay the last one.
+LOG_FORMAT = '%H%x1f%P%x1f%cn%x1f%ae%x1f%ad%x1f%ct%x1f%B'
+FIELD_SEPARATOR = '\x1f'
+
+# Records (IndexedCommit) kept in memory, per repository
+RECORDS_CACHE_SIZE = 1000
+
+# What a walk needs to know about a commit, and where its record is in the commits file
+_Node = namedtuple('_Node', ['offset', 'committed_at', 'parents'])
+
+
+class IndexedCommit(object):
+
+    __slots__ = ('hexsha', 'parents', 'committer', 'authored_date', 'committed_at', 'message')
+
+    def __init__(self, hexsha, parents, committer, authored_date, committed_at, message):
+        self.hexsha = hexsha
+        self.parents = parents
+        self.committer = committer
+        # Author local time, as gitutils.LocalRepository does
+        self.authored_date = authored_date
+        # Timestamp, used to order commits like git rev-list does
+        self.committed_at = committed_at
+        self.message = message
+
+    def to_json(self):
+        return json.dumps({
+            'hexsha': self.hexsha,
+            'parents': self.parents,
+            'committer': self.committer,
+            'authored_date': self.authored_date.strftime('%Y-%m-%dT%H:%M:%S'),
+            'committed_at': self.committed_at,
+            'message': self.message,
+        })
+
+    @classmethod
+    def from_json(klass, line):
+        data = json.loads(line)
+        return klass(data['hexsha'], data['parents'], data['committer'],
+                     datetime.datetime.strptime(data['authored_date'], '%Y-%m-%dT%H:%M:%S'),
+                     data['committed_at'], data['message'])
+
+    @classmethod
+    def from_log_entry(klass, entry):
+        """Parse an entry of git log -z --date=raw --format=LOG_FORMAT."""
+        hexsha, parents, committer, author_email, raw_date, committed_at, message = entry.split(FIELD_SEPARATOR, 6)
+        # raw date: "<timestamp> <+/-HHMM>"
+        timestamp, tz = raw_date.split(' ')
+        offset = (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60) * (-1 if tz[0] == '-' else 1)
+        return klass(hexsha, parents.split(' ') if parents else [],
+                     (committer or author_email).decode('utf-8', 'replace'),
+                     datetime.datetime.utcfromtimestamp(int(timestamp) + offset),
+                     int(committed_at), message.decode('utf-8', 'replace'))
+
+
+class CommitIndex(object):
+    """The commits of one repository, read from its index files.
+
+    Args:
+        git_dir (str): the git directory of the repository (where the index files are)
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._lock = threading.Lock()
+        self._nodes = {}  # hexsha -> _Node
+        self._records = OrderedDict()  # hexsha -> IndexedCommit, least recently used first
+        self._offset = 0  # how much of the commits file has been read
+        self._refs = None
+        self._refs_version = None
+
+    @property
+    def commits_path(self):
+        return os.path.join(self.git_dir, COMMITS_FILE)
+
+    @property
+    def refs_path(self):
+        return os.path.join(self.git_dir, REFS_FILE)
+
+    def exists(self):
+        return os.path.exists(self.refs_path)
+
+    def refresh(self):
+        """Read the commits appended since the last refresh, and the indexed refs."""
+        with self._lock:
+            try:
+                with open(self.commits_path, 'rb') as f:
+                    f.seek(self._offset)
+                    data = f.read()
+            except IOError:
+                data = ''
+            # Ignore a line being written
+            end = data.rfind('\n') + 1
+            position = 0
+            while position < end:
+                line_end = data.index('\n', position) + 1
+                commit = IndexedCommit.from_json(data[position:line_end])
+                self._nodes[commit.hexsha] = _Node(self._offset + position, commit.committed_at, tuple(commit.parents))
+                # A later line replaces the previous one for the same commit
+                self._records.pop(commit.hexsha, None)
+                position = line_end
+            self._offset += end
+            try:
+                stat = os.stat(self.refs_path)
+            except OSError:
+                self._refs = None
+                return
+            # The refs file is replaced, not modified: a new inode means new refs
+            refs_version = (stat.st_ino, stat.st_mtime)
+            if refs_version != self._refs_version:
+                with open(self.refs_path) as f:
+                    self._refs = json.load(f)
+                self._refs_version = refs_version
+
+    def refs(self):
+        """Return the indexed refs ({ref name: hexsha}), or None if the repository is not indexed."""
+        self.refresh()
+        return self._refs
+
+    def resolve(self, rev):
+        """Return the hexsha of a remote branch name (with or without the origin/ prefix) or of a commit, or None."""
+        refs = self.refs()
+        if refs is None:
+            return None
+        name = rev[len('origin/'):] if rev.startswith('origin/') else rev
+        if REMOTE_REFS_PREFIX + name in refs:
+            return refs[REMOTE_REFS_PREFIX + name]
+        if rev in self._nodes:
+            return rev
+        # Abbreviated hexsha
+        if len(rev) >= 7:
+            matching = [hexsha for hexsha in self._nodes if hexsha.startswith(rev)]
+            if len(matching) == 1:
+                return matching[0]
+        return None
+
+    def get(self, hexsha):
+        self.refresh()
+        if hexsha not in self._nodes:
+            return None
+        return self._read(hexsha)
+
+    def _read(self, hexsha):
+        """Return the IndexedCommit of an indexed commit, from the cache or from the commits file."""
+        with self._lock:
+            commit = self._records.pop(hexsha, None)
+            if commit is None:
+                with open(self.commits_path, 'rb') as f:
+                    f.seek(self._nodes[hexsha].offset)
+                    commit = IndexedCommit.from_json(f.readline())
+            self._records[hexsha] = commit
+            while len(self._records) > RECORDS_CACHE_SIZE:
+                self._records.popitem(last=False)
+            return commit
+
+    def walk(self, tip, exclude=None, count=None):
+        """Yield the commits reachable from tip (but not from exclude), most recently committed first, like git rev-list.
+
+        Raise KeyError if a commit is missing from the index.
+        """
+        self.refresh()
+        for hexsha in self._walk_graph(tip, exclude, count):
+            yield self._read(hexsha)
+
+    def _walk_graph(self, tip, exclude=None, count=None):
+        """Same as walk, but yield the hexsha of the commits (without reading their records)."""
+        excluded = set(self._walk_graph(exclude)) if exclude is not None else set()
+        seen = set([tip])
+        queue = [(-self._nodes[tip].committed_at, tip)]
+        n = 0
+        while queue and (count is None or n < count):
+            _, hexsha = heapq.heappop(queue)
+            if hexsha in excluded:
+                continue
+            yield hexsha
+            n += 1
+            for parent in self._nodes[hexsha].parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    # Shallow clones do not have all the parents
+                    if parent in self._nodes:
+                        heapq.heappush(queue, (-self._nodes[parent].committed_at, parent))
+
+    def update(self, repo, full=False):
+        """Index the commits of the remote refs that are not indexed yet.
+
+        Must be called with the fetch lock of the repository.
+
+        Args:
+            repo (git.Repo)
+            full (bool): read all the commits of the remote refs again, after the history of a shallow
+                repository was deepened (the parents of the commits at its former boundary have changed)
+        """
+        refs = {}
+        for line in repo.git.for_each_ref(REMOTE_REFS_PREFIX, format='%(refname) %(objectname) %(objecttype)').splitlines():
+            name, hexsha, object_type = line.split(' ')
+            if object_type == 'commit' and not name.endswith('/HEAD'):
+                refs[name] = hexsha
+        known = list(set((self.refs() or {}).values())) if not full else []
+        new_tips = [tip for tip in set(refs.values()) if full or tip not in self._nodes]
+        if len(new_tips) > 0:
+            args = ['-z', '--date=raw', '--format=' + LOG_FORMAT] + new_tips
+            if len(known) > 0:
+                # Commits of the previous refs may have been garbage collected since (after a force push)
+                args += ['--ignore-missing', '--not'] + known
+            output = repo.git.log(*args, stdout_as_string=False)
+            entries = [IndexedCommit.from_log_entry(entry) for entry in output.split('\0') if entry.strip('\n')]
+            with open(self.commits_path, 'ab') as f:
+                # Parents first
+                for commit in reversed(entries):
+                    # A later line replaces the previous one for the same commit
+                    indexed = self._nodes.get(commit.hexsha)
+                    if indexed is None or indexed.parents != tuple(commit.parents):
+                        f.write(commit.to_json() + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            logger.debug("Indexed {} new commits in {}".format(len(entries), self.git_dir))
+        tmp_path = self.refs_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(refs, f)
+        os.rename(tmp_path, self.refs_path)
+        self.refresh()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index_dir(repo):
+    """Return the directory of the index of a git.Repo (the same for all the worktrees of a repository)."""
+    return os.path.normpath(repo.common_dir)
+
+
+def get_index(git_dir):
+    """Return the (shared) CommitIndex of a repository."""
+    with _indexes_lock:
+        index = _indexes.get(git_dir)
+        if index is None:
+            index = _indexes[git_dir] = CommitIndex(git_dir)
+        return index
+
+
+def forget(repo_path):
+    """Forget the in-memory copy of the indexes of a repository (when it is deleted)."""
+    repo_path = repo_path.rstrip(os.sep)
+    with _indexes_lock:
+        for git_dir in list(_indexes.keys()):
+            if git_dir == repo_path or git_dir.startswith(repo_path + os.sep):
+                del _indexes[git_dir]
+
+
+def update_index(repo, full=False):
+    """Update the index of a repository, logging errors instead of raising them (the index is only an optimization)."""
+    try:
+        get_index(index_dir(repo)).update(repo, full)
+    except Exception:
+        logger.exception("Could not update the commit index of {}".format(repo.git_dir))
@@ -3,15 +3,26 @@
 Collection of helpers to run commands both on local and remote hosts.
 """
 
-import datetime
+import collections
+import errno
+import fcntl
+import hashlib
 import os
 from logging import getLogger
 import subprocess
 import select
 import signal
+import tempfile
+import threading
+import time
+
+from .fsutils import mkdir_p
 
 logger = getLogger(__name__)
 
+# Bytes of output kept in memory, per stream of a command
+MAX_OUTPUT_SIZE = 1024 * 1024
+
 
 class Host(object):
     """A Host contains the necessary information to connect to a server using SSH
@@ -37,36 +48,260 @@ class Host(object):
         """
         return klass(server.name, username, server.port)
 
+    @property
+    def key(self):
+        return (self.name, self.username, self.port)
+
+    def __eq__(self, other):
+        return isinstance(other, Host) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+class SSHConnectionSharing(object):
+    """Share one SSH master connection per Host between all the commands run on this host
+    (OpenSSH connection multiplexing), so we only pay for the SSH handshake once.
+
+    The master connection is started on first use, and exits by itself after being unused for
+    idle_timeout seconds (see ControlPersist in ssh_config(5)). If the master is not available for
+    some reason, commands fall back to a regular SSH connection.
+
+    Args:
+        control_dir (str): folder where the control sockets are created
+        idle_timeout (int): seconds
+    """
+
+    MASTER_CONNECT_TIMEOUT = 10
+
+    def __init__(self, control_dir, idle_timeout=60):
+        self.control_dir = control_dir
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._last_used = {}  # Host -> time of the last command sent through its master
+
+    def control_path(self, host):
+        # Control socket paths are limited to ~100 characters, so do not use the host name directly
+        digest = hashlib.sha1("{}@{}:{}".format(host.username, host.name, host.port)).hexdigest()[:16]
+        return os.path.join(self.control_dir, digest)
+
+    def options(self, host):
+        """Return the SSH options to use to run a command through the master connection of this host."""
+        self._ensure_master(host)
+        return ['-o', 'ControlMaster=no', '-o', 'ControlPath={}'.format(self.control_path(host))]
+
+    def _ensure_master(self, host):
+        with self._lock:
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+        with host_lock:
+            now = time.time()
+            last_used = self._last_used.get(host)
+            # Recently used masters are still there (keep a margin, so the master does not exit while we are
+            # starting a command). Otherwise ask the master: ControlPersist only counts from the end of the last
+            # command, and starting a second master on the same socket would leave a plain SSH session behind.
+            recently_used = last_used is not None and now - last_used <= self.idle_timeout - 1
+            if not (recently_used and os.path.exists(self.control_path(host))) and not self._master_alive(host):
+                self._start_master(host)
+            self._last_used[host] = time.time()
+
+    def _master_alive(self, host):
+        if not os.path.exists(self.control_path(host)):
+            return False
+        cmd = ['ssh', '-o', 'ControlPath={}'.format(self.control_path(host)), '-O', 'check',
+               '{}@{}'.format(host.username, host.name), '-p', str(host.port)]
+        with open(os.devnull, 'r+') as devnull:
+            if subprocess.call(cmd, stdin=devnull, stdout=devnull, stderr=devnull) == 0:
+                return True
+        # Left by a master that did not exit cleanly, it would prevent a new master from listening
+        try:
+            os.unlink(self.control_path(host))
+        except OSError:
+            pass
+        return False
+
+    def _start_master(self, host):
+        mkdir_p(self.control_dir)
+        cmd = ['ssh', '-o', 'ControlMaster=yes', '-o', 'ControlPath={}'.format(self.control_path(host)),
+               '-o', 'ControlPersist={}'.format(self.idle_timeout),
+               '-o', 'ConnectTimeout={}'.format(self.MASTER_CONNECT_TIMEOUT),
+               '-N', '-f', '{}@{}'.format(host.username, host.name), '-p', str(host.port)]
+        # The backgrounded master must not hold our pipes open
+        with open(os.devnull, 'r+') as devnull:
+            code = subprocess.call(cmd, stdin=devnull, stdout=devnull, stderr=devnull)
+        if code != 0:
+            logger.warning("Could not start a SSH master connection to {}@{}:{} (exit code {}), "
+                           "will use a regular connection".format(host.username, host.name, host.port, code))
+
+    def close_all(self):
+        """Close all the master connections."""
+        with self._lock:
+            hosts = list(self._last_used.keys())
+            self._last_used = {}
+        for host in hosts:
+            if not os.path.exists(self.control_path(host)):
+                continue
+            cmd = ['ssh', '-o', 'ControlPath={}'.format(self.control_path(host)), '-O', 'exit',
+                   '{}@{}'.format(host.username, host.name), '-p', str(host.port)]
+            with open(os.devnull, 'r+') as devnull:
+                subprocess.call(cmd, stdin=devnull, stdout=devnull, stderr=devnull)
+
+
+# Disabled unless enable_ssh_connection_sharing is called
+_ssh_connection_sharing = None
+
+
+def enable_ssh_connection_sharing(control_dir, idle_timeout=60):
+    global _ssh_connection_sharing
+    _ssh_connection_sharing = SSHConnectionSharing(control_dir, idle_timeout)
+
+
+def close_ssh_connections():
+    if _ssh_connection_sharing is not None:
+        _ssh_connection_sharing.close_all()
+
 
-def run_cmd_by_ssh(host, cmd, timeout=900):
+def _ssh_options(host):
+    if _ssh_connection_sharing is None:
+        return []
+    return _ssh_connection_sharing.options(host)
+
+
+def ssh_transport(host):
+    """Remote shell to use when running rsync (rsync -e) against the given host."""
+    return ' '.join(['ssh', '-p', str(host.port)] + _ssh_options(host))
+
+
+def run_cmd_by_ssh(host, cmd, timeout=900, on_output=None):
     """
     Args:
         host (Host)
         cmd (list of str): command to run
         timeout (int): return (with a status code 1) if the command did
                        not complete before this time
+        on_output (callable): see exec_cmd documentation
 
     Returns:
         tuple: see exec_cmd documentation
     """
 
-    full_cmd = ['ssh', '{}@{}'.format(host.username, host.name), '-p', str(host.port)] + cmd
+    full_cmd = ['ssh', '{}@{}'.format(host.username, host.name), '-p', str(host.port)] + _ssh_options(host) + cmd
+    if on_output is not None:
+        return exec_cmd(full_cmd, timeout=timeout, on_output=on_output)
     return exec_cmd(full_cmd, timeout=timeout)
 
 
-def exec_script(working_directory, script_name, params=None):
+def run_cmds_by_ssh(host, cmds, timeout=900, stop_on_error=False, on_output=None, cleanup_cmd=None):
+    """Run several commands on a remote host in a single SSH session.
+
+    Each command runs in its own subshell (so a 'cd' does not leak into the next command),
+    with its own standard output and error.
+
+    Args:
+        host (Host)
+        cmds (list of list of str): commands to run, in order
+        timeout (int): timeout for the whole batch
+        stop_on_error (bool): do not run the remaining commands once a command exits with a non-zero code
+        on_output (callable): if provided, the standard output of the commands is also streamed to
+                              on_output('stdout', data) while they run (see exec_cmd)
+        cleanup_cmd (list of str): if provided, command run when the batch ends, even if stop_on_error
+                                   interrupted it. Its output is discarded.
+
+    Returns:
+        list of tuples: a (exit code, stdout, stderr) tuple per command that was run. If the batch was
+        interrupted (SSH failure, timeout...), the last tuple describes the error and the
+        following commands are missing.
+    """
+    if len(cmds) == 0:
+        return []
+    kwargs = {}
+    if on_output is not None:
+        # The live output is mirrored on the standard error of the session
+        kwargs['on_output'] = lambda stream, data: on_output('stdout', data) if stream == 'stderr' else None
+    code, stdout, stderr = run_cmd_by_ssh(host, [_batch_script(cmds, stop_on_error, on_output is not None, cleanup_cmd)],
+                                          timeout=timeout, **kwargs)
+    results = _parse_batch_output(stdout, len(cmds))
+    stopped = stop_on_error and len(results) > 0 and results[-1][0] != 0
+    if len(results) < len(cmds) and not stopped:
+        results.append((code if code != 0 else 1, "", stderr))
+    return results
+
+
+def _batch_script(cmds, stop_on_error, mirror_output=False, cleanup_cmd=None):
+    """Shell script running cmds and printing, for each of them, a '<exit code> <stdout length> <stderr length>'
+    header followed by its standard output and error.
+
+    If mirror_output is True, the standard output of the commands is also written to the standard error
+    of the script while they run. cleanup_cmd, if any, is run silently when the script exits."""
+    cleanup = '({}) >/dev/null 2>&1; '.format(' '.join(cleanup_cmd)) if cleanup_cmd else ''
+    lines = [
+        '__deployer_cleanup() {{ {}rm -rf "$__deployer_batch"; }}'.format(cleanup),
+        'trap __deployer_cleanup EXIT',
+        '__deployer_batch=$(mktemp -d) || exit 255',
+    ]
+    for cmd in cmds:
+        if mirror_output:
+            lines.append('{{ ({}) 2>"$__deployer_batch/err"; echo $? >"$__deployer_batch/rc"; }} | tee "$__deployer_batch/out" >&2'.format(' '.join(cmd)))
+            lines.append('__deployer_rc=$(cat "$__deployer_batch/rc")')
+        else:
+            lines.append('({}) >"$__deployer_batch/out" 2>"$__deployer_batch/err"; __deployer_rc=$?'.format(' '.join(cmd)))
+        lines.append('echo $__deployer_rc $(wc -c <"$__deployer_batch/out") $(wc -c <"$__deployer_batch/err")')
+        lines.append('cat "$__deployer_batch/out" "$__deployer_batch/err"')
+        if stop_on_error:
+            lines.append('[ $__deployer_rc -eq 0 ] || exit 0')
+    return '\n'.join(lines)
+
+
+def _parse_batch_output(output, count):
+    results = []
+    position = 0
+    while len(results) < count:
+        end = output.find('\n', position)
+        if end == -1:
+            break
+        try:
+            code, stdout_length, stderr_length = [int(field) for field in output[position:end].split()]
+        except ValueError:
+            break
+        start = end + 1
+        middle = start + stdout_length
+        position = middle + stderr_length
+        if position > len(output):
+            break
+        results.append((code, output[start:middle], output[middle:position]))
+    return results
+
+
+def remote_script_cmd(remote_working_directory, script_name, params=None):
+    """Command running a script in remote_working_directory, which is not an error if the script does not exist.
+
+    Same behavior as exec_script_remote, to be used with run_cmds_by_ssh."""
+    if params is None:
+        params = []
+    return [
+        'cd', remote_working_directory, '&&',
+        'if', '[', '-e', script_name, '];', 'then', 'bash', script_name] + params + [
+        ';', 'else', 'echo', '"No remote script \'{}\'"'.format(script_name) + ';', 'fi'
+    ]
+
+
+def exec_script(working_directory, script_name, params=None, on_output=None):
     """Run a local shell script if it exists. No error is returned if the script does not exist.
 
     Args:
         working_directory: use this working directory to run the script
         script_name: path to the script (absolute, or relative to the working directory)
+        on_output (callable): see exec_cmd documentation
     """
     if params is None:
         params = []
     path = os.path.join(working_directory, script_name)
     if not os.path.exists(path):
         return (0, "No script '{}'.".format(script_name), None)
-    out = exec_cmd(['bash', script_name] + params, working_directory, use_shell=False)
+    out = exec_cmd(['bash', script_name] + params, working_directory, use_shell=False, on_output=on_output)
     return out
 
 
@@ -87,7 +322,91 @@ def exec_script_remote(host, remote_working_directory, script_name, params=None)
     return run_cmd_by_ssh(host, cmd)
 
 
-def exec_cmd(cmd, current_working_directory=None, timeout=600, use_shell=None):
+class OutputCollector(object):
+    """Accumulates the output of a command.
+
+    Up to max_size bytes are kept in memory. Beyond that, the whole output is written to a temporary file,
+    and only its last max_size bytes are kept in memory: getvalue then returns these last lines, followed by a
+    note giving the path to the full output. The temporary file is deleted by discard (exec_cmd only keeps it
+    when the command fails, for later inspection).
+    """
+
+    def __init__(self, max_size=MAX_OUTPUT_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.spill_path = None
+        self._spill = None
+        self._chunks = collections.deque()
+        self._in_memory = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self._chunks.append(data)
+        self._in_memory += len(data)
+        if self._spill is not None:
+            self._spill.write(data)
+        elif self.size > self.max_size:
+            fd, self.spill_path = tempfile.mkstemp(prefix='deployer-output-', suffix='.log')
+            self._spill = os.fdopen(fd, 'wb')
+            for chunk in self._chunks:
+                self._spill.write(chunk)
+        if self._spill is not None:
+            while len(self._chunks) > 1 and self._in_memory - len(self._chunks[0]) >= self.max_size:
+                self._in_memory -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        if self._spill is None:
+            return "".join(self._chunks)
+        tail = "".join(self._chunks)[-self.max_size:]
+        # Start at the beginning of a line
+        tail = tail[tail.find("\n") + 1:] if "\n" in tail else tail
+        if self.spill_path is None:
+            return "{}\n[output truncated: {} bytes in total]".format(tail, self.size)
+        return "{}\n[output truncated: {} bytes in total, the full output is in {}]".format(
+            tail, self.size, self.spill_path)
+
+    def close(self):
+        """Close the temporary file, if any (the output can still be read with getvalue)."""
+        if self._spill is not None:
+            self._spill.close()
+
+    def discard(self):
+        """Close and delete the temporary file, if any (getvalue still returns the last lines)."""
+        self.close()
+        if self.spill_path is not None:
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                logger.exception("Could not delete {}".format(self.spill_path))
+            self.spill_path = None
+
+
+class _LineSplitter(object):
+    """Forwards data to callback(stream_name, data) by chunks of complete lines."""
+
+    MAX_PENDING = 64 * 1024
+
+    def __init__(self, stream_name, callback):
+        self.stream_name = stream_name
+        self.callback = callback
+        self._pending = ""
+
+    def feed(self, data):
+        self._pending += data
+        end = self._pending.rfind("\n")
+        if end != -1:
+            self.callback(self.stream_name, self._pending[:end + 1])
+            self._pending = self._pending[end + 1:]
+        elif len(self._pending) >= self.MAX_PENDING:
+            self.close()
+
+    def close(self):
+        if len(self._pending) > 0:
+            self.callback(self.stream_name, self._pending)
+            self._pending = ""
+
+
+def exec_cmd(cmd, current_working_directory=None, timeout=600, use_shell=None, on_output=None):
     """
     Execute a command on the local machine.
 
@@ -95,58 +414,290 @@ def exec_cmd(cmd, current_working_directory=None, timeout=600, use_shell=None):
         cmd (list): command to execute. First element is the executable name, other elements are the parameters
         current_working_directory (str): if provided, the command will be executed in a shell with the working directory set to this.
         timeout (int): timeout in seconds for the command to complete. If the timeout is reached, returns immediately and set the exit code to 1.
+        on_output (callable): if provided, called with ('stdout' or 'stderr', data) as the command outputs data,
+                              data being one or more complete lines (unless a line is very long or is the last one).
 
     Returns
-        a tuple: (exit code, stdout, sterr)
+        a tuple: (exit code, stdout, sterr). Each output is truncated to its last MAX_OUTPUT_SIZE bytes,
+        see OutputCollector.
     """
+    outputs = (OutputCollector(), OutputCollector())
+    splitters = (_LineSplitter('stdout', on_output), _LineSplitter('stderr', on_output)) if on_output else None
     try:
         if use_shell is None:
             use_shell = current_working_directory is not None
-        p = subprocess.Popen(cmd, shell=use_shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=current_working_directory, bufsize=1)
+        # In its own process group, so that the children of the command can be killed with it
+        p = subprocess.Popen(cmd, shell=use_shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=current_working_directory,
+                             preexec_fn=os.setsid)
+        job = process_supervisor().run(p, timeout, outputs, splitters)
+        if not job.timed_out and p.returncode == 0:
+            # The full output of a failed command is kept for inspection only
+            for output in outputs:
+                output.discard()
+        if job.timed_out:
+            out = (1, outputs[0].getvalue(), "Timeout (the command took more than {}s to return)\n\n{}".format(timeout, outputs[1].getvalue()))
+            logger.error("cmd:[%s] timeout! so far: stdout:[%s] stderr:[%s]" % (cmd, out[1], out[2]))
+            return out
+        out = (p.returncode, outputs[0].getvalue(), outputs[1].getvalue())
+        logger.debug("cmd:[%s] stdout:[%s] stderr:[%s]" % (cmd, out[1], out[2]))
+        return out
+    except Exception as e:
+        logger.exception("error:[%s] cmd:[%s]" % (str(e), cmd))
+        for output in outputs:
+            output.discard()
+        return (1, "", str(e))
 
-        reads = [p.stdout.fileno(), p.stderr.fileno()]
-        outputs = ([], [])
 
-        # Wait for completion
-        start = datetime.datetime.now()
-        while p.poll() is None:
-            ret = select.select(reads, [], [], 0.2)
+try:
+    from time import monotonic as _monotonic
+except ImportError:  # Python 2
+    def _monotonic():
+        # Elapsed real time since an arbitrary point in the past, not affected by system clock changes
+        return os.times()[4]
 
-            for fd in ret[0]:
-                for i in range(0, len(reads)):
-                    if fd == reads[i]:
-                        data = os.read(fd, 4096)
-                        outputs[i].append(data)
-                        break
 
-            # Check whether timeout is exceeded
-            now = datetime.datetime.now()
-            if (now - start) > datetime.timedelta(seconds=timeout):
-                os.kill(p.pid, signal.SIGKILL)
-                os.waitpid(p.pid, 0)
-                stdout = "".join(outputs[0])
-                stderr = "".join(outputs[1])
-                logger.error("cmd:[%s] timeout! so far: stdout:[%s] stderr:[%s]" % (cmd, stdout, stderr))
-                return (1, stdout, "Timeout (the command took more than {}s to return)\n\n{}".format(timeout, stderr))
-
-        # Read remaining data
-        performed_read = True
-        while performed_read:
-            performed_read = False
-            ret = select.select(reads, [], [], 0)
-            for fd in ret[0]:
-                for i in range(0, len(reads)):
-                    if fd == reads[i]:
-                        data = os.read(fd, 4096)
-                        if len(data) > 0:
-                            performed_read = True
-                            outputs[i].append(data)
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Poller(object):
+    """epoll where available, poll otherwise."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._flags = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self._timeout_scale = 1
+        else:
+            self._poller = select.poll()
+            self._flags = select.POLLIN | select.POLLERR | select.POLLHUP
+            self._timeout_scale = 1000
+
+    def register(self, fd):
+        self._poller.register(fd, self._flags)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Return the file descriptors that are ready (timeout in seconds, None to wait forever)."""
+        if timeout is None:
+            timeout = -1 if self._timeout_scale == 1 else None
+        else:
+            timeout = timeout * self._timeout_scale
+        try:
+            return [fd for fd, _ in self._poller.poll(timeout)]
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class CommandJob(object):
+    """A command supervised by a ProcessSupervisor."""
+
+    def __init__(self, process, deadline, outputs, splitters):
+        self.process = process
+        self.deadline = deadline
+        self.outputs = outputs
+        self.splitters = splitters
+        self.fds = dict((pipe.fileno(), i) for i, pipe in enumerate((process.stdout, process.stderr)))
+        self.open_fds = set(self.fds)
+        self.timed_out = False
+        self.error = None  # raised by an output callback
+        self.done = threading.Event()
+
+    def read(self, fd):
+        """Read the available data from fd.
+
+        Return True if data was read, None if no data is available, and False at the end of the stream."""
+        try:
+            data = os.read(fd, ProcessSupervisor.READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+        if len(data) == 0:
+            return False
+        i = self.fds[fd]
+        self.outputs[i].write(data)
+        if self.splitters:
+            self.splitters[i].feed(data)
+        return True
+
+    def kill(self):
+        """Kill the whole process group of the command."""
+        for kill in (os.killpg, os.kill):
+            try:
+                kill(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass  # Already gone
+
+    def finish(self):
+        try:
+            if self.splitters and self.error is None:
+                for splitter in self.splitters:
+                    splitter.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            for output in self.outputs:
+                output.close()
+            self.process.stdout.close()
+            self.process.stderr.close()
+            self.done.set()
+
+
+class ProcessSupervisor(object):
+    """Reads the output of all the commands run by exec_cmd, and enforces their timeouts, from a single thread
+    waiting on a single poller.
+
+    A command is complete as soon as its process exits: its pipes are then read one last time, without waiting
+    for their end (a child process may have inherited them, such as an SSH master connection).
+    Exits are found with waitpid(WNOHANG) on each wakeup: the pipes of a process usually end when it exits, and
+    the supervisor also wakes up every REAP_INTERVAL seconds while commands run.
+    On timeout, the whole process group of the command is killed. If an output callback raises, the command
+    is killed too, and run() raises the error.
+    """
+
+    READ_SIZE = 64 * 1024
+    # Reads performed on each pipe once the process exited
+    MAX_FINAL_READS = 16
+    # Seconds between two checks for exited processes, and once all the pipes of a process ended
+    REAP_INTERVAL = 0.5
+    REAP_INTERVAL_AFTER_EOF = 0.01
+
+    def __init__(self):
+        self._incoming = collections.deque()
+        self._killed = set()  # processes of failed jobs, to reap
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        _set_nonblocking(self._wakeup_read)
+        _set_nonblocking(self._wakeup_write)
+        self._poller = _Poller()
+        self._poller.register(self._wakeup_read)
+        self._jobs = set()
+        self._fds = {}  # fd -> job, only used from the supervisor thread
+        self._thread = threading.Thread(target=self._run, name="process-supervisor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, process, timeout, outputs, splitters=None):
+        """Supervise process until it exits (or is killed), and return its CommandJob.
+
+        outputs and splitters receive the standard output and error of the process (see exec_cmd); their
+        methods are called from the supervisor thread."""
+        job = CommandJob(process, _monotonic() + timeout, outputs, splitters)
+        for fd in job.fds:
+            _set_nonblocking(fd)
+        self._incoming.append(job)
+        self._wakeup()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:  # The pipe is full, the supervisor will wake up anyway
+                raise
+
+    def _run(self):
+        while True:
+            try:
+                self._loop_once()
+            except Exception:
+                logger.exception("Error in the process supervisor")
+
+    def _poll_timeout(self):
+        if len(self._jobs) == 0 and len(self._killed) == 0:
+            return None
+        timeout = self.REAP_INTERVAL
+        for job in self._jobs:
+            if len(job.open_fds) == 0:
+                timeout = self.REAP_INTERVAL_AFTER_EOF
+            if not job.timed_out:
+                timeout = min(timeout, job.deadline - _monotonic())
+        return max(0, timeout)
+
+    def _loop_once(self):
+        for fd in self._poller.poll(self._poll_timeout()):
+            if fd == self._wakeup_read:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                continue
+            job = self._fds.get(fd)
+            if job is None:
+                continue
+            try:
+                if job.read(fd) is False:
+                    self._forget(job, fd)
+            except Exception as e:
+                self._fail(job, e)
+        while len(self._incoming) > 0:
+            job = self._incoming.popleft()
+            self._jobs.add(job)
+            for fd in job.fds:
+                self._fds[fd] = job
+                self._poller.register(fd)
+        # Reap the exited processes
+        for job in list(self._jobs):
+            if job.process.poll() is not None:
+                self._complete(job)
+        for process in list(self._killed):
+            if process.poll() is not None:
+                self._killed.discard(process)
+        now = _monotonic()
+        for job in self._jobs:
+            if not job.timed_out and now >= job.deadline:
+                job.timed_out = True
+                job.kill()
+
+    def _forget(self, job, fd):
+        del self._fds[fd]
+        job.open_fds.discard(fd)
+        self._poller.unregister(fd)
+
+    def _fail(self, job, error):
+        logger.exception("Error when reading the output of the process {}, killing it".format(job.process.pid))
+        job.error = error
+        job.kill()
+        self._killed.add(job.process)
+        self._release(job)
+
+    def _complete(self, job):
+        for fd in list(job.open_fds):
+            try:
+                for _ in range(self.MAX_FINAL_READS):
+                    if not job.read(fd):
                         break
+            except Exception as e:
+                self._fail(job, e)
+                return
+            self._forget(job, fd)
+        self._release(job)
 
-        stdout = "".join(outputs[0])
-        stderr = "".join(outputs[1])
-        logger.debug("cmd:[%s] stdout:[%s] stderr:[%s]" % (cmd, stdout, stderr))
-        return (p.returncode, stdout, stderr)
-    except Exception as e:
-        logger.exception("error:[%s] cmd:[%s]" % (str(e), cmd))
-        return (1, "", str(e))
+    def _release(self, job):
+        for fd in list(job.open_fds):
+            self._forget(job, fd)
+        self._jobs.discard(job)
+        job.finish()
+
+
+_process_supervisor = None
+_process_supervisor_lock = threading.Lock()
+
+
+def process_supervisor():
+    """Return the ProcessSupervisor shared by all commands."""
+    global _process_supervisor
+    with _process_supervisor_lock:
+        if _process_supervisor is None:
+            _process_supervisor = ProcessSupervisor()
+        return _process_supervisor
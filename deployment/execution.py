@@ -1,7 +1,8 @@
 # Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import collections
 import enum
 from logging import getLogger, LoggerAdapter
-import functools
+import itertools
 import traceback
 import datetime
 import socket
@@ -10,17 +11,22 @@ import time
 import json
 import multiprocessing
 from multiprocessing.dummy import Pool
+from Queue import Queue, Empty
 import sys
+import threading
 
 from sqlalchemy import inspect
 
-from . import mail, authorization, gitutils, database, filelock, samodels as m
+from . import mail, authorization, gitutils, database, filelock, executils, topology, samodels as m
+from . import logbuffer
+from .logbuffer import LogEntryBuffer
 from .artifact import GitArtifact, NoArtifactDetected
 from .executils import run_cmd_by_ssh, exec_script, remote_check_file_exists, \
-    exec_script_remote, exec_cmd, Host
+    exec_script_remote, exec_cmd, ssh_transport, run_cmds_by_ssh, remote_script_cmd, Host
 from .notification import Notification
 from .samodels import Severity, DeploymentStatus, LogEntry
 
+from . import haproxyapi
 from .haproxyapi import haproxy
 
 logger = getLogger(__name__)
@@ -30,6 +36,16 @@ class DeploymentError(Exception):
     pass
 
 
+class OutputChunk(object):
+    """Output of a command still running, that a step can yield for live tailing.
+
+    Output chunks are not stored in the deployment log (see stream_output)."""
+
+    def __init__(self, prefix, data):
+        self.prefix = prefix
+        self.data = data
+
+
 class PrefixedLoggerAdapter(LoggerAdapter):
 
     def __init__(self, logger, prefix):
@@ -42,7 +58,8 @@ class PrefixedLoggerAdapter(LoggerAdapter):
 
 class GeneralConfig(object):
 
-    def __init__(self, base_repos_path, haproxy_user, haproxy_password, notify_mails, mail_sender):
+    def __init__(self, base_repos_path, haproxy_user, haproxy_password, notify_mails, mail_sender,
+                 haproxy_drain_sessions=1, haproxy_drain_timeout=60, haproxy_up_timeout=30):
         """
         Args:
             base_repos_path (str): path to the deployer working directory, ie the folder that will contains the cloned repositories
@@ -50,11 +67,17 @@ class GeneralConfig(object):
             haproxy_password (str): password for the HAproxy user
             notify_mails (list of str): always put these email adresses in CC of mails sent for this deployment
             mail_sender (str): field 'From:' in emails sent by the deployer
+            haproxy_drain_sessions (int): disabled servers are considered drained below this number of current sessions
+            haproxy_drain_timeout (float): how long to wait (in seconds) for disabled servers to be drained before updating them anyway
+            haproxy_up_timeout (float): how long to wait (in seconds) for enabled servers to be UP before failing the deployment
         """
         self.base_repos_path = base_repos_path
         self.haproxy_auth = (haproxy_user, haproxy_password)
         self.notify_mails = notify_mails
         self.mail_sender = mail_sender
+        self.haproxy_drain_sessions = haproxy_drain_sessions
+        self.haproxy_drain_timeout = haproxy_drain_timeout
+        self.haproxy_up_timeout = haproxy_up_timeout
 
 
 # TODO: make the whole thing simpler
@@ -67,6 +90,7 @@ def run_step(deployment, step, *args, **kwargs):
             * first, a string (type str) describing the step (such as "cloning the repo")
             * then, zero or more LogEntry objects, that will be registered in the deployment log.
               Yielding a log entry with an ERROR severity will mark the step as failed (unless _abort_on_error is True).
+              OutputChunk objects may also be yielded, they are only forwarded to the notifier.
             * the last yielded value (which may be of any type) will be the result of the step (and returned by run_step).
         args, kwargs: arguments to pass to the step function
         _abort_on_error: if False, yielding an error (LogEntry with severity ERROR) will not abort the deployment. If an exception is raised, the step is still marked as failed regardless of this parameter.
@@ -108,12 +132,12 @@ def run_step(deployment, step, *args, **kwargs):
             message="Error when initializing a step: {}".format(str(e)),
             severity=Severity.ERROR.format()
         )
-        deployment.view.log_entries.append(entry)
-        session.commit()
+        deployment.add_log_entry(entry, session)
+        deployment.flush_log_entries(wait=True)
         raise
 
-    deployment.view.log_entries.append(LogEntry(message='Step: {}'.format(description)))
-    session.commit()
+    deployment.add_log_entry(LogEntry(message='Step: {}'.format(description)), session)
+    deployment.flush_log_entries()
     deployment.notifier.dispatch(Notification.deployment_step_start(deployment.view, description))
 
     # Collect log entries
@@ -124,10 +148,11 @@ def run_step(deployment, step, *args, **kwargs):
             while True:
                 out = it.next()
                 if isinstance(out, LogEntry):
-                    deployment.view.log_entries.append(out)
+                    deployment.add_log_entry(out, session)
                     if out.severity == Severity.ERROR.format():
                         errored = True
-                    session.commit()
+                elif isinstance(out, OutputChunk):
+                    deployment.notifier.dispatch(Notification.deployment_output(deployment.view, out.prefix, out.data))
         except StopIteration:
             pass
         return out
@@ -138,10 +163,11 @@ def run_step(deployment, step, *args, **kwargs):
             message="Error when running step '{}': {}".format(description, str(e)),
             severity=Severity.ERROR.format()
         )
-        deployment.view.log_entries.append(e)
-        session.commit()
+        deployment.add_log_entry(e, session)
         raise
     finally:
+        # Make sure the log of a failed step is complete before the deployment is aborted
+        deployment.flush_log_entries(wait=errored)
         deployment.notifier.dispatch(
             Notification.deployment_step_end(deployment.view, description, errored)
         )
@@ -174,8 +200,22 @@ class Deployment(object):
         self.log = PrefixedLoggerAdapter(logger, "[deploy {}]".format(deploy_id))
         self.artifact = None
         self.view = None
+        self.log_buffer = None
         self.step_results = []
 
+    def add_log_entry(self, entry, session):
+        """Register the provided LogEntry in the deployment log."""
+        if self.log_buffer is None:
+            self.view.log_entries.append(entry)
+            session.commit()
+            logbuffer.watcher.notify()
+        else:
+            self.log_buffer.add(entry)
+
+    def flush_log_entries(self, wait=False):
+        if self.log_buffer is not None:
+            self.log_buffer.flush(wait=wait)
+
     def write_entry(self, entry):
         """Log the provided LogEntry, according to its severity"""
         if entry.severity == Severity.INFO:
@@ -209,7 +249,7 @@ class Deployment(object):
 
     def _get_artifact(self, local_repo_path, repo, mail_sender, mail_test_report_to):
         environment = self.view.environment
-        run_step(self, update_repo, local_repo_path, self.view.commit, repo)
+        run_step(self, update_repo, local_repo_path, self.view.commit, repo, environment.repository.clone_policy())
         self.notifier.dispatch(Notification.commits_fetched(
             environment_id=environment.id,
             local_repo_path=local_repo_path,
@@ -237,56 +277,67 @@ class Deployment(object):
                      self.view.branch, self.view.commit, dummy_host, mail_sender, mail_test_report_to,
                      _abort_on_error=environment.fail_deploy_on_failed_tests)
 
-    def _copy_to_remotes(self, cluster, mail_sender, mail_test_report_to):
+    def _copy_to_remotes(self, clusters, mail_sender, mail_test_report_to):
         environment = self.view.environment
-        hosts = [Host.from_server(s, environment.remote_user) for s in cluster.activated_servers]
+        # Interleave the servers of the clusters, so that they are all updated at the same pace
+        servers = []
+        for batch in itertools.izip_longest(*[cluster.activated_servers for cluster in clusters]):
+            servers.extend(s for s in batch if s is not None and s not in servers)
+        hosts = [Host.from_server(s, environment.remote_user) for s in servers]
         destination_path = environment.release_path(self.view.branch, self.view.commit)
+        max_parallel = sum(cluster.rollout_parallelism or self.MAX_PARALLEL_SYNC for cluster in clusters)
+
+        def on_release(server, release_date):
+            self.notifier.dispatch(Notification.released_on_server(self.view, server, release_date, self.view.branch, self.view.commit))
+
+        # Errors are handled by the step itself (failed remote tests may not be fatal)
         run_step(
             self,
-            parallel_sync,
-            destination_path, environment.sync_options, self.view.branch, self.view.commit, self.artifact.local_path,
-            hosts,
-            self.MAX_PARALLEL_SYNC
+            parallel_rollout,
+            environment, destination_path, self.view.branch, self.view.commit, self.artifact.local_path,
+            zip(hosts, servers), max_parallel, on_release, mail_sender, mail_test_report_to,
+            _abort_on_error=False
         )
 
-        for host, server in zip(hosts, cluster.activated_servers):
-            run_step(self, release, host, environment.repository.deploy_method, environment.remote_repo_path(), environment.production_folder(), destination_path)
-            self.notifier.dispatch(Notification.released_on_server(self.view, server, datetime.datetime.utcnow(), self.view.branch, self.view.commit))
-            run_step(self, run_and_delete_deploy, host, environment.target_path, environment.name, self.view.commit)
-            run_step(self, run_remote_tests, environment, self.view.branch, self.view.commit, host, mail_sender, mail_test_report_to, _abort_on_error=environment.fail_deploy_on_failed_tests)
+    def _cluster_orchestration(self, target_clusters, haproxy_auth, batch_size=1):
+        """Yield the clusters to update, by batches of batch_size clusters (lists of clusters).
 
-    def _cluster_orchestration(self, target_clusters, haproxy_auth):
-        # Deploy the code cluster by cluster
+        Each batch is disabled in HAProxy before being yielded, and enabled again once it is updated.
+        Once the first batch is updated and up, all the clusters still running the old version are disabled,
+        so that only one version of the code is served.
+        """
         old_version_clusters = list(target_clusters)
         new_version_clusters = []
+        # Clusters are updated from the last one
+        remaining = list(reversed(old_version_clusters))
+        batches = [remaining[i:i + batch_size] for i in range(0, len(remaining), batch_size)]
 
         run_step(self, ensure_clusters_up, old_version_clusters, haproxy_auth)
-        while len(old_version_clusters) > 0:
-            cluster = old_version_clusters.pop()
-            if len(new_version_clusters) == 0:
-                pass   # Nothing to do
-            elif len(new_version_clusters) == 1:
-                # One cluster has already been updated, so deactivate all the old ones
-                time.sleep(1)  # Give some time to the cluster to activate
+        for batch in batches:
+            for cluster in batch:
+                old_version_clusters.remove(cluster)
+            if len(new_version_clusters) > 0:
                 run_step(self, ensure_clusters_up, new_version_clusters, haproxy_auth)
-                if len(old_version_clusters) != 0:
+                if batch is batches[1] and len(old_version_clusters) != 0:
+                    # The first batch has been updated, so deactivate all the old clusters
                     run_step(self, disable_clusters, old_version_clusters, haproxy_auth)
-            else:
-                # More than one cluster has already been updated
-                run_step(self, ensure_clusters_up, new_version_clusters, haproxy_auth)
-            # In any case, deactivate the cluster we are updating
-            run_step(self, disable_clusters, [cluster], haproxy_auth)
-            yield cluster
-            # Activate the updated cluster
-            new_version_clusters.append(cluster)
-            run_step(self, enable_clusters, [cluster], haproxy_auth)
+            # In any case, deactivate the clusters we are updating, and let them finish their current sessions
+            run_step(self, disable_clusters, batch, haproxy_auth)
+            run_step(self, wait_clusters_drained, batch, haproxy_auth,
+                     self.general_config.haproxy_drain_sessions, self.general_config.haproxy_drain_timeout)
+            yield batch
+            # Activate the updated clusters
+            new_version_clusters.extend(batch)
+            run_step(self, enable_clusters, batch, haproxy_auth)
+            run_step(self, wait_clusters_up, batch, haproxy_auth, self.general_config.haproxy_up_timeout)
 
     def execute(self):
         with database.session_scope() as session:
             try:
-                self.view = session.query(m.DeploymentView).get(self.deploy_id)
+                self.view = topology.load_deployment(session, self.deploy_id)
                 if self.view is None:
                     raise AssertionError('No configuration found for deploy ID {}'.format(self.deploy_id))
+                self.log_buffer = LogEntryBuffer(self.view)
 
                 self._check_configuration(session)
                 self._update_status(DeploymentStatus.PRE_DEPLOY, session)
@@ -297,13 +348,16 @@ class Deployment(object):
                 mail_sender = self.general_config.mail_sender
 
                 # Ensure the repo exist on disk
-                run_step(self, clone_repo, local_repo_path, environment.repository.name, environment.repository.git_server)
+                run_step(self, clone_repo, local_repo_path, environment.repository.name, environment.repository.git_server,
+                         environment.repository.clone_policy())
 
                 with gitutils.lock_repository_write(local_repo_path) as repo:
                     self._get_artifact(local_repo_path, repo, mail_sender, mail_test_report_to)
 
-                    for cluster in self._cluster_orchestration(self.view.target_clusters, self.general_config.haproxy_auth):
-                        self._copy_to_remotes(cluster, mail_sender, mail_test_report_to)
+                    target_clusters = self.view.target_clusters
+                    batch_size = environment.rollout_batch_size(len(target_clusters))
+                    for clusters in self._cluster_orchestration(target_clusters, self.general_config.haproxy_auth, batch_size):
+                        self._copy_to_remotes(clusters, mail_sender, mail_test_report_to)
 
                 self._update_status(DeploymentStatus.POST_DEPLOY, session)
                 self.log.info("END deploy")
@@ -320,6 +374,8 @@ class Deployment(object):
             finally:
                 if self.artifact is not None:
                     self.artifact.cleanup()
+                if self.log_buffer is not None:
+                    self.log_buffer.close()
                 self.notifier.dispatch(Notification.deployment_end(self.view))
                 session.commit()
 
@@ -332,7 +388,11 @@ def capture(prefix, func, *args, **kwargs):
 
     Also works with function returning only a string S, in which case S is considered standard output.
     """
-    out = func(*args, **kwargs)
+    return capture_output(prefix, func(*args, **kwargs))
+
+
+def capture_output(prefix, out):
+    """Same as capture, for an already available (return_code, stdout, stderr) tuple (or string)."""
     if out is None:
         return []
     entries = []
@@ -352,6 +412,78 @@ def capture(prefix, func, *args, **kwargs):
     return entries
 
 
+# Minimum delay (in seconds) between two live output chunks, and between two log entries, of a running command
+STREAM_CHUNK_INTERVAL = 0.5
+STREAM_ENTRY_INTERVAL = 5
+
+
+def stream_output(prefix, func, *args, **kwargs):
+    """Run func(*args, on_output=callback, **kwargs) in a separate thread (see executils.exec_cmd for the callback),
+    and yield its standard output as it arrives.
+
+    Yields OutputChunk objects (at most one every STREAM_CHUNK_INTERVAL seconds, for both standard output and error),
+    LogEntry objects with the standard output (at most one every STREAM_ENTRY_INTERVAL seconds, up to
+    executils.MAX_OUTPUT_SIZE bytes), and finally the tuple (func result, logged) where logged is False if
+    no output, or only part of it, was logged.
+    """
+    chunks = Queue()
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = func(*args, on_output=lambda stream, data: chunks.put((stream, data)), **kwargs)
+        except Exception as e:
+            outcome['error'] = e
+        finally:
+            chunks.put(None)
+
+    thread = threading.Thread(target=run, name="stream-{}".format(prefix))
+    thread.daemon = True
+    thread.start()
+
+    live, stdout = [], []
+    logged_size = 0
+    last_chunk = last_entry = time.time()
+    finished = False
+    while not finished:
+        try:
+            item = chunks.get(timeout=STREAM_CHUNK_INTERVAL)
+        except Empty:
+            item = ()
+        if item is None:
+            finished = True
+        elif item:
+            stream, data = item
+            live.append(data)
+            if stream == 'stdout' and logged_size < executils.MAX_OUTPUT_SIZE:
+                stdout.append(data)
+                logged_size += len(data)
+        now = time.time()
+        if len(live) > 0 and (finished or now - last_chunk >= STREAM_CHUNK_INTERVAL):
+            yield OutputChunk(prefix, "".join(live))
+            live, last_chunk = [], now
+        if len(stdout) > 0 and (finished or now - last_entry >= STREAM_ENTRY_INTERVAL):
+            yield LogEntry("{}: {}".format(prefix, "".join(stdout)))
+            stdout, last_entry = [], now
+    thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    yield outcome['result'], 0 < logged_size < executils.MAX_OUTPUT_SIZE
+
+
+def capture_stream(prefix, func, *args, **kwargs):
+    """Same as capture, but the standard output of func is yielded as it arrives (see stream_output).
+
+    func must accept an on_output keyword argument (see executils.exec_cmd)."""
+    for out in stream_output(prefix, func, *args, **kwargs):
+        if isinstance(out, (LogEntry, OutputChunk)):
+            yield out
+        else:
+            (code, stdout, stderr), logged = out
+    for e in capture_output(prefix, (code, None if logged else stdout, stderr)):
+        yield e
+
+
 ##################
 # Steps definition
 ##################
@@ -451,16 +583,16 @@ def check_deploy_allowed(account, environment_id, environment_name):
     yield False
 
 
-def clone_repo(working_directory, repo_name, git_server):
+def clone_repo(working_directory, repo_name, git_server, clone_policy=None):
     yield "Clone repository {}".format(repo_name)
     if os.path.exists(working_directory):
         yield LogEntry("Repository already cloned, skipping.")
         return
     with gitutils.lock_repository_clone(gitutils.build_repo_url(repo_name, git_server), working_directory) as repo:
-        repo.clone()
+        repo.clone(policy=clone_policy)
 
 
-def update_repo(local_repo_path, commit, write_repo_lock):
+def update_repo(local_repo_path, commit, write_repo_lock, clone_policy=None):
     yield "Switch to commit {}".format(commit)
     if not os.path.exists(local_repo_path):
         yield LogEntry('Git repository not found at {}'.format(local_repo_path), Severity.ERROR)
@@ -468,7 +600,13 @@ def update_repo(local_repo_path, commit, write_repo_lock):
     try:
         with gitutils.lock_repository_fetch(local_repo_path) as repo:
             yield LogEntry("Update objects (git fetch)")
-            repo.fetch()
+            repo.fetch(clone_policy)
+            if not repo.has_commit(commit):
+                # Shallow or single branch clone
+                yield LogEntry("Commit {} not found locally, fetching more history".format(commit))
+                if not repo.ensure_commit(commit):
+                    yield LogEntry("Commit {} not found in the repository".format(commit), Severity.ERROR)
+                    return
     except filelock.AlreadyLocked:
         pass
     yield LogEntry("Reset local copy to commit {}".format(commit))
@@ -497,48 +635,146 @@ def get_artifact(artifact):
 
 def run_and_delete_predeploy(working_directory, environment_name, commit):
     yield "Run 'predeploy.sh'"
-    for e in capture("predeploy.sh", exec_script, working_directory, 'predeploy.sh', [environment_name, commit]): yield e
+    for e in capture_stream("predeploy.sh", exec_script, working_directory, 'predeploy.sh', [environment_name, commit]): yield e
     yield LogEntry(working_directory)
     for e in capture('delete predeploy.sh', exec_cmd, cmd=['cd', working_directory, '&&', 'rm', '-f', 'predeploy.sh'], use_shell=True): yield e
 
 
-def parallel_sync(destination_path, sync_options, branch, commit, local_path, hosts, max_parallel_sync):
-    yield "Sync to hosts {}".format(', '.join(host.name for host in hosts))
+def _normalize_sync_args(destination_path, sync_options):
     if sync_options is None or len(sync_options) == 0:
         sync_options = '-az --delete'
     sync_options += ' --exclude=.git_release'
     destination_path = destination_path + '/' if not destination_path.endswith('/') else destination_path
-    partial = functools.partial(sync, destination_path, sync_options, branch, commit, local_path)
+    return destination_path, sync_options
+
+
+def parallel_rollout(environment, destination_path, branch, commit, local_path, hosts_servers, max_parallel,
+                     on_release, mail_sender, mail_report_to):
+    """Sync, release, run deploy.sh and run the remote tests on each host, as a pipeline.
+
+    Each host goes through all the stages as soon as its own sync is complete, with at most
+    max_parallel hosts being handled at the same time. As soon as a stage fails on a host,
+    no new stage is started on any host, and this step raises a DeploymentError once
+    the stages already in progress are complete.
+
+    The work is done in worker threads, but log entries are yielded and on_release(server, release_date)
+    is called from the thread running this step, so the caller can safely use its database session.
+    Releases are reported in order for a given host (after the release, before the remote tests are run).
+    """
+    yield "Roll out on hosts {}".format(', '.join(host.name for host, _ in hosts_servers))
+    destination_path, sync_options = _normalize_sync_args(destination_path, environment.sync_options)
+    # Worker threads must not trigger lazy loads, so read everything they need here
+    deploy_method = environment.repository.deploy_method
+    remote_repo_path = environment.remote_repo_path()
+    production_folder = environment.production_folder()
+    target_path = environment.target_path
+    environment_name = environment.name
+    repository_name = environment.repository.name
+    fail_on_tests = environment.fail_deploy_on_failed_tests
+
+    events = Queue()
+    abort = threading.Event()
+
+    def forward(host, step, *args):
+        """Run a step in the current thread, forward its log entries.
+
+        Return a (errored, result) tuple: errored is True if the step logged an error,
+        result is the last value yielded by the step that is not a LogEntry (if any).
+        """
+        it = step(*args)
+        events.put((host, 'entry', LogEntry("On {}: {}".format(host.name, it.next()))))
+        errored = False
+        result = None
+        for out in it:
+            if isinstance(out, LogEntry):
+                errored = errored or out.severity == Severity.ERROR.format()
+                events.put((host, 'entry', out))
+            elif isinstance(out, OutputChunk):
+                events.put((host, 'entry', out))
+            else:
+                result = out
+        return errored, result
+
+    def rollout(host_server):
+        host, server = host_server
+        failed = False
+        try:
+            if abort.is_set():
+                events.put((host, 'entry', LogEntry("Skipping {} (rollout aborted)".format(host.name), Severity.WARN)))
+                return
+            entries = sync(destination_path, sync_options, branch, commit, local_path, host)
+            for entry in entries:
+                events.put((host, 'entry', entry))
+            failed = any(e.severity == Severity.ERROR.format() for e in entries)
+            if failed or abort.is_set():
+                return
+            failed, released = forward(host, release_and_deploy, host, deploy_method, remote_repo_path, production_folder,
+                                       destination_path, target_path, environment_name, commit)
+            if released:
+                events.put((host, 'released', server))
+            if failed or abort.is_set():
+                return
+            tests_failed, _ = forward(host, run_remote_tests, repository_name, environment_name, target_path, branch, commit,
+                                      host, mail_sender, mail_report_to)
+            failed = tests_failed and fail_on_tests
+        except Exception as e:
+            failed = True
+            logger.exception("Unexpected error during the rollout on {}".format(host.name))
+            events.put((host, 'entry', LogEntry("Error during the rollout on {}: {}".format(host.name, e), Severity.ERROR)))
+        finally:
+            if failed:
+                abort.set()
+            events.put((host, 'done', failed))
+
+    failed_hosts = []
+    pool = Pool(max(1, min(len(hosts_servers), max_parallel)))
     try:
-        pool = Pool(min(len(hosts), max_parallel_sync))
-        it = pool.imap_unordered(partial, hosts)
-        for entry_group in it:  # Block until the copy is complete
-            for entry in entry_group:
-                yield entry
+        pool.map_async(rollout, hosts_servers, chunksize=1)
+        remaining = len(hosts_servers)
+        while remaining > 0:
+            host, kind, value = events.get()
+            if kind == 'entry':
+                yield value
+            elif kind == 'released':
+                on_release(value, datetime.datetime.utcnow())
+            elif kind == 'done':
+                remaining -= 1
+                if value:
+                    failed_hosts.append(host.name)
     finally:
+        # If we are interrupted, do not start anything new
+        abort.set()
         pool.close()
-    yield LogEntry("Copy on all servers complete.")
+
+    if len(failed_hosts) > 0:
+        raise DeploymentError("Rollout failed on {}".format(", ".join(failed_hosts)))
+    yield LogEntry("Rollout on all servers complete.")
 
 
 # sync options is a str for now
 def sync(destination_path, sync_options, branch, commit, local_path, host):
     log_entries = []
     try:
-        for e in capture('mkdir', run_cmd_by_ssh, host, ['mkdir', '-p', destination_path]):
-            log_entries.append(e)
-
-        release_status = get_release_status(host, destination_path)
-        log_entries.append(LogEntry("On {}, previous release: {}".format(host.name, release_status.format_commit())))
-
-        # Copy release file (to indicate a deployment is in progress)
+        # Create the destination, read the previous release and write the release file
+        # (to indicate a deployment is in progress) in a single SSH session
         now = datetime.datetime.utcnow()
         release_file_contents = gitutils.Release(branch, commit, now, destination_path, in_progress=True).to_string()
-        for e in capture('copy release file', run_cmd_by_ssh, host, ['echo', "'{}'".format(release_file_contents), '>', os.path.join(destination_path, '.git_release')]):
-            log_entries.append(e)
+        preamble = [
+            ('mkdir', ['mkdir', '-p', destination_path]),
+            (None, _get_git_release_cmd(destination_path)),
+            ('copy release file', ['echo', "'{}'".format(release_file_contents), '>', os.path.join(destination_path, '.git_release')]),
+        ]
+        results = run_cmds_by_ssh(host, [cmd for _, cmd in preamble])
+        for (prefix, _), out in zip(preamble, results):
+            if prefix is None:
+                release_status = release_status_from_output(out)
+                log_entries.append(LogEntry("On {}, previous release: {}".format(host.name, release_status.format_commit())))
+            else:
+                log_entries.extend(capture_output(prefix, out))
 
         log_entries.append(LogEntry("Copying to {}@{}:{}".format(host.username, host.name, destination_path)))
         destination = "{}@{}:{}".format(host.username, host.name, destination_path)
-        cmd = ['rsync', '-e', 'ssh -p {}'.format(host.port), '--exclude=.git'] + sync_options.split(" ") + [local_path, destination]
+        cmd = ['rsync', '-e', ssh_transport(host), '--exclude=.git'] + sync_options.split(" ") + [local_path, destination]
         for e in capture(' '.join(cmd), exec_cmd, cmd):
             log_entries.append(e)
 
@@ -548,30 +784,41 @@ def sync(destination_path, sync_options, branch, commit, local_path, host):
         for e in capture('copy release file', run_cmd_by_ssh, host, ['echo', "'{}'".format(release_file_contents), '>', os.path.join(destination_path, '.git_release')]):
             log_entries.append(e)
     except Exception as e:
-        log_entries.append("Error when syncing to server {}".format(host.name), severity=Severity.ERROR)
-        log_entries.append(str(e))
+        log_entries.append(LogEntry("Error when syncing to server {}: {}".format(host.name, e), severity=Severity.ERROR))
     return log_entries
 
 
-def release(host, method, remote_repo_path, production_folder, release_path):
-    yield "Release on {}".format(host.name)
-    if method == 'inplace':
-        pass  # Nothing to do, remore_repo_path + production_folder == release_path in this case
-    elif method == 'symlink':
-        # Atomic link change (thanks to rename with 'mv -T')
-        ln_cmd = ['cd', remote_repo_path, '&&', 'ln', '-s', release_path, 'tmp-link', '&&', 'mv', '-T', 'tmp-link', os.path.join(remote_repo_path, production_folder)]
-        for e in capture('symlink', run_cmd_by_ssh, host, ln_cmd): yield e
-    else:
+def release_and_deploy(host, method, remote_repo_path, production_folder, release_path,
+                       remote_working_directory, environment_name, commit):
+    """Release (switch the symlink for the symlink method, nothing for the inplace method), run deploy.sh
+    and delete it, in a single SSH session.
+
+    The last value yielded is True if the release was successful."""
+    yield "Release and run 'deploy.sh' on {}".format(host.name)
+    batch = []
+    if method == 'symlink':
+        batch.append(('symlink', _symlink_cmd(remote_repo_path, production_folder, release_path)))
+    elif method != 'inplace':
         raise ValueError('Unsupported release method: {}'.format(method))
+    batch.append(("Run 'deploy.sh'", remote_script_cmd(remote_working_directory, "deploy.sh", [environment_name, host.name, commit])))
+    # Do not run deploy.sh if the release failed, but always delete it
+    rm_cmd = ['cd', remote_working_directory, '&&', 'rm', '-f', 'deploy.sh']
+    for out in stream_output("On {}".format(host.name), run_cmds_by_ssh, host, [cmd for _, cmd in batch],
+                             stop_on_error=(method == 'symlink'), cleanup_cmd=rm_cmd):
+        if isinstance(out, (LogEntry, OutputChunk)):
+            yield out
+        else:
+            results, logged = out
+    for (prefix, _), (code, stdout, stderr) in zip(batch, results):
+        for e in capture_output(prefix, (code, None if logged else stdout, stderr)):
+            yield e
+    released = method == 'inplace' or (len(results) > 0 and results[0][0] == 0)
+    yield released
 
 
-def run_and_delete_deploy(host, remote_working_directory, environment_name, commit):
-    yield "Run 'deploy.sh' on {}".format(host.name)
-    out = capture("Run 'deploy.sh'", exec_script_remote, host, remote_working_directory, "deploy.sh", [environment_name, host.name, commit])
-    for e in out:
-        yield e
-    rm_cmd = ['cd', remote_working_directory, '&&', 'rm', '-f', 'deploy.sh']
-    for e in capture("delete 'deploy.sh'", run_cmd_by_ssh, host, rm_cmd): yield e
+def _symlink_cmd(remote_repo_path, production_folder, release_path):
+    # Atomic link change (thanks to rename with 'mv -T')
+    return ['cd', remote_repo_path, '&&', 'ln', '-s', release_path, 'tmp-link', '&&', 'mv', '-T', 'tmp-link', os.path.join(remote_repo_path, production_folder)]
 
 
 def get_haproxy_host(cluster):
@@ -618,11 +865,41 @@ def ensure_clusters_up(clusters, haproxy_auth):
         host = get_haproxy_host(cluster)
         if host is None:
             continue
-        hosts = host.split(",")
-        for host in hosts:
-            keys = get_servers_keys(cluster)
-            # Will raise an exception if the cluster is not UP (I know, I know... TODO refactor)
-            haproxy_action(host, keys, haproxy_auth, 'UP', HAProxyAction.ENABLE)
+        keys = get_servers_keys(cluster)
+        # Will raise an exception if the cluster is not UP (I know, I know... TODO refactor)
+        on_haproxy_hosts(host, lambda h: haproxy_action(h, keys, haproxy_auth, 'UP', HAProxyAction.ENABLE))
+
+
+def wait_clusters_up(clusters, haproxy_auth, timeout=30, interval=haproxyapi.WAIT_INTERVAL):
+    yield "Wait for all servers in clusters {} to be up".format(", ".join(cluster.name for cluster in clusters))
+    for cluster in clusters:
+        haproxy_hosts = get_haproxy_host(cluster)
+        if haproxy_hosts is None:
+            continue
+        keys = get_servers_keys(cluster)
+        try:
+            on_haproxy_hosts(haproxy_hosts, lambda host: haproxy(host, haproxy_auth).wait_up(keys, timeout, interval=interval))
+        except haproxyapi.HAProxyTimeout as e:
+            raise UnexpectedHAproxyServerStatus("Servers not up: {}".format(e))
+        yield LogEntry("All servers of cluster {} are up".format(cluster.name))
+
+
+def wait_clusters_drained(clusters, haproxy_auth, max_sessions=1, timeout=60, interval=haproxyapi.WAIT_INTERVAL):
+    """Wait for the (disabled) servers of the clusters to have less than max_sessions current sessions.
+
+    Servers still busy after timeout seconds are only reported with a warning: their remaining sessions may be cut by the update.
+    """
+    yield "Wait for the servers in clusters {} to finish their sessions".format(", ".join(cluster.name for cluster in clusters))
+    for cluster in clusters:
+        haproxy_hosts = get_haproxy_host(cluster)
+        if haproxy_hosts is None:
+            continue
+        keys = get_servers_keys(cluster)
+        try:
+            on_haproxy_hosts(haproxy_hosts, lambda host: haproxy(host, haproxy_auth).wait_drained(keys, max_sessions, timeout, interval=interval))
+            yield LogEntry("All servers of cluster {} are drained".format(cluster.name))
+        except haproxyapi.HAProxyTimeout as e:
+            yield LogEntry("Servers of cluster {} not drained, updating them anyway: {}".format(cluster.name, e), severity=Severity.WARN)
 
 
 def cluster_action(clusters, haproxy_auth, action):
@@ -638,15 +915,28 @@ def cluster_action(clusters, haproxy_auth, action):
             continue
         servers_description = ", ".join("{} ({})".format(server.server_def.name, server.haproxy_key) for server in cluster.servers)
         yield LogEntry('{} cluster {} (servers {})'.format(verb, cluster.name, servers_description))
-        hosts = haproxy_host.split(",")
-        for haproxy_host in hosts:
-            server_keys = get_servers_keys(cluster)
-            haproxy_action(haproxy_host, server_keys, haproxy_auth, '', action)
+        server_keys = get_servers_keys(cluster)
+        on_haproxy_hosts(haproxy_host, lambda host: haproxy_action(host, server_keys, haproxy_auth, '', action))
+
+
+def on_haproxy_hosts(haproxy_hosts, func):
+    """Call func(host) concurrently for each host of a comma separated list of HAProxy hosts.
+
+    Returns the list of results, or raises the first exception raised by func."""
+    hosts = haproxy_hosts.split(",")
+    if len(hosts) == 1:
+        return [func(hosts[0])]
+    pool = Pool(len(hosts))
+    try:
+        return pool.map(func, hosts, chunksize=1)
+    finally:
+        pool.close()
 
 
 def run_local_tests(environment, local_repo_path, branch, commit, host, mail_sender, mail_report_to):
     yield "Run local tests (execute tests/run_local_tests.sh)"
-    report = run_test(environment, branch, commit, host, mail_sender, local=True, local_repo_path=local_repo_path, mail_report_to=mail_report_to)
+    report = run_test(environment.repository.name, environment.name, environment.target_path, branch, commit, host, mail_sender,
+                      local=True, local_repo_path=local_repo_path, mail_report_to=mail_report_to)
 
     if report is None:
         yield LogEntry("No script 'tests/run_local_tests.sh', skipping.")
@@ -658,9 +948,10 @@ def run_local_tests(environment, local_repo_path, branch, commit, host, mail_sen
         yield LogEntry("Tests failed.", severity=Severity.ERROR)
 
 
-def run_remote_tests(environment, branch, commit, host, mail_sender, mail_report_to):
+def run_remote_tests(repository_name, environment_name, target_path, branch, commit, host, mail_sender, mail_report_to):
     yield "Run remote tests (execute tests/run_tests.sh on the remote server)"
-    report = run_test(environment, branch, commit, host, mail_sender, local=False, mail_report_to=mail_report_to)
+    report = run_test(repository_name, environment_name, target_path, branch, commit, host, mail_sender, local=False,
+                      mail_report_to=mail_report_to)
 
     if report is None:
         yield LogEntry("No script 'tests/run_tests.sh', skipping.")
@@ -717,10 +1008,12 @@ def check_servers_availability(session, current_deploy_id, servers, environment_
 #########
 # Helpers
 #########
+def _get_git_release_cmd(target_path):
+    return ['cat', os.path.join(target_path, ".git_release")]
+
+
 def _get_git_release(host, target_path, timeout=4):
-    remote_path = os.path.join(target_path, ".git_release")
-    cmd = ['cat', remote_path]
-    return run_cmd_by_ssh(host, cmd, timeout)
+    return run_cmd_by_ssh(host, _get_git_release_cmd(target_path), timeout)
 
 
 class ReleaseStatus(object):
@@ -777,7 +1070,12 @@ class ReleaseStatus(object):
 
 
 def get_release_status(host, target_path, timeout=4):
-    (status, stdout, stderr) = _get_git_release(host, target_path, timeout)
+    return release_status_from_output(_get_git_release(host, target_path, timeout))
+
+
+def release_status_from_output(out):
+    """Build a ReleaseStatus from the (status, stdout, stderr) output of 'cat .git_release'."""
+    (status, stdout, stderr) = out
     if status != 0:
         return ReleaseStatus.error(stdout + "\n" + stderr, status)
     try:
@@ -809,37 +1107,37 @@ def concurrent_get_release_status(targets, timeout=4):
         pool.close()
 
 
-def run_test(environment, branch, commit, host, mail_sender, local, local_repo_path=None, mail_report_to=None):
-    """Run the local test script if local is True, else the remote test script.
+def run_test(repository_name, environment_name, target_path, branch, commit, host, mail_sender, local, local_repo_path=None,
+             mail_report_to=None):
+    """Run the local test script if local is True, else the remote test script (in target_path on the host).
     For a local test script, hostname may be any server on which the project will be deployed (for compatibility reasons).
 
-    Also end a mail if tests failed.
+    Also end a mail if tests failed. Only takes plain values, so that it can run in a worker thread.
 
     Return:
         None if no test is defined, else a TestReport object
     """
-    repository_name = environment.repository.name
     # Check whether tests are defined
     if local:
         if local_repo_path is None:
             raise ValueError("When running local tests, you must provide the local_repo_path ")
         tests_defined = os.path.exists(os.path.join(local_repo_path, "tests/run_local_tests.sh"))
-        cmd = (exec_script, local_repo_path, "tests/run_local_tests.sh", [environment.name, host.name, branch, commit])
+        cmd = (exec_script, local_repo_path, "tests/run_local_tests.sh", [environment_name, host.name, branch, commit])
     else:
-        tests_defined = remote_check_file_exists(os.path.join(environment.target_path, "tests/run_tests.sh"), host)
-        cmd = (exec_script_remote, host, environment.target_path, "tests/run_tests.sh", [environment.name, host.name, branch, commit])
+        tests_defined = remote_check_file_exists(os.path.join(target_path, "tests/run_tests.sh"), host)
+        cmd = (exec_script_remote, host, target_path, "tests/run_tests.sh", [environment_name, host.name, branch, commit])
 
     if not tests_defined:
         return None
 
     result = cmd[0](*(cmd[1:]))
     report = m.TestReport.from_command_output(
-        result, repository_name, environment.name, host.name, branch, commit)
+        result, repository_name, environment_name, host.name, branch, commit)
 
     if report.failed and mail_report_to is not None:
         mail.send_mail(mail_sender,
                        mail_report_to,
-                       "Tests failed for {} ({})".format(repository_name, environment.name),
+                       "Tests failed for {} ({})".format(repository_name, environment_name),
                        report.format()
                        )
 
@@ -859,36 +1157,63 @@ class HAProxyAction(enum.Enum):
     DISABLE = 2
 
 
+def _normalize_haproxy_keys(haproxy_keys):
+    """Accept [backend, server] pairs or 'BACKEND,SERVER' strings, return (backend, server) tuples."""
+    normalized = []
+    for key in haproxy_keys:
+        if isinstance(key, basestring):
+            key = key.split(',')
+        if len(key) != 2:
+            raise InvalidHAProxyKeyFormat('Invalid HAProxy key: {}'.format(key))
+        normalized.append(tuple(key))
+    return normalized
+
+
 # TODO: refactor that, it does two things (status check + change status), and sometimes only one of these
 # actions is desired
 def haproxy_action(haproxy_host, normalized_haproxy_keys, haproxy_auth, expected_status, changeto_status):
+    normalized_haproxy_keys = _normalize_haproxy_keys(normalized_haproxy_keys)
     # Setup connection to HAProxy
     haproxy_con = haproxy(haproxy_host, haproxy_auth)
 
     # TODO: store haproxy_key normalized in the database!
 
-    # Check status (all must have same status to do anything)
+    # Check status (all must have same status to do anything), using a single download of the stats
+    snapshot = haproxy_con.snapshot()
+    statuses = []
     for ha_backend, ha_server in normalized_haproxy_keys:
-        ha_status_raw = haproxy_con.status(ha_backend, ha_server)
-        if 'status' not in ha_status_raw:
+        ha_status_raw = snapshot.get(ha_backend, ha_server)
+        if ha_status_raw is None or 'status' not in ha_status_raw:
             raise UnexpectedHAproxyServerStatus("Server [%s] of backend [%s] not found in haproxy, status was:[%s]." % (ha_server, ha_backend, json.dumps(ha_status_raw)))
         ha_status = ha_status_raw['status']
         logger.info("HAProxy current status of [%s/%s]: [%s] expected:[%s]" % (ha_backend, ha_server, ha_status, expected_status))
         if expected_status not in ha_status:
             raise UnexpectedHAproxyServerStatus("Server [%s] of backend [%s] not UP in haproxy." % (ha_server, ha_backend))
+        statuses.append(ha_status)
 
-    # Disable servers in HAProxy
-    for ha_backend, ha_server in normalized_haproxy_keys:
-        ha_status = haproxy_con.status(ha_backend, ha_server)['status']
-        if changeto_status == HAProxyAction.DISABLE and ("UP" in ha_status):
+    # Change the status of the servers in HAProxy, with one request per backend
+    to_change = collections.OrderedDict()
+    for (ha_backend, ha_server), ha_status in zip(normalized_haproxy_keys, statuses):
+        if (changeto_status == HAProxyAction.DISABLE and ("UP" in ha_status)) or \
+                (changeto_status == HAProxyAction.ENABLE and ("MAINT" in ha_status)):
             logger.info("HAProxy change status of [%s/%s] from [%s] to [%s]" % (ha_backend, ha_server, ha_status, changeto_status))
-            ha_ret = haproxy_con.disable(ha_backend, ha_server)
-        elif changeto_status== HAProxyAction.ENABLE and ("MAINT" in ha_status):
-            logger.info("HAProxy change status of [%s/%s] from [%s] to [%s]" % (ha_backend, ha_server, ha_status, changeto_status))
-            ha_ret = haproxy_con.enable(ha_backend, ha_server)
+            to_change.setdefault(ha_backend, []).append(ha_server)
         else:
-            ha_ret = "OK"
             logger.info("HAProxy status already OK for [%s/%s] [%s] == [%s]" % (ha_backend, ha_server, ha_status, changeto_status))
+    if len(to_change) == 0:
+        return
 
+    action = "disable" if changeto_status == HAProxyAction.DISABLE else "enable"
+    for ha_backend, ha_servers in to_change.items():
+        ha_ret = haproxy_con.post_all(ha_backend, ha_servers, action)
         if ha_ret != "OK":
-            raise UnexpectedHAproxyServerStatus("Server [%s] of backend [%s] status could not be changed: [%s]." % (ha_server, ha_backend, ha_ret))
+            raise UnexpectedHAproxyServerStatus("Servers [%s] of backend [%s] status could not be changed: [%s]." % (", ".join(ha_servers), ha_backend, ha_ret))
+
+    # Check the result
+    snapshot = haproxy_con.snapshot(max_age=0)
+    for ha_backend, ha_servers in to_change.items():
+        for ha_server in ha_servers:
+            row = snapshot.get(ha_backend, ha_server)
+            ha_status = row.get('status', '') if row is not None else ''
+            if ("MAINT" in ha_status) != (changeto_status == HAProxyAction.DISABLE):
+                raise UnexpectedHAproxyServerStatus("Server [%s] of backend [%s] status could not be changed: status is [%s]." % (ha_server, ha_backend, ha_status))
@@ -0,0 +1,13 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import errno
+import os
+
+
+def mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
@@ -3,26 +3,28 @@ import contextlib
 import os
 import re
 import string
-import errno
 import datetime
+import threading
+from logging import getLogger
 
+from deployment import commitindex
 from deployment.filelock import FileLock
+from deployment.fsutils import mkdir_p
 
 import git
 
 
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
+logger = getLogger(__name__)
 
 
 LOCKS_FOLDER = '/tmp/deployerlocks'
 
+# Layouts of the local repositories (see configure_repository_layout)
+REPOSITORY_LAYOUTS = ('clone', 'worktree')
+# Folder (next to the local repositories) containing the shared bare repositories of the worktree layout
+MIRRORS_FOLDER = '.mirrors'
+_repository_layout = 'clone'
+
 
 def _path_to_filename(path):
     VALID_CHARS = "-_()%s%s" % (string.ascii_letters, string.digits)
@@ -40,6 +42,15 @@ def _path_to_filename(path):
 #   This lock is not mutually exclusive with a "fetch lock".
 #
 # When a clone is in progress, we need to acquire both locks, because we're not certain of the state of the directory.
+#
+# With the worktree layout, the objects and refs of a repository are shared by the worktrees of all its environments (see
+# storage_path). The fetch lock is then the lock of the shared repository, whichever worktree it is acquired for, and the
+# write lock stays per worktree (a deployment only modifies its own working directory and HEAD). Adding a worktree
+# requires the fetch lock of the shared repository and the write lock of the new worktree.
+#
+# git.Repo objects are borrowed from a pool (see RepoHandlePool) for the duration of each operation, so the locks above
+# still apply to the operations, not to the handles. A handle is never used by two threads at the same time.
+# Cloning into a path, or deleting it (with both locks held) discards its idle handles.
 
 @contextlib.contextmanager
 def acquire_repo_lock(lock_type, repo_path, block=True):
@@ -55,9 +66,133 @@ def acquire_repo_lock(lock_type, repo_path, block=True):
     with FileLock(filename, block):
         yield
 
+def configure_repository_layout(layout):
+    """Choose how new local repositories are created.
+
+    Args:
+        layout (str): 'clone' for one full clone per environment, 'worktree' for one bare repository per remote
+            repository (fetched once for all its environments) with a git worktree per environment.
+            Existing local repositories keep their layout.
+    """
+    global _repository_layout
+    if layout not in REPOSITORY_LAYOUTS:
+        raise ValueError("Unknown repository layout '{}', must be one of: {}".format(layout, ", ".join(REPOSITORY_LAYOUTS)))
+    _repository_layout = layout
+
+
+def mirror_path(local_path, remote_url):
+    """Path of the shared bare repository of remote_url, for a worktree created at local_path."""
+    base_path = os.path.dirname(os.path.abspath(local_path))
+    return os.path.join(base_path, MIRRORS_FOLDER, _path_to_filename(remote_url) + ".git")
+
+
+def storage_path(repo_path):
+    """Return the path of the repository holding the objects and refs of the local repository at repo_path:
+    its shared bare repository if it is a worktree, repo_path itself otherwise."""
+    dot_git = os.path.join(repo_path, '.git')
+    if os.path.isfile(dot_git):
+        with open(dot_git) as f:
+            contents = f.read().strip()
+        if contents.startswith('gitdir: '):
+            # <shared repository>/worktrees/<name>
+            return os.path.dirname(os.path.dirname(contents[len('gitdir: '):]))
+    return repo_path
+
+
+def prune_worktrees(shared_repo_path):
+    """Forget the worktrees of a shared repository whose folder was deleted, and return the number of remaining worktrees.
+
+    Must be called with the fetch lock of the shared repository.
+    """
+    repo = git.Repo(shared_repo_path)
+    try:
+        repo.git.worktree('prune')
+    finally:
+        repo.close()
+    worktrees_path = os.path.join(shared_repo_path, 'worktrees')
+    return len(os.listdir(worktrees_path)) if os.path.isdir(worktrees_path) else 0
+
+
+class ClonePolicy(object):
+    """How much of a remote repository is cloned and fetched.
+
+    A commit outside of what the policy fetched can still be obtained with _CanFetchLocalRepository.ensure_commit.
+
+    Args:
+        depth (int): number of commits of history to fetch from the tip of each branch, None for the whole history
+        filter (str): partial clone filter, such as 'blob:none' (file contents are then downloaded when first needed), or None
+        branches (list of str): the only branches to fetch, or None for all of them
+    """
+
+    FILTER_PATTERN = re.compile(r'^blob:(none|limit=\d+[kmg]?)$')
+    # Successive --deepen tried to find a missing commit, before fetching the whole history
+    DEEPEN_STEPS = (100, 1000)
+
+    def __init__(self, depth=None, filter=None, branches=None):
+        if depth is not None and depth < 1:
+            raise ValueError("The clone depth must be a positive number of commits")
+        if filter is not None and not self.FILTER_PATTERN.match(filter):
+            raise ValueError("Unsupported clone filter '{}' (expected 'blob:none' or 'blob:limit=<size>')".format(filter))
+        self.depth = depth
+        self.filter = filter
+        self.branches = sorted(branches) if branches is not None else None
+
+    def clone_kwargs(self):
+        """Options of git clone (as GitPython keyword arguments)."""
+        kwargs = {}
+        if self.depth is not None:
+            kwargs['depth'] = self.depth
+            if self.branches is None:
+                # --depth implies --single-branch
+                kwargs['no_single_branch'] = True
+        if self.filter is not None:
+            kwargs['filter'] = self.filter
+        if self.branches is not None:
+            kwargs['single_branch'] = True
+            kwargs['branch'] = self.branches[0]
+        return kwargs
+
+    def fetch_kwargs(self):
+        """Options of git fetch (as GitPython keyword arguments). The filter is remembered by git after the clone."""
+        if self.depth is not None:
+            return {'depth': self.depth}
+        return {}
+
+    def refspecs(self):
+        if self.branches is None:
+            return ['+refs/heads/*:refs/remotes/origin/*']
+        return ['+refs/heads/{0}:refs/remotes/origin/{0}'.format(branch) for branch in self.branches]
+
+
+def _configure_refspecs(repo, policy):
+    """Fetch the branches of the policy from origin (they may have changed since the clone)."""
+    try:
+        current = repo.git.config('--get-all', 'remote.origin.fetch').splitlines()
+    except git.GitCommandError:
+        current = []
+    if current == policy.refspecs():
+        return
+    if len(current) > 0:
+        repo.git.config('--unset-all', 'remote.origin.fetch')
+    for refspec in policy.refspecs():
+        repo.git.config('--add', 'remote.origin.fetch', refspec)
+
+
+def _is_shallow(repo):
+    return os.path.exists(os.path.join(repo.common_dir, 'shallow'))
+
+
+def _has_commit(repo, commit):
+    try:
+        repo.git.cat_file('-e', '{}^{{commit}}'.format(commit))
+        return True
+    except git.GitCommandError:
+        return False
+
+
 @contextlib.contextmanager
 def lock_repository_fetch(repo_path, block=True):
-    with acquire_repo_lock("fetch", repo_path, block):
+    with acquire_repo_lock("fetch", storage_path(repo_path), block):
         repo = _CanFetchLocalRepository(repo_path)
         try:
             yield repo
@@ -87,25 +222,152 @@ def build_repo_url(repo_name, git_server):
 
 @contextlib.contextmanager
 def lock_repository_clone(remote_url, local_path):
-    with acquire_repo_lock("fetch", local_path), acquire_repo_lock("write", local_path):
-        yield _RepositoryClonator(remote_url, local_path)
+    shared_repo_path = mirror_path(local_path, remote_url) if _repository_layout == 'worktree' else None
+    with acquire_repo_lock("fetch", shared_repo_path or local_path), acquire_repo_lock("write", local_path):
+        # The directory may have been deleted and is about to be recreated
+        repo_handles.evict(local_path)
+        yield _RepositoryClonator(remote_url, local_path, shared_repo_path)
+
+
+class RepoHandlePool(object):
+    """Keep git.Repo objects of the local repositories open between operations.
+
+    Opening a git.Repo is cheap, but each one starts its own persistent git cat-file --batch processes
+    on first use. Reusing the handles keeps these processes warm.
+    A handle is lent to one caller at a time (GitPython objects are not thread safe): at most max_size
+    idle handles are kept, the least recently used ones are closed first.
+
+    Args:
+        max_size (int): maximum number of idle handles, 0 disables the pool
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._idle = []  # (path, git.Repo), the most recently used at the end
+        self._generations = {}  # path -> number of evictions, to drop the handles lent before an eviction
+
+    @contextlib.contextmanager
+    def borrow(self, path):
+        """Lend a git.Repo for this path (can raise the exceptions of git.Repo)."""
+        path = os.path.abspath(path)
+        repo = None
+        with self._lock:
+            generation = self._generations.get(path, 0)
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == path:
+                    repo = self._idle.pop(i)[1]
+                    break
+        if repo is None:
+            repo = git.Repo(path)
+        try:
+            yield repo
+        except Exception:
+            # The state of the cat-file processes is unknown (for instance when a command was interrupted)
+            _close_repo(repo)
+            raise
+        self._give_back(path, repo, generation)
+
+    def _give_back(self, path, repo, generation):
+        to_close = []
+        with self._lock:
+            if generation == self._generations.get(path, 0):
+                self._idle.append((path, repo))
+            else:
+                to_close.append(repo)
+            while len(self._idle) > self.max_size:
+                to_close.append(self._idle.pop(0)[1])
+        for repo in to_close:
+            _close_repo(repo)
+
+    def evict(self, path):
+        """Close the idle handles of this path, and the handles currently lent once they are given back."""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._generations[path] = self._generations.get(path, 0) + 1
+            to_close = [repo for p, repo in self._idle if p == path]
+            self._idle = [(p, repo) for p, repo in self._idle if p != path]
+        for repo in to_close:
+            _close_repo(repo)
+
+    def close_all(self):
+        with self._lock:
+            to_close = [repo for _, repo in self._idle]
+            self._idle = []
+        for repo in to_close:
+            _close_repo(repo)
+
+    def __len__(self):
+        return len(self._idle)
+
+
+def _close_repo(repo):
+    try:
+        repo.close()
+    except Exception:
+        logger.exception("Error when closing the git repository {}:".format(repo.working_dir))
+
+
+repo_handles = RepoHandlePool()
+
+
+def configure_repo_handles(max_size):
+    repo_handles.max_size = max_size
+    if max_size == 0:
+        repo_handles.close_all()
+
+
+def close_repo_handles():
+    repo_handles.close_all()
 
 
 class _RepositoryClonator(object):
 
-    def __init__(self, remote_url, local_path):
+    def __init__(self, remote_url, local_path, shared_repo_path=None):
         self.remote_url = remote_url
         self.local_path = local_path
+        self.shared_repo_path = shared_repo_path
+
+    def clone(self, raise_for_error=True, policy=None):
+        """Clone the repository (or add a worktree, see configure_repository_layout).
 
-    def clone(self, raise_for_error=True):
+        Args:
+            policy (ClonePolicy): None to clone everything
+        """
         try:
-            git.Repo.clone_from(self.remote_url, self.local_path)
+            if self.shared_repo_path is not None:
+                self._add_worktree(policy or ClonePolicy())
+            else:
+                kwargs = policy.clone_kwargs() if policy is not None else {}
+                repo = git.Repo.clone_from(self.remote_url, self.local_path, **kwargs)
+                if policy is not None and policy.branches is not None and len(policy.branches) > 1:
+                    # git clone --single-branch only fetches the first one
+                    _configure_refspecs(repo, policy)
+                    repo.remotes.origin.fetch(**policy.fetch_kwargs())
+                commitindex.update_index(repo)
             return True
         except git.GitCommandError as e:
             if e.status == 128 and not raise_for_error:
                 return False
             raise
 
+    def _add_worktree(self, policy):
+        if not os.path.exists(self.shared_repo_path):
+            mkdir_p(os.path.dirname(self.shared_repo_path))
+            shared_repo = git.Repo.clone_from(self.remote_url, self.shared_repo_path, bare=True, **policy.clone_kwargs())
+            # Like a regular clone, so that origin/<branch> can be used in the worktrees
+            _configure_refspecs(shared_repo, policy)
+            shared_repo.remotes.origin.fetch(**policy.fetch_kwargs())
+            commitindex.update_index(shared_repo)
+        else:
+            shared_repo = git.Repo(self.shared_repo_path)
+        try:
+            # A worktree deleted without the cleaner would prevent adding it again
+            shared_repo.git.worktree('prune')
+            shared_repo.git.worktree('add', '--detach', os.path.abspath(self.local_path), 'HEAD')
+        finally:
+            shared_repo.close()
+
 
 # Safe operations only, can be used without acquiring a lock first.
 # Specialized subclasses with more operations defined are built by using one of the lock functions.
@@ -113,9 +375,15 @@ class LocalRepository(object):
 
     def __init__(self, path):
         self.path = path  # Path to the folder on disk containing the repo
-        self._repo = git.Repo(self.path)
+        # Raises if the path is not a repository
+        with self._repo() as repo:
+            # Commits metadata, to avoid reading them with git (see commitindex)
+            self._index = commitindex.get_index(commitindex.index_dir(repo))
         self._invalidated = False
 
+    def _repo(self):
+        return repo_handles.borrow(self.path)
+
     def invalidate(self):
         self._invalidated = True
 
@@ -136,28 +404,69 @@ class LocalRepository(object):
             committer = entry.author.email
         return Commit(msg, committer, entry.hexsha, datetime.datetime.utcfromtimestamp(entry.authored_date - entry.author_tz_offset))
 
+    def _format_indexed_commit(self, entry):
+        return Commit(entry.message, entry.committer, entry.hexsha, entry.authored_date)
+
+    def _walk_index(self, rev, exclude=None, count=None):
+        """Return the commits like git rev-list would, from the commit index, or None if they are not all indexed."""
+        tip = self._index.resolve(rev)
+        excluded = self._index.resolve(exclude) if exclude is not None else None
+        if tip is None or (exclude is not None and excluded is None):
+            return None
+        try:
+            return list(self._index.walk(tip, excluded, count))
+        except KeyError:
+            return None
+
     def list_commits(self, branch, count=20):
         if not branch.startswith("origin/"):
             branch = "origin/" + branch
-        commits = self._repo.iter_commits(branch, max_count=count)
-        out = [self._format_commit(commit) for commit in commits]
+        indexed = self._walk_index(branch, count=count)
+        if indexed is not None:
+            return [self._format_indexed_commit(commit) for commit in indexed]
+        with self._repo() as repo:
+            commits = repo.iter_commits(branch, max_count=count)
+            out = [self._format_commit(commit) for commit in commits]
         return out
 
     def get_commit(self, commit):
-        return self._format_commit(self._repo.commit(commit))
+        hexsha = self._index.resolve(commit)
+        indexed = self._index.get(hexsha) if hexsha is not None else None
+        if indexed is not None:
+            return self._format_indexed_commit(indexed)
+        with self._repo() as repo:
+            return self._format_commit(repo.commit(commit))
+
+    def has_commit(self, commit):
+        with self._repo() as repo:
+            return _has_commit(repo, commit)
 
     # Returns a string
     def diff(self, commit_src, commit_dest):
-        return self._repo.git.diff(commit_src, commit_dest)
+        with self._repo() as repo:
+            return repo.git.diff(commit_src, commit_dest)
 
     def look_for_file(self, commit_src, commit_dest, filename):
         """Returns a list of Commits reachable from commit_dest but not from commit_src
         whose tree contains the given filename.
+
+        The commit index does not know the files of the commits: their presence is checked with git, one object
+        lookup per commit, all of them through the same (persistent) 'git cat-file --batch-check' process.
         """
         out = []
-        for commit in self._repo.iter_commits("{}..{}".format(commit_src, commit_dest)):
-            if filename in commit.tree:
-                out.append(self._format_commit(commit))
+        indexed = self._walk_index(commit_dest, exclude=commit_src)
+        with self._repo() as repo:
+            if indexed is not None:
+                for commit in indexed:
+                    try:
+                        repo.git.get_object_header("{}:{}".format(commit.hexsha, filename))
+                    except ValueError:
+                        continue  # Not in this commit
+                    out.append(self._format_indexed_commit(commit))
+                return out
+            for commit in repo.iter_commits("{}..{}".format(commit_src, commit_dest)):
+                if filename in commit.tree:
+                    out.append(self._format_commit(commit))
         return out
 
 
@@ -166,9 +475,54 @@ class _CanFetchLocalRepository(LocalRepository):
     def __init__(self, *args, **kwargs):
         super(_CanFetchLocalRepository, self).__init__(*args, **kwargs)
 
-    def fetch(self):
+    def fetch(self, policy=None):
+        """Fetch from origin.
+
+        Args:
+            policy (ClonePolicy): if not None, the branches and the depth to fetch (the repository is unshallowed
+                if the policy has no depth)
+        """
+        self._abort_if_invalidated()
+        with self._repo() as repo:
+            kwargs = {}
+            if policy is not None:
+                _configure_refspecs(repo, policy)
+                kwargs = policy.fetch_kwargs()
+                if policy.depth is None and _is_shallow(repo):
+                    kwargs['unshallow'] = True
+            repo.remotes.origin.fetch(**kwargs)
+            commitindex.update_index(repo)
+
+    def ensure_commit(self, commit):
+        """Fetch more history if the commit is not in the repository (shallow or single branch clone).
+
+        Returns:
+            bool: whether the commit is now available
+        """
         self._abort_if_invalidated()
-        self._repo.remotes.origin.fetch()
+        attempts = []
+        if re.match(r'^[0-9a-f]{40}$', commit):
+            # Only if the server accepts any commit in its want lines (most do with the protocol v2)
+            attempts.append(['origin', commit])
+        with self._repo() as repo:
+            if _has_commit(repo, commit):
+                return True
+            if _is_shallow(repo):
+                attempts.extend(['--deepen={}'.format(depth), 'origin'] for depth in ClonePolicy.DEEPEN_STEPS)
+                attempts.append(['--unshallow', 'origin'])
+            attempts.append(['origin', '+refs/heads/*:refs/remotes/origin/*'])
+            for args in attempts:
+                logger.info("Commit {} not found in {}, fetching more history (git fetch {})".format(commit, self.path, " ".join(args)))
+                try:
+                    repo.git.fetch(*args)
+                except git.GitCommandError as e:
+                    logger.warning("git fetch {} failed in {}: {}".format(" ".join(args), self.path, e))
+                    continue
+                if _has_commit(repo, commit):
+                    # The history of the indexed commits may have been deepened
+                    commitindex.update_index(repo, full=True)
+                    return True
+        return False
 
 
 class _WritableLocalRepository(LocalRepository):
@@ -179,10 +533,11 @@ class _WritableLocalRepository(LocalRepository):
     def switch_to(self, commit):
         """Make sure the specified commit is checked out."""
         self._abort_if_invalidated()
-        # Use twice the "-f" option to also delete repositories
-        self._repo.git.clean(d=True, force=True, x=True, f=True)
-        self._repo.head.reference = self._repo.commit(commit)
-        self._repo.head.reset(index=True, working_tree=True)
+        with self._repo() as repo:
+            # Use twice the "-f" option to also delete repositories
+            repo.git.clean(d=True, force=True, x=True, f=True)
+            repo.head.reference = repo.commit(commit)
+            repo.head.reset(index=True, working_tree=True)
 
 
 class Commit(object):
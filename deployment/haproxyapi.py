@@ -1,6 +1,99 @@
 # Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import threading
+import time
+
 import requests
 
+# Seconds during which a stats snapshot is reused
+STATS_TTL = 2
+
+# Polling of the stats when waiting for servers: first interval, growth factor and longest interval (in seconds)
+WAIT_INTERVAL = 0.5
+WAIT_BACKOFF = 1.5
+WAIT_MAX_INTERVAL = 5
+
+# Longest HTTP request to HAProxy, and shortest one when it is derived from a deadline (in seconds)
+REQUEST_TIMEOUT = 10
+MIN_REQUEST_TIMEOUT = 1
+
+
+class HAProxyError(Exception):
+    pass
+
+
+class HAProxyTimeout(HAProxyError):
+    """Raised when servers do not reach the expected state in time.
+
+    Attributes:
+        pending (list of str): the servers ("backend/server (status, check status, sessions)") still not in the expected state
+    """
+
+    def __init__(self, message, pending):
+        super(HAProxyTimeout, self).__init__(message)
+        self.pending = pending
+
+
+def is_up(row):
+    """True if the server (given by its stats row, a dict) is UP."""
+    status = row.get('status', '')
+    # A server without health check is reported as "no check" when it is enabled
+    return status == 'UP' or status == 'no check'
+
+
+def is_drained(row, max_sessions=1):
+    """True if the server has less than max_sessions current sessions."""
+    try:
+        return int(row.get('scur') or 0) < max_sessions
+    except ValueError:
+        return False
+
+
+def describe(backend, server, row):
+    if row is None:
+        return "{}/{} (not found)".format(backend, server)
+    return "{}/{} ({}, check {}, {} sessions)".format(
+        backend, server, row.get('status', ''), row.get('check_status') or 'none', row.get('scur') or 0)
+
+
+class StatsSnapshot(object):
+    """Parsed HAProxy CSV stats, indexed by (pxname, svname)."""
+
+    def __init__(self, rows, fetched_at=None):
+        self.rows = rows
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self._index = dict(((row.get('pxname'), row.get('svname')), row) for row in rows)
+
+    @classmethod
+    def from_csv(klass, text):
+        lines = text.split("\n")[:-1]
+        header = lines.pop(0).replace('# ', '').strip(",").split(",")
+        rows = []
+        for l in lines:
+            rows.append(dict(zip(header, l.split(","))))
+        return klass(rows)
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def get(self, backend, server):
+        """Return the stats row of a server (a dict), or None if it is not found."""
+        return self._index.get((backend, server))
+
+
+# One HTTP session (and thus connection pool) and one stats snapshot per HAProxy URL,
+# shared by all the haproxy objects
+_sessions = {}
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def _session(url):
+    with _lock:
+        if url not in _sessions:
+            _sessions[url] = requests.Session()
+        return _sessions[url]
+
+
 class haproxy:
     def __init__(self, url, auth):
         self.url = url
@@ -12,33 +105,102 @@ class haproxy:
     def disable(self, backend, server):
         return self.post(backend, server, "disable")
 
+    def enable_all(self, backend, servers):
+        return self.post_all(backend, servers, "enable")
+
+    def disable_all(self, backend, servers):
+        return self.post_all(backend, servers, "disable")
+
     def post(self, backend, server, action):
-        payload = 's=%s&action=%s&b=%s' % (server, action, backend)
-        #payload = {'s':server, 'b':backend, 'action':action}
-        #print self.url, self.auth, payload
-        r = requests.post(self.url, auth=self.auth, data=payload, allow_redirects=False)
-        #print r.headers
-        #print r.text
+        return self.post_all(backend, [server], action)
+
+    def post_all(self, backend, servers, action, timeout=REQUEST_TIMEOUT):
+        """Apply action to several servers of the same backend, with a single request."""
+        # HAProxy reads the parameters from the end: the backend and the action must come after the servers
+        payload = '&'.join(['s=%s' % server for server in servers] + ['action=%s' % action, 'b=%s' % backend])
+        try:
+            r = _session(self.url).post(self.url, auth=self.auth, data=payload, allow_redirects=False, timeout=timeout)
+        finally:
+            # Whatever the result, the status of the server may have changed
+            self.invalidate()
         if r.status_code<>303:
             return "Error (%d)" % int(r.status_code)
         if 'DONE' not in r.headers['location']:
             return "Error (%s)" % r.headers['location']
         return "OK"
 
-    def stats(self):
-        r = requests.get("%s;csv" % self.url, auth=self.auth)
+    def snapshot(self, max_age=STATS_TTL, timeout=REQUEST_TIMEOUT):
+        """Return the stats of this HAProxy, downloading them only if the last snapshot is older than max_age seconds
+        (in at most timeout seconds).
+
+        Raises:
+            HAProxyError: the stats could not be downloaded
+        """
+        with _lock:
+            snapshot = _snapshots.get(self.url)
+        if snapshot is not None and snapshot.age() < max_age:
+            return snapshot
+        r = _session(self.url).get("%s;csv" % self.url, auth=self.auth, timeout=timeout)
         if r.status_code<>200:
-            return "Error (%d)" % int(r.status_code)
-        lines = r.text.split("\n")[:-1]
-        header = lines.pop(0).replace('# ','').strip(",").split(",")
-        rows = []
-        for l in lines:
-            rows.append(dict(zip(header, l.split(","))))
-        return rows
+            raise HAProxyError("Could not get the stats of %s: error (%d)" % (self.url, int(r.status_code)))
+        snapshot = StatsSnapshot.from_csv(r.text)
+        with _lock:
+            _snapshots[self.url] = snapshot
+        return snapshot
+
+    def wait_for(self, keys, condition, timeout, interval=WAIT_INTERVAL, backoff=WAIT_BACKOFF, max_interval=WAIT_MAX_INTERVAL):
+        """Poll the stats until condition is true for all the given servers.
+
+        The polling interval starts at interval seconds and is multiplied by backoff after each poll, up to max_interval.
+
+        Args:
+            keys (list of (str, str)): (backend, server) pairs
+            condition (callable): called with the stats row of a server (a dict)
+            timeout (float): deadline, in seconds
+
+        Return:
+            the last StatsSnapshot
+
+        Raises:
+            HAProxyTimeout: some servers were not in the expected state before the deadline
+            HAProxyError: the stats could not be downloaded
+        """
+        deadline = time.time() + timeout
+        while True:
+            request_timeout = min(REQUEST_TIMEOUT, max(MIN_REQUEST_TIMEOUT, deadline - time.time()))
+            snapshot = self.snapshot(max_age=0, timeout=request_timeout)
+            pending = []
+            for backend, server in keys:
+                row = snapshot.get(backend, server)
+                if row is None or not condition(row):
+                    pending.append(describe(backend, server, row))
+            if len(pending) == 0:
+                return snapshot
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise HAProxyTimeout("Timeout after {}s on {}: {}".format(timeout, self.url, ", ".join(pending)), pending)
+            time.sleep(min(interval, remaining))
+            interval = min(interval * backoff, max_interval)
+
+    def wait_up(self, keys, timeout, **kwargs):
+        """Wait until all the given servers are UP. See wait_for."""
+        return self.wait_for(keys, is_up, timeout, **kwargs)
+
+    def wait_drained(self, keys, max_sessions, timeout, **kwargs):
+        """Wait until all the given servers have less than max_sessions current sessions. See wait_for."""
+        return self.wait_for(keys, lambda row: is_drained(row, max_sessions), timeout, **kwargs)
+
+    def invalidate(self):
+        """Forget the last stats snapshot of this HAProxy."""
+        with _lock:
+            _snapshots.pop(self.url, None)
+
+    def stats(self):
+        try:
+            return self.snapshot(max_age=0).rows
+        except HAProxyError as e:
+            return str(e)
 
     def status(self, backend, server):
-        stats = self.stats()
-        servers = {}
-        for s in stats:
-            servers[s['pxname']+':'+s['svname']] = s
-        return servers[backend+':'+server] if backend+':'+server in servers else "Not found"
+        row = self.snapshot().get(backend, server)
+        return row if row is not None else "Not found"
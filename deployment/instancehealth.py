@@ -6,6 +6,7 @@ class InstanceHealth(object):
 
     def __init__(self):
         self._errors = {}
+        self._metrics = {}
         self._lock = threading.Lock()
 
     def add_degraded(self, key, error):
@@ -25,6 +26,27 @@ class InstanceHealth(object):
             if key in self._errors:
                 del self._errors[key]
 
+    def set_errors(self, key, errors):
+        """Replace all the errors of key at once (an empty list means OK)."""
+        with self._lock:
+            if len(errors) > 0:
+                self._errors[key] = list(errors)
+            elif key in self._errors:
+                del self._errors[key]
+
+    def set_metrics(self, key, metrics):
+        """
+        Args:
+            key (str)
+            metrics (dict): JSON serializable values
+        """
+        with self._lock:
+            self._metrics[key] = metrics
+
     def get_status(self):
         with self._lock:
             return {'degraded': len(self._errors), 'errors': self._errors}
+
+    def get_metrics(self):
+        with self._lock:
+            return dict(self._metrics)
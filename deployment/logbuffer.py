@@ -0,0 +1,187 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+"""
+Batched persistence of the log entries of a deployment.
+"""
+from logging import getLogger
+import threading
+import time
+
+from sqlalchemy import orm
+
+from . import database
+from .samodels import LogEntry
+
+logger = getLogger(__name__)
+
+
+class LogWatcher(object):
+    """Wake up the threads waiting for new log entries, when this process writes some.
+
+    Waiters are woken up by the writes of any deployment: they must check themselves whether
+    there are new entries for the deployment they are interested in.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sequence = 0
+
+    def sequence(self):
+        """Return a number that changes every time log entries are written."""
+        with self._condition:
+            return self._sequence
+
+    def notify(self):
+        with self._condition:
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def wait(self, sequence, timeout):
+        """Block until log entries are written after sequence was read, or for timeout seconds.
+
+        Return:
+            True if log entries were written
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._sequence == sequence:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+
+watcher = LogWatcher()
+
+
+def insert_rows(rows):
+    """Insert log entries (as dicts) with a single multi-row INSERT."""
+    with database.session_scope() as session:
+        session.execute(LogEntry.__table__.insert(), rows)
+    watcher.notify()
+
+
+class LogEntryBuffer(object):
+    """Persist the log entries of a deployment in batches, from a background thread.
+
+    Pending entries are written when max_entries of them are waiting, when the oldest one has
+    been waiting for max_delay seconds, or when flush is called.
+    Entries are also added right away to the in-memory log of the deployment view, so notifications
+    (and thus websocket clients) see them without waiting for the database.
+
+    Args:
+        view (DeploymentView): only used from the thread calling add
+        insert_rows (callable): writes a list of rows (dicts) in the log_entries table
+    """
+
+    MAX_ENTRIES = 50
+    MAX_DELAY = 1  # seconds
+    RETRY_DELAY = 2  # seconds
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, view, insert_rows=insert_rows, max_entries=MAX_ENTRIES, max_delay=MAX_DELAY):
+        self._view = view
+        self._deploy_id = view.id
+        self._entries = list(view.log_entries)
+        self._insert_rows = insert_rows
+        self.max_entries = max_entries
+        self.max_delay = max_delay
+
+        self._condition = threading.Condition()
+        self._rows = []
+        self._oldest = None  # time at which the oldest pending row was added (or retried)
+        self._flush_requested = False
+        self._closed = False
+        self._added = 0
+        self._done = 0  # rows either written or given up on
+        self._failures = 0
+
+        self._thread = threading.Thread(target=self._run, name="log-entries-{}".format(self._deploy_id))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, entry):
+        entry.deploy_id = self._deploy_id
+        self._entries.append(entry)
+        # Do not let the ORM insert the entry again
+        orm.attributes.set_committed_value(self._view, 'log_entries', self._entries)
+        row = {'deploy_id': self._deploy_id, 'date': entry.date, 'severity': entry.severity, 'message': entry.message}
+        with self._condition:
+            self._rows.append(row)
+            self._added += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            if len(self._rows) >= self.max_entries:
+                self._condition.notify_all()
+
+    def flush(self, wait=False, timeout=30):
+        """Write the pending entries now.
+
+        Args:
+            wait (bool): block until the entries added so far are written (or given up on)
+        """
+        with self._condition:
+            target = self._added
+            self._flush_requested = True
+            self._condition.notify_all()
+            if not wait:
+                return
+            deadline = time.time() + timeout
+            while self._done < target and self._thread.is_alive():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.error("Timeout when writing the log entries of deployment {}".format(self._deploy_id))
+                    return
+                self._condition.wait(remaining)
+
+    def close(self, timeout=30):
+        """Write all pending entries and stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def _should_write(self):
+        if len(self._rows) == 0:
+            return False
+        if self._failures > 0:
+            return time.time() >= self._oldest + self.RETRY_DELAY
+        return self._closed or self._flush_requested or len(self._rows) >= self.max_entries or \
+            time.time() >= self._oldest + self.max_delay
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._should_write():
+                    if self._closed and len(self._rows) == 0:
+                        return
+                    timeout = None
+                    if self._oldest is not None:
+                        delay = self.RETRY_DELAY if self._failures > 0 else self.max_delay
+                        timeout = max(0, self._oldest + delay - time.time())
+                    self._condition.wait(timeout)
+                rows, self._rows = self._rows, []
+                self._oldest = None
+                self._flush_requested = False
+            try:
+                self._insert_rows(rows)
+                written = True
+            except Exception:
+                logger.exception("Could not write the log entries of deployment {}".format(self._deploy_id))
+                written = False
+            with self._condition:
+                if written:
+                    self._failures = 0
+                    self._done += len(rows)
+                else:
+                    self._failures += 1
+                    if self._failures < self.MAX_ATTEMPTS:
+                        # Retry later, keeping the entries in order
+                        self._rows = rows + self._rows
+                        self._oldest = time.time()
+                    else:
+                        self._failures = 0
+                        self._done += len(rows)
+                        logger.error("Giving up writing {} log entries of deployment {}:\n{}".format(
+                            len(rows), self._deploy_id, "\n".join(r['message'] for r in rows)))
+                self._condition.notify_all()
@@ -61,6 +61,15 @@ class Notification(object):
             'step_failed': step_failed
         })
 
+    @classmethod
+    def deployment_output(klass, deployment_view, prefix, data):
+        return klass('deployment.output', {
+            'environment_id': deployment_view.environment_id,
+            'deploy_id': deployment_view.id,
+            'prefix': prefix,
+            'data': data
+        })
+
     @classmethod
     def deployer_started(klass):
         return klass('deployer.start')
@@ -89,6 +98,15 @@ class Notification(object):
             }
         })
 
+    # changes: IDs of the changed records, by kind (see topology.KINDS)
+    # version is None if this instance has no topology snapshot yet
+    @classmethod
+    def topology_changed(klass, version, changes):
+        return klass('topology.changed', {
+            'version': version,
+            'changes': changes
+        })
+
     # If deployment_id is not none, it means that commits were fetched
     # during a deployment (a notifier may want to take a different action
     # in this case)
@@ -119,6 +137,12 @@ class NotifierCollection(object):
 
 class RemoteDeployerNotifier(object):
 
+    # Events posted to the other deployer instances, synchronously: the output of the commands is too chatty
+    # for that, the other instances only get the events marking the progress of a deployment
+    FORWARDED_EVENTS_TYPES = ["deployment.queued", "deployment.configuration_loaded", "deployment.end", "deployment.step_start", "deployment.step.release", "commits.fetched", "topology.changed"]
+    # Seconds, for each request to another deployer instance
+    REQUEST_TIMEOUT = 10
+
     # Take care of not passing the current deployer URL
     def __init__(self, urls, deployer_username, deployer_token):
         self.urls = urls
@@ -135,17 +159,19 @@ class RemoteDeployerNotifier(object):
                                  'Check the cluster->this_deployer_username setting.'.format(self.deployer_username)
                                  )
             r = requests.post(urlparse.urljoin(url, '/api/auth/token'),
-                              json={'username': deployer_user.username, 'auth_token': self.deployer_token})
+                              json={'username': deployer_user.username, 'auth_token': self.deployer_token},
+                              timeout=self.REQUEST_TIMEOUT)
         r.raise_for_status()
         self.session_token = r.json()['token']
 
     def dispatch(self, event):
-        if event.evt_type not in WebSocketNotifier.FORWARDED_EVENTS_TYPES:
+        if event.evt_type not in self.FORWARDED_EVENTS_TYPES:
             return
         for url in self.urls:
             if self.session_token is None:
                 self.get_session_token(url)
-            kwargs = {'json': {'event': WebSocketNotifier.event_to_websocket(event).to_dict()}, 'headers': {'Content-Type': 'application/json', 'X-Session-Token': self.session_token}}
+            kwargs = {'json': {'event': WebSocketNotifier.event_to_websocket(event).to_dict()}, 'headers': {'Content-Type': 'application/json', 'X-Session-Token': self.session_token},
+                      'timeout': self.REQUEST_TIMEOUT}
             args = [urlparse.urljoin(url, '/api/notification/websocketevent')]
             r = requests.post(*args, **kwargs)
             if r.status_code == 403:
@@ -255,7 +281,7 @@ Completed: {date_end}
 
 class WebSocketNotifier(object):
 
-    FORWARDED_EVENTS_TYPES = ["deployment.queued", "deployment.configuration_loaded", "deployment.end", "deployment.step_start", "deployment.step.release", "commits.fetched"]
+    FORWARDED_EVENTS_TYPES = ["deployment.queued", "deployment.configuration_loaded", "deployment.end", "deployment.step_start", "deployment.step.release", "deployment.output", "commits.fetched", "topology.changed"]
 
 
     # Push events to a queue
@@ -281,6 +307,23 @@ class WebSocketNotifier(object):
             evt = websocket.WebSocketEvent("commits.fetched", payload)
             return evt
 
+        if event.evt_type == "deployment.output":
+            # Live output of a running command, not stored in the deployment log
+            payload = {
+                'environment_id': event.payload['environment_id'],
+                'deployment_id': event.payload['deploy_id'],
+                'prefix': event.payload['prefix'],
+                'data': event.payload['data'].decode('utf-8', 'replace')
+            }
+            return websocket.WebSocketEvent("deployment.output", payload)
+
+        if event.evt_type == "topology.changed":
+            payload = {
+                'version': event.payload['version'],
+                'changes': dict((kind, sorted(ids)) for kind, ids in event.payload['changes'].items())
+            }
+            return websocket.WebSocketEvent("topology.changed", payload)
+
         if event.evt_type == "deployment.step.release":
             server_schema = m.Server.__marshmallow__()
             payload = {
@@ -0,0 +1,153 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+"""
+Shared cache of the release deployed on each server.
+"""
+import datetime
+from logging import getLogger
+import threading
+import time
+
+from . import execution, executils, gitutils
+
+logger = getLogger(__name__)
+
+
+class CachedReleaseStatus(object):
+    """A ReleaseStatus and the time (a timestamp) at which it was read on the server."""
+
+    def __init__(self, status, fetched_at):
+        self.status = status
+        self.fetched_at = fetched_at
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def to_dict(self, environment_id, server_id):
+        out = self.status.to_dict(environment_id, server_id)
+        out['fetched_at'] = datetime.datetime.utcfromtimestamp(self.fetched_at).isoformat()
+        return out
+
+
+class ReleaseStatusCache(object):
+    """Thread safe cache of the release statuses of servers, keyed by (Host, target path).
+
+    Entries younger than ttl seconds are served as is. Entries older than that but younger than max_stale
+    seconds are also served, but are refreshed in the background (stale-while-revalidate).
+    Older or missing entries are read on the servers before answering.
+
+    Args:
+        fetch (callable): reads the release statuses of a list of (Host, target path) on the servers,
+            with a timeout (in seconds). Defaults to execution.concurrent_get_release_status.
+    """
+
+    TTL = 60  # seconds
+    MAX_STALE = 3600  # seconds
+
+    def __init__(self, fetch=None, ttl=TTL, max_stale=MAX_STALE):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refreshing = set()
+
+    def put(self, host, target_path, status, fetched_at=None):
+        """Cache the release status of a server.
+
+        Args:
+            host (executils.Host)
+            target_path (str)
+            status (execution.ReleaseStatus)
+        """
+        entry = CachedReleaseStatus(status, time.time() if fetched_at is None else fetched_at)
+        with self._lock:
+            current = self._entries.get((host, target_path))
+            # Do not overwrite a newer value with the result of a slow read
+            if current is None or current.fetched_at <= entry.fetched_at:
+                self._entries[(host, target_path)] = entry
+        return entry
+
+    def put_release(self, host, target_path, release_date, branch, commit):
+        """Record a release that has just been made by a deployment."""
+        release = gitutils.Release(branch, commit, release_date, None)
+        return self.put(host, target_path, execution.ReleaseStatus.release(release))
+
+    def get(self, host, target_path):
+        """Return the cached status (a CachedReleaseStatus), or None. Never reads the server."""
+        with self._lock:
+            return self._entries.get((host, target_path))
+
+    def get_many(self, targets, timeout=4, refresh=False):
+        """Return the release statuses of the targets, reading the servers only when needed.
+
+        Args:
+            targets (list of (Host, str)): (host, target path) pairs
+            timeout (int): SSH timeout for the servers that must be read now
+            refresh (bool): ignore the cached values and read all the servers
+
+        Return:
+            a list of CachedReleaseStatus, in the same order as targets
+        """
+        out = []
+        missing = []
+        stale = []
+        with self._lock:
+            for target in targets:
+                entry = None if refresh else self._entries.get(target)
+                if entry is None or entry.age() >= self.max_stale:
+                    missing.append(target)
+                elif entry.age() >= self.ttl and target not in self._refreshing:
+                    stale.append(target)
+                    self._refreshing.add(target)
+                out.append(entry)
+        if len(stale) > 0:
+            thread = threading.Thread(target=self._revalidate, args=(stale, timeout), name="release-cache-refresh")
+            thread.daemon = True
+            thread.start()
+        if len(missing) > 0:
+            fetched = dict(zip(missing, self.refresh(missing, timeout)))
+            out = [fetched.get(target, cached) for target, cached in zip(targets, out)]
+        return out
+
+    def refresh(self, targets, timeout=4):
+        """Read the release statuses of the targets on the servers, and cache them.
+
+        Return:
+            a list of CachedReleaseStatus, in the same order as targets
+        """
+        fetched_at = time.time()
+        fetch = self._fetch if self._fetch is not None else execution.concurrent_get_release_status
+        statuses = fetch(targets, timeout)
+        return [self.put(host, target_path, status, fetched_at) for (host, target_path), status in zip(targets, statuses)]
+
+    def _revalidate(self, targets, timeout):
+        try:
+            self.refresh(targets, timeout)
+        except Exception:
+            logger.exception("Could not refresh the release statuses of {} servers".format(len(targets)))
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(targets)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ReleaseCacheNotifier(object):
+    """Update the cache with the releases made by deployments."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def dispatch(self, event):
+        if event.evt_type != "deployment.step.release":
+            return
+        environment = event.payload['deployment'].environment
+        host = executils.Host.from_server(event.payload['server'], environment.remote_user)
+        info = event.payload['release_info']
+        self.cache.put_release(host, environment.target_path, info['release_date'], info['branch'], info['commit'])
+
+
+# Shared by the API, the deployments and the CheckReleases worker
+cache = ReleaseStatusCache()
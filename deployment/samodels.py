@@ -2,6 +2,7 @@
 import string
 import json
 import datetime
+import math
 import os
 import enum
 import textwrap
@@ -10,7 +11,7 @@ import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 
-from . import authorization
+from . import authorization, gitutils
 
 
 Base = declarative_base()
@@ -32,18 +33,28 @@ class Role(Base):
 
     users = orm.relationship("User", secondary=users_roles, back_populates="roles")
 
+    # (JSON permissions, parsed permissions, authorization.PermissionIndex)
+    _permissions_cache = None
+
+    def _compiled_permissions(self):
+        cache = self._permissions_cache
+        if cache is None or cache[0] != self.permissions:
+            parsed = authorization.permissions_from_dict(json.loads(self.permissions))
+            cache = (self.permissions, parsed, authorization.PermissionIndex(parsed))
+            self._permissions_cache = cache
+        return cache
+
     def permissions_parsed(self):
-        # TODO: memoize that somewhat ?
-        return authorization.permissions_from_dict(json.loads(self.permissions))
+        return self._compiled_permissions()[1]
+
+    def permission_index(self):
+        return self._compiled_permissions()[2]
 
     def allow(self, permission):
-        return any(p.implies(permission) for p in self.permissions_parsed())
+        return self.permission_index().allows(permission)
 
     def readable_environments(self):
-        out = set()
-        for p in self.permissions_parsed():
-            out.update(p.readable_environments())
-        return out
+        return self.permission_index().readable_environments
 
 
 class User(Base):
@@ -73,17 +84,29 @@ class User(Base):
             all()
         return self._default_roles_cache
 
+    # (roles and their permissions, authorization.PermissionIndex)
+    _permission_index_cache = None
+
+    def permission_index(self):
+        """Return the authorization.PermissionIndex of all the roles of this user (default roles included)."""
+        roles = self.roles + self.default_roles
+        key = tuple((id(role), role.permissions) for role in roles)
+        cache = self._permission_index_cache
+        if cache is None or cache[0] != key:
+            permissions = [p for role in roles for p in role.permissions_parsed()]
+            cache = (key, authorization.PermissionIndex(permissions))
+            self._permission_index_cache = cache
+        return cache[1]
+
     def is_superadmin(self):
         return self.has_permission(authorization.SuperAdmin())
 
     def has_permission(self, permission):
-        return any(role.allow(permission) for role in self.roles + self.default_roles)
+        return self.permission_index().allows(permission)
 
     def readable_environments(self):
-        out = set()
-        for role in self.roles + self.default_roles:
-            out.update(role.readable_environments())
-        return out
+        """Return the frozenset of the IDs of the environments this user can read."""
+        return self.permission_index().readable_environments
 
 
 class HaproxyBackend(Base):
@@ -137,6 +160,9 @@ class Cluster(Base):
     haproxy_backend_id = sa.Column(sa.Integer, sa.ForeignKey("haproxy_backends.id"), nullable=True)
     inventory_key = sa.Column(sa.String(255), nullable=True, unique=True) #mySQL allows multiple NUll values with a UNIQUE constraint
     updated_at = sa.Column(sa.DateTime(), nullable=True)
+    # How many servers of this cluster are synced and released at the same time during a deployment
+    # (None means use the deployer default)
+    rollout_parallelism = sa.Column(sa.Integer(), nullable=True)
     servers = orm.relationship("ClusterServerAssociation", back_populates="cluster_def")
     environments = orm.relationship("Environment", secondary=environments_clusters, back_populates="clusters")
     haproxy_backend_def = orm.relationship('HaproxyBackend')
@@ -159,6 +185,7 @@ class OneServerCluster(object):
     def __init__(self, name, server):
         self.name = name
         self.haproxy_host = None
+        self.rollout_parallelism = None
         self.servers = [FakeClusterAssociation(server, self)]
 
     @property
@@ -175,9 +202,26 @@ class Repository(Base):
     deploy_method = sa.Column(sa.String(255), nullable=False, default='inplace')
     git_server = sa.Column(sa.String(255), nullable=False)
     _notify_owners_mails = sa.Column("notify_owners_mails", sa.String(255), nullable=False, default='')
+    # How much of the repository is cloned and fetched, see clone_policy
+    clone_depth = sa.Column(sa.Integer(), nullable=True)
+    clone_filter = sa.Column(sa.String(64), nullable=True)
+    clone_single_branch = sa.Column(sa.Boolean(), nullable=False, default=False)
 
     environments = orm.relationship("Environment", back_populates="repository")
 
+    def clone_policy(self):
+        """Return the gitutils.ClonePolicy of this repository.
+
+        With clone_single_branch, only the deploy branches of its environments are fetched.
+        """
+        branches = None
+        if self.clone_single_branch:
+            branches = set(env.deploy_branch for env in self.environments)
+            # An environment without a deploy branch needs all of them
+            if len(branches) == 0 or '' in branches:
+                branches = None
+        return gitutils.ClonePolicy(self.clone_depth, self.clone_filter, branches)
+
     @property
     def notify_owners_mails(self):
         if self._notify_owners_mails is None:
@@ -202,6 +246,8 @@ class Environment(Base):
     env_order = sa.Column(sa.Integer(), nullable=False, default=0)
     deploy_branch = sa.Column(sa.String(255), nullable=False, default='')
     fail_deploy_on_failed_tests = sa.Column(sa.Boolean, nullable=False, default=True)
+    # How many clusters are updated at the same time, see rollout_batch_size
+    rollout_strategy = sa.Column(sa.String(32), nullable=False, default='serial')
 
     repository_id = sa.Column(sa.Integer, sa.ForeignKey("repositories.id"), nullable=False)
 
@@ -237,10 +283,40 @@ class Environment(Base):
     def remote_repo_path(self):
         return os.path.dirname(os.path.normpath(self.target_path))
 
+    def rollout_batch_size(self, cluster_count):
+        return rollout_batch_size(self.rollout_strategy or 'serial', cluster_count)
+
     def production_folder(self):
         return os.path.basename(os.path.normpath(self.target_path))
 
 
+def rollout_batch_size(strategy, cluster_count):
+    """Return how many clusters (out of cluster_count) to update at the same time.
+
+    At least one cluster must keep serving while the others are updated, so the result is
+    always lower than cluster_count (unless there is only one cluster).
+
+    Args:
+        strategy (str): 'serial' (one cluster at a time), 'N' (N clusters at a time) or 'P%' (P percent of the clusters at a time)
+
+    Raises:
+        ValueError: strategy is not valid
+    """
+    strategy = strategy.strip()
+    if strategy == 'serial':
+        size = 1
+    elif strategy.endswith('%'):
+        percent = int(strategy[:-1])
+        if not 0 < percent <= 100:
+            raise ValueError("Invalid rollout strategy percentage: {}".format(strategy))
+        size = int(math.ceil(cluster_count * percent / 100.0))
+    else:
+        size = int(strategy)
+        if size <= 0:
+            raise ValueError("Invalid rollout strategy: {}".format(strategy))
+    return max(1, min(size, cluster_count - 1))
+
+
 class Severity(enum.Enum):
     INFO = 1,
     WARN = 2,
@@ -268,6 +344,8 @@ class Severity(enum.Enum):
 
 class LogEntry(Base):
     __tablename__ = "log_entries"
+    # For reading the log of a deployment incrementally (see api.deployment_logs)
+    __table_args__ = (sa.Index('log_entries_deploy_id_id', 'deploy_id', 'id'), )
 
     def __init__(self, message, severity=Severity.INFO, date=None, deploy_id=None, id=None):
         self.message = message
@@ -299,6 +377,12 @@ class LogEntry(Base):
 
 class DeploymentView(Base):
     __tablename__ = "deploys"
+    # For the history, listed from the most recent deployment (see api.deployments_history)
+    __table_args__ = (
+        sa.Index('deploys_date_start_deploy_id', 'date_start_deploy', 'id'),
+        sa.Index('deploys_repository_date_start_deploy_id', 'repository_name', 'date_start_deploy', 'id'),
+        sa.Index('deploys_environment_date_start_deploy_id', 'environment_id', 'date_start_deploy', 'id'),
+    )
 
     id = sa.Column(sa.Integer(), nullable=False, primary_key=True, autoincrement=True)
     # Not only foreign keys for tracability reasons - the env may be modified or deleted
@@ -3,13 +3,13 @@ import sys
 import inspect
 import json
 
-from marshmallow import fields
+from marshmallow import fields, validate
 from sqlalchemy import orm
 import sqlalchemy as sa
 from marshmallow_sqlalchemy import ModelSchema, ModelConversionError, field_for
 from marshmallow import Schema, validates, ValidationError
 
-from . import samodels as m, authorization
+from . import samodels as m, authorization, gitutils
 
 
 class BaseSchema(ModelSchema):
@@ -37,10 +37,21 @@ class RepositorySchema(BaseSchema):
         out = ",".join(s.strip() for s in value)
         return out
 
+    @validates('clone_depth')
+    def validate_clone_depth(self, data):
+        if data is not None and data < 1:
+            raise ValidationError("must be a positive number of commits (or null for the whole history)")
+
+    @validates('clone_filter')
+    def validate_clone_filter(self, data):
+        if data is not None and not gitutils.ClonePolicy.FILTER_PATTERN.match(data):
+            raise ValidationError("must be 'blob:none', 'blob:limit=<size>' or null")
+
     def get_environments(self, obj):
         ids = [env.id for env in obj.environments]
         if self.context and not self.context['account'].has_permission(authorization.ReadAllEnvironments()):
-            ids = [env_id for env_id in ids if env_id in self.context['account'].readable_environments()]
+            readable = self.context['account'].readable_environments()
+            ids = [env_id for env_id in ids if env_id in readable]
         return ids
 
 
@@ -85,6 +96,7 @@ class ClusterPostSchema(Schema):
     name = fields.String()
     haproxy_host = fields.String(missing=None)
     haproxy_backend_id = fields.Integer(missing=None)
+    rollout_parallelism = fields.Integer(missing=None, allow_none=True, validate=validate.Range(min=1))
     servers = fields.List(fields.Nested(_InnerClusterPostSchema))
 
 
@@ -110,6 +122,13 @@ class EnvironmentSchema(BaseSchema):
         if "/" not in data:
             raise ValidationError("must contain at least a /")
 
+    @validates('rollout_strategy')
+    def validate_rollout_strategy(self, data):
+        try:
+            m.rollout_batch_size(data, 2)
+        except ValueError:
+            raise ValidationError("must be 'serial', a number of clusters or a percentage of clusters (such as '50%')")
+
 
 
 class PostEnvironmentSchema(EnvironmentSchema):
@@ -10,7 +10,7 @@ import time
 import beanstalkc
 
 from . import api
-from . import execution, mail, notification, websocket, database
+from . import execution, executils, gitutils, mail, notification, websocket, database, releasecache, topology
 from .instancehealth import InstanceHealth
 from .log import configure_logging
 from .checkreleases import CheckReleasesWorker
@@ -54,6 +54,8 @@ class WorkerSupervisor(object):
         self.config_path = config_path
 
         database.init_db(config.get("database", "connection"))
+        self._configure_ssh(config)
+        self._configure_git(config)
 
         workers = self._build_workers(config)
         self._spawn_workers(workers)
@@ -90,13 +92,30 @@ class WorkerSupervisor(object):
 
         return wrapped
 
+    def _configure_ssh(self, config):
+        idle_timeout = 60
+        if config.has_option("general", "ssh_connection_idle_timeout"):
+            idle_timeout = config.getint("general", "ssh_connection_idle_timeout")
+        if idle_timeout > 0:
+            control_dir = "/tmp/deployer-ssh"
+            if config.has_option("general", "ssh_control_path"):
+                control_dir = config.get("general", "ssh_control_path")
+            executils.enable_ssh_connection_sharing(control_dir, idle_timeout)
+
+    def _configure_git(self, config):
+        if config.has_option("general", "repository_layout"):
+            gitutils.configure_repository_layout(config.get("general", "repository_layout"))
+        if config.has_option("general", "git_repo_handles"):
+            gitutils.configure_repo_handles(config.getint("general", "git_repo_handles"))
+
     def _build_notifiers(self, ws_worker, mail_sender, notify_mails, carbon_host, carbon_port, other_deployer_urls, deployer_username, deployer_token, provider):
         mail = notification.MailNotifier(mail_sender, notify_mails)
         websocket = notification.WebSocketNotifier(ws_worker)
         graphite = notification.GraphiteNotifier(carbon_host, carbon_port)
         remote = notification.RemoteDeployerNotifier(other_deployer_urls, deployer_username, deployer_token)
+        release_cache = releasecache.ReleaseCacheNotifier(releasecache.cache)
         more_notifiers = provider.build_notifiers()
-        return notification.NotifierCollection(mail, websocket, graphite, remote, *more_notifiers), websocket
+        return notification.NotifierCollection(mail, websocket, graphite, remote, release_cache, *more_notifiers), websocket
 
     def _build_integration_module(self, config):
         provider_class = _import_class(config.get('integration', 'provider'))
@@ -106,12 +125,19 @@ class WorkerSupervisor(object):
         provider = self._build_integration_module(config)
         workers = []
 
+        haproxy_waits = {}
+        for option, getter in (("haproxy_drain_sessions", config.getint),
+                               ("haproxy_drain_timeout", config.getfloat),
+                               ("haproxy_up_timeout", config.getfloat)):
+            if config.has_option("general", option):
+                haproxy_waits[option] = getter("general", option)
         general_config = execution.GeneralConfig(
             base_repos_path=config.get("general", "local_repo_path"),
             haproxy_user=config.get("general", "haproxy_user"),
             haproxy_password=config.get("general", "haproxy_pass"),
             notify_mails=config.get('general', "notify_mails").split(","),
-            mail_sender=config.get('mail', 'sender')
+            mail_sender=config.get('mail', 'sender'),
+            **haproxy_waits
         )
         notify_mails = [s.strip() for s in config.get('general', 'notify_mails').split(",")]
         carbon_host = config.get('general', 'carbon_host')
@@ -129,6 +155,7 @@ class WorkerSupervisor(object):
         self.notifier, websocket_notifier = self._build_notifiers(
             ws_worker, mail_sender, notify_mails, carbon_host, carbon_port, other_deployers_urls, deployer_username, deployer_token, provider
         )
+        topology.service.notifier = self.notifier
 
         for i in range(5):
             conn = beanstalkc.Connection(host=config.get('general', 'beanstalk_host'), port=11300)
@@ -175,6 +202,8 @@ class WorkerSupervisor(object):
 
         for worker in async_fetch_workers:
             workers.append(worker)
+        if config.has_option("general", "fetch_min_interval"):
+            AsyncFetchWorker.job_queue.min_interval = config.getfloat("general", "fetch_min_interval")
 
         workers.append(CleanerWorker(general_config.base_repos_path))
 
@@ -229,6 +258,14 @@ class WorkerSupervisor(object):
             else:
                 logger.info("All workers gracefully terminated.")
             self.threads = []
+            try:
+                executils.close_ssh_connections()
+            except Exception:
+                logger.exception("Error when closing the SSH master connections:")
+            try:
+                gitutils.close_repo_handles()
+            except Exception:
+                logger.exception("Error when closing the git repositories:")
 
     def _monitor(self):
         while self._running:
@@ -4,13 +4,17 @@ import os
 import shutil
 import datetime
 import json
+import threading
+import time
+import zlib
 
 
 from io import BytesIO
 import mock
 from bottle import request, tob, HTTPError, default_app
+from marshmallow import ValidationError
 
-from deployment import gitutils, database, samodels as m, api
+from deployment import gitutils, database, samodels as m, api, releasecache, topology, logbuffer
 from deployment.integrationexample.integration import DummyAuthenticator
 
 
@@ -39,6 +43,11 @@ class TestApi(unittest.TestCase):
         database.create_all()
         self.session = database.Session()
         self._load_fixtures(self.session)
+        releasecache.cache.clear()
+        api.principals.invalidate()
+        topology.service.reset()
+        request.environ.pop('QUERY_STRING', None)
+        request.environ.pop('bottle.request.query', None)
 
     def tearDown(self):
         self.session.rollback()
@@ -49,6 +58,10 @@ class TestApi(unittest.TestCase):
         # So let's dememoize it (yes, I don't think that word exists either).
         request.environ.pop('bottle.request.json', None)
         request.environ.pop('bottle.request.body', None)
+        request.environ.pop('HTTP_X_SESSION_TOKEN', None)
+        request.environ.pop('HTTP_IF_NONE_MATCH', None)
+        request.environ.pop('HTTP_ACCEPT_ENCODING', None)
+        request.environ.pop('bottle.request.headers', None)
 
     def _set_body_json(self, data):
         body = json.dumps(data)
@@ -201,6 +214,16 @@ class TestApi(unittest.TestCase):
         self.assertEqual('fr-hq-important-01', parsed['cluster']['servers'][0]['server']['name'])
         self.assertTrue(1 < parsed['cluster']['id'])
 
+    def test_post_cluster_invalid_parallelism(self):
+        self._set_body_json({
+            'name': 'cluster',
+            'haproxy_host': 'vip',
+            'rollout_parallelism': 0,
+            'servers': []
+        })
+        with self.assertRaises(ValidationError):
+            api.clusters_post(self.session)
+
     def test_delete_cluster(self):
         out = api.clusters_delete(1, self.session)
         parsed = json.loads(out)
@@ -245,6 +268,27 @@ class TestApi(unittest.TestCase):
         parsed = json.loads(out)
         self.assertEqual(1, parsed['repository']['id'])
 
+    def test_update_repository_clone_policy(self):
+        body = {
+            'name': 'my repo',
+            'git_server': 'git',
+            'clone_depth': 50,
+            'clone_filter': 'blob:none',
+            'clone_single_branch': True
+        }
+        self._set_body_json(body)
+        parsed = json.loads(api.repository_put(1, self.session))
+        self.assertEqual(50, parsed['repository']['clone_depth'])
+        policy = self.session.query(m.Repository).get(1).clone_policy()
+        self.assertEqual((50, 'blob:none', ['master', 'prod']), (policy.depth, policy.filter, policy.branches))
+        self.assertEqual(None, self.session.query(m.Repository).get(3).clone_policy().branches)
+        body['clone_filter'] = 'tree:0'
+        self._set_body_json(body)
+        for key in ('bottle.request.json', 'bottle.request.body'):
+            request.environ.pop(key, None)
+        with self.assertRaises(ValidationError):
+            api.repository_put(1, self.session)
+
     def test_insert_repository(self):
         self._set_body_json({
             'name': 'new_repo',
@@ -454,6 +498,61 @@ class TestApi(unittest.TestCase):
         with self.assertRaises(HTTPError):
             api.auth_token(self.session)
 
+    def _check_auth_with_session_token(self, token):
+        request.environ['HTTP_X_SESSION_TOKEN'] = token
+        request.environ.pop('bottle.request.headers', None)
+        api.check_auth()
+        return request.account
+
+    def _issue_session_token(self):
+        self._set_body_json({
+            'username': 'impersonator',
+            'auth_token': 'iamarobot'
+        })
+        token = json.loads(api.auth_token(self.session))['token']
+        request.environ.pop('bottle.request.json', None)
+        request.environ.pop('bottle.request.body', None)
+        return token
+
+    def test_check_auth_cached(self):
+        token = self._issue_session_token()
+        user = self._check_auth_with_session_token(token)
+        self.assertEqual('impersonator', user.username)
+        with mock.patch('deployment.database.session_scope') as mocked:
+            self.assertIs(user, self._check_auth_with_session_token(token))
+            self.assertTrue(user.has_permission(api.authorization.Impersonate()))
+            self.assertFalse(mocked.called)
+        with self.assertRaises(HTTPError) as e:
+            self._check_auth_with_session_token("not a token")
+        self.assertEqual(403, e.exception.status_code)
+
+    def test_check_auth_invalidated_on_role_update(self):
+        token = self._issue_session_token()
+        self.assertFalse(self._check_auth_with_session_token(token).is_superadmin())
+        request.account = self.session.query(m.User).filter_by(username='root').one()
+        self._set_body_json({'name': 'impersonator', 'permissions': {'impersonate': True, 'admin': True}})
+        api.roles_put(3, self.session)
+        self.assertTrue(self._check_auth_with_session_token(token).is_superadmin())
+
+    def test_check_auth_expired_token(self):
+        token = self._issue_session_token()
+        self._check_auth_with_session_token(token)
+        expired = datetime.datetime.utcnow() + api.TOKEN_VALIDITY + datetime.timedelta(seconds=1)
+        self.assertIsNone(api.principals.get(token, now=expired))
+        self.session.query(m.User).filter_by(username='impersonator').update(
+            {'token_issued_at': datetime.datetime.utcnow() - api.TOKEN_VALIDITY - datetime.timedelta(seconds=1)})
+        self.session.commit()
+        api.principals.invalidate()
+        with self.assertRaises(HTTPError) as e:
+            self._check_auth_with_session_token(token)
+        self.assertEqual(403, e.exception.status_code)
+
+    def test_permissions_parsed_memoized(self):
+        role = self.session.query(m.Role).get(1)
+        self.assertIs(role.permissions_parsed(), role.permissions_parsed())
+        role.permissions = json.dumps({'deploy': [2]})
+        self.assertTrue(role.allow(api.authorization.Deploy(2)))
+
     @mock.patch("deployment.execution.run_cmd_by_ssh", side_effect=_mocked_get_git_release)
     def test_fetch_server_status(self, mocked):
         parsed = json.loads(api.environments_servers(2, self.session))
@@ -464,6 +563,21 @@ class TestApi(unittest.TestCase):
         self.assertEqual("prod", release_data['release_status']['release']['branch'])
         self.assertEqual("ee31430cc3b28596857d50e67c117a5ec8825fec", release_data['release_status']['release']['commit'])
 
+    @mock.patch("deployment.execution.run_cmd_by_ssh", side_effect=_mocked_get_git_release)
+    def test_fetch_server_status_cached(self, mocked):
+        parsed = json.loads(api.environments_servers(2, self.session))
+        calls = mocked.call_count
+        fetched_at = parsed['servers_status']['1']['release_status']['fetched_at']
+        # Served from the cache
+        parsed = json.loads(api.environments_servers(2, self.session))
+        self.assertEqual(calls, mocked.call_count)
+        self.assertEqual(fetched_at, parsed['servers_status']['1']['release_status']['fetched_at'])
+        # Unless asked otherwise
+        request.environ['QUERY_STRING'] = 'refresh=1'
+        request.environ.pop('bottle.request.query', None)
+        json.loads(api.environments_servers(2, self.session))
+        self.assertEqual(2 * calls, mocked.call_count)
+
     @mock.patch("deployment.execution.run_cmd_by_ssh", side_effect=_mocked_get_git_release)
     def test_fetch_server_releases(self, mocked):
         parsed = json.loads(api.servers_get_environments(1, self.session))
@@ -540,6 +654,151 @@ class TestApi(unittest.TestCase):
         self.assertEqual(1, len(user.roles))
         self.assertEqual(0, len(user.default_roles))
 
+    def test_user_permission_index(self):
+        user = self.session.query(m.User).get(1)
+        index = user.permission_index()
+        self.assertIs(index, user.permission_index())
+        # Default roles included
+        self.assertEqual(frozenset([1, 42]), user.readable_environments())
+        # Rebuilt when the roles change
+        user.roles.append(self.session.query(m.Role).get(3))
+        self.assertTrue(user.has_permission(api.authorization.ReadAllEnvironments()))
+        self.assertIsNot(index, user.permission_index())
+
+    def _set_headers(self, **headers):
+        for name, value in headers.items():
+            request.environ['HTTP_' + name.upper()] = value
+        request.environ.pop('bottle.request.headers', None)
+
+    def test_conditional_list(self):
+        body = api.clusters_get(self.session)
+        etag = api.response.headers['ETag']
+        self._set_headers(if_none_match=etag)
+        self.assertEqual(304, api.clusters_get(self.session).status_code)
+        # Another user gets another ETag
+        request.account = self.session.query(m.User).get(1)
+        self.assertEqual(body, api.clusters_get(self.session))
+        request.account = self.session.query(m.User).get(2)
+        # Modified
+        self.session.query(m.Cluster).get(1).name = 'renamed'
+        self.session.commit()
+        self.assertIn('renamed', api.clusters_get(self.session))
+        self.assertNotEqual(etag, api.response.headers['ETag'])
+
+    def test_conditional_gzip(self):
+        self._set_headers(accept_encoding='gzip, deflate')
+        with mock.patch('deployment.api.GZIP_MIN_SIZE', 0):
+            body = api.environments_list(self.session)
+        self.assertEqual('gzip', api.response.headers['Content-Encoding'])
+        parsed = json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+        self.assertEqual(4, len(parsed['environments']))
+        etag = api.response.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        self._set_headers(if_none_match=etag)
+        self.assertEqual(304, api.environments_list(self.session).status_code)
+
+    def test_conditional_recent_deployments(self):
+        api.deployments_recent(self.session)
+        self._set_headers(if_none_match=api.response.headers['ETag'])
+        self.assertEqual(304, api.deployments_recent(self.session).status_code)
+        self.session.add(m.LogEntry(deploy_id=2, message="new entry"))
+        self.session.commit()
+        deploys = json.loads(api.deployments_recent(self.session))['deployments']
+        self.assertIn("new entry", [entry['message'] for deploy in deploys for entry in deploy['log_entries']])
+        self._set_headers(if_none_match=api.response.headers['ETag'])
+        self.session.query(m.DeploymentView).get(2).status = "COMPLETE"
+        self.session.commit()
+        self.assertNotEqual(304, getattr(api.deployments_recent(self.session), 'status_code', 200))
+
+    def _set_query(self, query):
+        request.environ['QUERY_STRING'] = query
+        request.environ.pop('bottle.request.query', None)
+
+    def test_deployments_history(self):
+        start = datetime.datetime(2016, 1, 1)
+        for i in range(10, 30):
+            self.session.add(m.DeploymentView(id=i, repository_name="my repo", environment_name="prod", environment_id=4,
+                                              branch="prod", commit="abcde", user_id=1, status="COMPLETE",
+                                              queued_date=start, date_start_deploy=start + datetime.timedelta(hours=i // 2)))
+        self.session.add(m.LogEntry(id=2, deploy_id=10, message="entry"))
+        self.session.commit()
+
+        seen = []
+        cursor = ''
+        while True:
+            self._set_query('environment_id=4&limit=6&cursor=' + cursor)
+            page = json.loads(api.deployments_history(self.session))
+            seen.extend(d['id'] for d in page['deployments'])
+            self.assertNotIn('log_entries', page['deployments'][0])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        # From the most recent, ties broken by ID, without duplicates
+        self.assertEqual(list(range(29, 9, -1)), seen)
+
+        self._set_query('repository=my repo&since=2016-01-01T10:00:00&until=2016-01-01T12:00:00&fields=id,username,log_entries')
+        page = json.loads(api.deployments_history(self.session))
+        self.assertEqual([23, 22, 21, 20], [d['id'] for d in page['deployments']])
+        self.assertEqual(set(['id', 'username', 'log_entries']), set(page['deployments'][0].keys()))
+        self.assertEqual('username', page['deployments'][0]['username'])
+
+    def test_deployments_history_filters(self):
+        self._set_query('status=COMPLETE,FAILED&user_id=1&fields=id,status')
+        page = json.loads(api.deployments_history(self.session))
+        self.assertEqual(set([1, 3]), set(d['id'] for d in page['deployments']))
+        self.assertIsNone(page['next_cursor'])
+        # Only the readable environments
+        request.account = self.session.query(m.User).get(1)
+        self._set_query('')
+        self.assertEqual([], json.loads(api.deployments_history(self.session))['deployments'])
+        for query in ['fields=id,password', 'limit=abc', 'cursor=notacursor', 'since=yesterday']:
+            self._set_query(query)
+            with self.assertRaises(HTTPError) as e:
+                api.deployments_history(self.session)
+            self.assertEqual(400, e.exception.status_code)
+
+    def test_deployment_logs(self):
+        self.session.add_all([m.LogEntry(id=i, deploy_id=2, message="entry {}".format(i)) for i in range(2, 8)])
+        self.session.commit()
+        self._set_query('after=3&limit=2')
+        parsed = json.loads(api.deployment_logs(2, self.session))
+        self.assertEqual(["entry 4", "entry 5"], [e['message'] for e in parsed['log_entries']])
+        self.assertEqual(5, parsed['last_id'])
+        self.assertEqual('DEPLOY', parsed['status'])
+        self._set_query('after=7')
+        self.assertEqual([], json.loads(api.deployment_logs(2, self.session))['log_entries'])
+        # Only for readable environments
+        request.account = self.session.query(m.User).get(1)
+        with self.assertRaises(HTTPError) as e:
+            api.deployment_logs(3, self.session)
+        self.assertEqual(403, e.exception.status_code)
+
+    def test_deployment_logs_long_polling(self):
+        def write():
+            time.sleep(0.2)
+            logbuffer.insert_rows([{'deploy_id': 2, 'date': datetime.datetime.now(), 'severity': 'info', 'message': 'new entry'}])
+        writer = threading.Thread(target=write)
+        writer.start()
+        self._set_query('after=1&wait=10')
+        start = time.time()
+        parsed = json.loads(api.deployment_logs(2, self.session))
+        writer.join()
+        self.assertEqual(["new entry"], [e['message'] for e in parsed['log_entries']])
+        self.assertLess(time.time() - start, 5)
+        # Finished deployments do not wait
+        self._set_query('after=1&wait=10')
+        start = time.time()
+        self.assertEqual([], json.loads(api.deployment_logs(1, self.session))['log_entries'])
+        self.assertLess(time.time() - start, 5)
+
+    @mock.patch('deployment.api._logs_waiters', threading.BoundedSemaphore(1))
+    def test_deployment_logs_waiters_limit(self):
+        api._logs_waiters.acquire()
+        self._set_query('after=1&wait=10')
+        start = time.time()
+        self.assertEqual([], json.loads(api.deployment_logs(2, self.session))['log_entries'])
+        self.assertLess(time.time() - start, 5)
+
     def test_diff_requires_login(self):
         # The default user should not be able to read diff
         user = self.session.query(m.User).filter_by(username="default").one()
@@ -0,0 +1,73 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+import threading
+import time
+import unittest
+
+import requests
+
+from deployment import apiserver
+
+
+def _app(environ, start_response):
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(0.5)
+    body = "{}:{}".format(environ['REMOTE_ADDR'], environ['REMOTE_PORT'])
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class TestCherryPyServer(unittest.TestCase):
+
+    def setUp(self):
+        config = apiserver.ServerConfig('cherrypy', threads=2, backlog=4, timeout=2, shutdown_timeout=5)
+        self.server = apiserver.build_server("127.0.0.1", 0, _app, config)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        for _ in range(50):
+            if self.server.ready:
+                break
+            time.sleep(0.1)
+        self.url = "http://127.0.0.1:{}".format(self.server.port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join(10)
+
+    def test_keep_alive(self):
+        session = requests.Session()
+        first = session.get(self.url + "/")
+        second = session.get(self.url + "/")
+        self.assertEqual(200, first.status_code)
+        # Same client port: the connection was reused
+        self.assertEqual(first.text, second.text)
+
+    def test_shutdown_drains_requests(self):
+        responses = []
+        client = threading.Thread(target=lambda: responses.append(requests.get(self.url + "/slow")))
+        client.start()
+        time.sleep(0.2)
+        self.server.shutdown()
+        client.join(5)
+        self.assertEqual([200], [r.status_code for r in responses])
+
+
+class TestServerConfig(unittest.TestCase):
+
+    def test_from_config(self):
+        config = ConfigParser()
+        config.readfp(StringIO("[general]\napi_server=cherrypy\napi_server_threads=8\n"))
+        server_config = apiserver.ServerConfig.from_config(config)
+        self.assertEqual('cherrypy', server_config.backend)
+        self.assertEqual(8, server_config.threads)
+        self.assertEqual(64, server_config.backlog)
+
+    def test_default(self):
+        config = ConfigParser()
+        config.readfp(StringIO("[general]\n"))
+        self.assertEqual('wsgiref', apiserver.ServerConfig.from_config(config).backend)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            apiserver.ServerConfig('nginx')
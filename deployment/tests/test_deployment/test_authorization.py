@@ -56,3 +56,36 @@ class TestPermissions(unittest.TestCase):
                        authorization.SuperAdmin(), authorization.Impersonate(), authorization.ReadAllEnvironments()]
         for permission in permissions:
             self.assertTrue(permission.implies(permission))
+
+
+class TestPermissionIndex(unittest.TestCase):
+
+    ROLES = [
+        {},
+        {'read': [1]},
+        {'deploy_business_hours': [1, 2], 'read': [3]},
+        {'deploy': [2]},
+        {'impersonate': True, 'read': [4]},
+        {'deployer': True},
+        {'admin': True},
+    ]
+
+    CHECKS = [authorization.Default(), authorization.ReadAllEnvironments(), authorization.SuperAdmin(),
+              authorization.Impersonate(), authorization.Deployer()] + \
+        [klass(env_id) for klass in (authorization.Read, authorization.DeployBusinessHours, authorization.Deploy)
+         for env_id in range(1, 5)]
+
+    def test_same_as_implies(self):
+        for i, role in enumerate(self.ROLES):
+            for other in self.ROLES[i:]:
+                permissions = authorization.permissions_from_dict(role) + authorization.permissions_from_dict(other)
+                index = authorization.PermissionIndex(permissions)
+                for check in self.CHECKS:
+                    expected = any(p.implies(check) for p in permissions)
+                    self.assertEqual(expected, index.allows(check), "{} + {}: {}".format(role, other, type(check).__name__))
+
+    def test_readable_environments(self):
+        index = authorization.PermissionIndex(authorization.permissions_from_dict(
+            {'deploy_business_hours': [1, 2], 'read': [3], 'deploy': [2, 5]}))
+        self.assertEqual(frozenset([1, 2, 3, 5]), index.readable_environments)
+        self.assertEqual(frozenset([2, 5]), index.deploy)
@@ -0,0 +1,139 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import datetime
+import threading
+import time
+import unittest
+
+from deployment import samodels as m, database, execution, gitutils, releasecache, topology
+from deployment.checkreleases import CheckReleasesWorker, list_targets
+from deployment.instancehealth import InstanceHealth
+
+try:
+    from unittest import mock
+except ImportError as e:
+    import mock
+
+
+def _release(commit):
+    date = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    return execution.ReleaseStatus.release(gitutils.Release("master", commit, date, "/path"))
+
+
+class TestCheckReleases(unittest.TestCase):
+
+    def setUp(self):
+        database.init_db("sqlite:////tmp/test_checkreleases.db")
+        database.drop_all()
+        database.create_all()
+        with database.session_scope() as session:
+            servers = [m.Server(id=i, name="server-{}".format(i), activated=(i != 3)) for i in range(4)]
+            clusters = [m.Cluster(id=1, name="cluster-1"), m.Cluster(id=2, name="cluster-2")]
+            for i, server in enumerate(servers):
+                m.ClusterServerAssociation(server_def=server, cluster_def=clusters[i % 2])
+            repository = m.Repository(id=1, name="repo", git_server="git")
+            session.add_all([
+                m.Environment(id=1, repository=repository, name="prod", target_path="/path", clusters=clusters),
+                m.Environment(id=2, repository=repository, name="dev", target_path="/path", clusters=[clusters[0]]),
+            ])
+        self.health = InstanceHealth()
+        releasecache.cache.clear()
+        topology.service.reset()
+
+    def tearDown(self):
+        topology.service.reset()
+        database.drop_all()
+        database.stop_engine()
+
+    def test_list_targets(self):
+        targets = list_targets(topology.service.current(), ignore_envs=["dev"])
+        self.assertEqual(["server-0", "server-1", "server-2"], [t.server for t in targets])
+        self.assertEqual(set(["prod"]), set(t.environment for t in targets))
+
+    @mock.patch('deployment.execution.get_release_status')
+    def test_sweep_in_sync(self, mock_status):
+        mock_status.return_value = _release("abcde")
+        metrics = CheckReleasesWorker(60, [], self.health).sweep()
+        self.assertEqual(0, self.health.get_status()['degraded'])
+        # 3 activated servers in prod, 2 in dev
+        self.assertEqual(5, mock_status.call_count)
+        self.assertEqual(5, metrics['servers'])
+        self.assertEqual(0, metrics['retried'])
+        self.assertEqual(set(["server-0", "server-1", "server-2"]), set(metrics['latencies']['prod'].keys()))
+        self.assertEqual(set(["server-0", "server-2"]), set(metrics['latencies']['dev'].keys()))
+        self.assertEqual(metrics, self.health.get_metrics()['releases'])
+        # The results are shared with the API
+        self.assertIsNotNone(releasecache.cache.get(mock_status.call_args[0][0], "/path"))
+
+    @mock.patch('deployment.execution.get_release_status')
+    def test_sweep_out_of_sync(self, mock_status):
+        mock_status.side_effect = lambda host, path, timeout: _release("abcde" if host.name == "server-0" else "fghij")
+        CheckReleasesWorker(60, ["dev"], self.health).sweep()
+        status = self.health.get_status()
+        self.assertEqual(1, status['degraded'])
+        self.assertEqual(["at least one server is out of sync for repo:[repo] env:[prod]"], status['errors']['releases'])
+        # Back to normal
+        mock_status.side_effect = lambda host, path, timeout: _release("abcde")
+        CheckReleasesWorker(60, ["dev"], self.health).sweep()
+        self.assertEqual(0, self.health.get_status()['degraded'])
+
+    @mock.patch('deployment.execution.get_release_status')
+    def test_sweep_retry(self, mock_status):
+        attempts = {}
+
+        def get_release_status(host, path, timeout):
+            attempts[host.name] = attempts.get(host.name, 0) + 1
+            if host.name == "server-1" and attempts[host.name] == 1:
+                return execution.ReleaseStatus.error("timeout", 2)
+            if host.name == "server-2":
+                # Not retried
+                return execution.ReleaseStatus.error("connection refused", 255)
+            return _release("abcde")
+        mock_status.side_effect = get_release_status
+        worker = CheckReleasesWorker(60, ["dev"], self.health, retry_delay=0)
+        metrics = worker.sweep()
+        # The results of the first pass are published at once, without the server to retry
+        self.assertEqual({"server-0": 1, "server-1": 1, "server-2": 1}, attempts)
+        self.assertEqual(1, metrics['pending_retry'])
+        self.assertEqual(0, self.health.get_status()['degraded'])
+        metrics = worker.retry()
+        self.assertEqual({"server-0": 1, "server-1": 2, "server-2": 1}, attempts)
+        self.assertEqual(1, metrics['retried'])
+        self.assertEqual(0, metrics['pending_retry'])
+        self.assertEqual(0, self.health.get_status()['degraded'])
+        self.assertIsNone(worker.retry())
+
+    @mock.patch('deployment.execution.get_release_status')
+    def test_sweep_no_release(self, mock_status):
+        mock_status.side_effect = lambda host, path, timeout: execution.ReleaseStatus.error("timeout", 2) \
+            if host.name == "server-1" else _release("abcde")
+        worker = CheckReleasesWorker(60, ["dev"], self.health, retry_delay=0)
+        worker.sweep()
+        self.assertEqual(0, self.health.get_status()['degraded'])
+        worker.retry()
+        self.assertEqual(["No release found on server:[server-1] repo:[repo] env:[prod]"], self.health.get_status()['errors']['releases'])
+
+    @mock.patch('deployment.execution.get_release_status')
+    def test_retry_scheduled(self, mock_status):
+        attempts = []
+
+        def get_release_status(host, path, timeout):
+            attempts.append(host.name)
+            if host.name == "server-1" and attempts.count("server-1") == 1:
+                return execution.ReleaseStatus.error("timeout", 2)
+            return _release("abcde")
+        mock_status.side_effect = get_release_status
+        worker = CheckReleasesWorker(60, ["dev"], self.health, retry_delay=0.1)
+        thread = threading.Thread(target=worker.start)
+        thread.start()
+        try:
+            for _ in range(50):
+                if attempts.count("server-1") == 2:
+                    break
+                time.sleep(0.1)
+        finally:
+            worker.stop()
+            thread.join(5)
+        # Retried before the next sweep
+        self.assertEqual(2, attempts.count("server-1"))
+        self.assertEqual(1, attempts.count("server-0"))
+        self.assertEqual(1, self.health.get_metrics()['releases']['retried'])
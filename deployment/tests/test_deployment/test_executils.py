@@ -1,14 +1,29 @@
 # Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
 # vim: set noexpandtab:
+import functools
+import os
+import shutil
+import tempfile
+import time
 from unittest import TestCase
 
 from Queue import Queue
+from threading import Thread
+
+import mock
 
 from deployment import executils
 
 
 class Testexecutils(TestCase):
 
+	def setUp(self):
+		self.marker = tempfile.mktemp(prefix='deployertests-')
+
+	def tearDown(self):
+		if os.path.exists(self.marker):
+			os.remove(self.marker)
+
 	def test_exec_cmd_with_timeout(self):
 		status, stdout, stderr = executils.exec_cmd("sleep 1", timeout=0.1, current_working_directory='/tmp')
 		self.assertEqual(1, status)
@@ -37,3 +52,156 @@ class Testexecutils(TestCase):
 		status, stdout, stderr = executils.exec_cmd("echo 'hey' 1>&2", timeout=0.1, current_working_directory='/tmp')
 		self.assertEqual('hey\n', stderr)
 		self.assertEqual('', stdout)
+
+
+	def test_exec_cmd_does_not_wait_for_eof(self):
+		# The background process keeps the output pipes open after the shell exits
+		start = time.time()
+		status, stdout, stderr = executils.exec_cmd("sleep 3 & echo 'done'", timeout=5, current_working_directory='/tmp')
+		self.assertEqual(0, status)
+		self.assertEqual('done\n', stdout)
+		self.assertTrue(time.time() - start < 1)
+
+	def test_exec_cmd_timeout_kills_process_group(self):
+		status, stdout, stderr = executils.exec_cmd("(sleep 3; echo 'still alive' > {}) & wait".format(self.marker), timeout=0.2, current_working_directory='/tmp')
+		self.assertEqual(1, status)
+		time.sleep(3.2)
+		self.assertFalse(os.path.exists(self.marker))
+
+	def test_exec_cmd_on_output(self):
+		chunks = []
+		status, stdout, stderr = executils.exec_cmd("echo 'a'; echo 'b' 1>&2; printf 'c'", timeout=1, current_working_directory='/tmp',
+		                                            on_output=lambda stream, data: chunks.append((stream, data)))
+		self.assertEqual(0, status)
+		self.assertEqual('a\nc', stdout)
+		self.assertEqual('a\nc', "".join(data for stream, data in chunks if stream == 'stdout'))
+		self.assertEqual([('stderr', 'b\n')], [c for c in chunks if c[0] == 'stderr'])
+
+	def test_exec_cmd_on_output_error(self):
+		def on_output(stream, data):
+			raise ValueError("broken callback")
+		results = []
+		other = Thread(target=lambda: results.append(executils.exec_cmd("sleep 0.3; echo 'other'", timeout=5, current_working_directory='/tmp')))
+		other.start()
+		status, stdout, stderr = executils.exec_cmd("echo 'a'; sleep 3", timeout=5, current_working_directory='/tmp', on_output=on_output)
+		self.assertEqual(1, status)
+		self.assertIn("broken callback", stderr)
+		# The other commands are still supervised
+		other.join(5)
+		self.assertEqual([(0, 'other\n', '')], results)
+
+	def test_output_collector_spill(self):
+		output = executils.OutputCollector(max_size=10)
+		for i in range(5):
+			output.write("line {}\n".format(i))
+		output.close()
+		self.assertTrue(output.getvalue().startswith("line 4\n"))
+		self.assertIn(output.spill_path, output.getvalue())
+		with open(output.spill_path) as f:
+			self.assertEqual("".join("line {}\n".format(i) for i in range(5)), f.read())
+		path = output.spill_path
+		output.discard()
+		self.assertFalse(os.path.exists(path))
+		self.assertIsNone(output.spill_path)
+		self.assertTrue(output.getvalue().startswith("line 4\n"))
+
+	@mock.patch('deployment.executils.OutputCollector', functools.partial(executils.OutputCollector, max_size=10))
+	def test_exec_cmd_spill_kept_on_failure(self):
+		spill_dir = tempfile.mkdtemp()
+		try:
+			with mock.patch('tempfile.tempdir', spill_dir):
+				status, stdout, stderr = executils.exec_cmd("seq 100", timeout=1, current_working_directory='/tmp')
+				self.assertEqual(0, status)
+				self.assertEqual([], os.listdir(spill_dir))
+				status, stdout, stderr = executils.exec_cmd("seq 100; false", timeout=1, current_working_directory='/tmp')
+				self.assertEqual(1, status)
+				self.assertEqual(1, len(os.listdir(spill_dir)))
+				self.assertIn(spill_dir, stdout)
+		finally:
+			shutil.rmtree(spill_dir)
+
+	@mock.patch('deployment.executils.run_cmd_by_ssh')
+	def test_run_cmds_by_ssh(self, mock_ssh):
+		# Run the batch script locally instead of through SSH
+		mock_ssh.side_effect = lambda host, cmd, timeout: executils.exec_cmd(['sh', '-c'] + cmd, timeout=timeout)
+		host = executils.Host("some-server", "scaleweb", 22)
+		cmds = [['echo', 'hey'], ['cd', '/', '&&', 'echo', 'oops', '1>&2', '&&', 'false'], ['pwd']]
+		results = executils.run_cmds_by_ssh(host, cmds, timeout=5)
+		self.assertEqual(1, mock_ssh.call_count)
+		self.assertEqual([(0, 'hey\n', ''), (1, '', 'oops\n')], results[:2])
+		# Each command runs in its own subshell: 'cd' does not leak
+		self.assertEqual(0, results[2][0])
+		self.assertNotEqual('/\n', results[2][1])
+		results = executils.run_cmds_by_ssh(host, cmds, timeout=5, stop_on_error=True)
+		self.assertEqual([(0, 'hey\n', ''), (1, '', 'oops\n')], results)
+
+	@mock.patch('deployment.executils.run_cmd_by_ssh')
+	def test_run_cmds_by_ssh_cleanup(self, mock_ssh):
+		mock_ssh.side_effect = lambda host, cmd, timeout: executils.exec_cmd(['sh', '-c'] + cmd, timeout=timeout)
+		host = executils.Host("some-server", "scaleweb", 22)
+		with open(self.marker, 'w'):
+			pass
+		cmds = [['false'], ['echo', 'hey']]
+		results = executils.run_cmds_by_ssh(host, cmds, timeout=5, stop_on_error=True, cleanup_cmd=['rm', '-f', self.marker])
+		self.assertEqual([(1, '', '')], results)
+		self.assertFalse(os.path.exists(self.marker))
+
+	@mock.patch('deployment.executils.run_cmd_by_ssh', return_value=(255, '', 'ssh: connection refused'))
+	def test_run_cmds_by_ssh_connection_error(self, mock_ssh):
+		host = executils.Host("some-server", "scaleweb", 22)
+		results = executils.run_cmds_by_ssh(host, [['echo', 'hey'], ['pwd']])
+		self.assertEqual([(255, '', 'ssh: connection refused')], results)
+
+
+class TestSSHConnectionSharing(TestCase):
+
+	def setUp(self):
+		self.host = executils.Host("fr-hq-deployment-01", "scaleweb", 22)
+
+	def tearDown(self):
+		executils._ssh_connection_sharing = None
+
+	def test_host_key(self):
+		self.assertEqual(self.host, executils.Host("fr-hq-deployment-01", "scaleweb", 22))
+		self.assertNotEqual(self.host, executils.Host("fr-hq-deployment-01", "scaleweb", 2222))
+		self.assertEqual(1, len(set([self.host, executils.Host("fr-hq-deployment-01", "scaleweb", 22)])))
+
+	@mock.patch('deployment.executils.exec_cmd', return_value=(0, "", ""))
+	def test_disabled(self, mock_exec):
+		executils.run_cmd_by_ssh(self.host, ['ls'])
+		mock_exec.assert_called_with(['ssh', 'scaleweb@fr-hq-deployment-01', '-p', '22', 'ls'], timeout=900)
+		self.assertEqual('ssh -p 22', executils.ssh_transport(self.host))
+
+	@mock.patch('os.unlink')
+	@mock.patch('os.path.exists', return_value=True)
+	@mock.patch('subprocess.call', side_effect=[255, 0, 0])
+	@mock.patch('deployment.executils.exec_cmd', return_value=(0, "", ""))
+	def test_master_is_reused(self, mock_exec, mock_call, mock_exists, mock_unlink):
+		executils.enable_ssh_connection_sharing('/tmp/deployertests-ssh', idle_timeout=60)
+		executils.run_cmd_by_ssh(self.host, ['ls'])
+		executils.run_cmd_by_ssh(self.host, ['ls'])
+		# The stale socket was checked and removed, then only one master connection was started
+		self.assertIn('check', mock_call.call_args_list[0][0][0])
+		self.assertTrue(mock_unlink.called)
+		self.assertIn('ControlPersist=60', mock_call.call_args[0][0])
+		self.assertEqual(2, mock_call.call_count)
+		control_path = executils._ssh_connection_sharing.control_path(self.host)
+		mock_exec.assert_called_with(
+			['ssh', 'scaleweb@fr-hq-deployment-01', '-p', '22', '-o', 'ControlMaster=no', '-o', 'ControlPath={}'.format(control_path), 'ls'],
+			timeout=900)
+		self.assertIn('ControlPath={}'.format(control_path), executils.ssh_transport(self.host))
+		executils.close_ssh_connections()
+		self.assertIn('exit', mock_call.call_args[0][0])
+
+	@mock.patch('os.path.exists', return_value=True)
+	@mock.patch('subprocess.call', return_value=0)
+	@mock.patch('deployment.executils.exec_cmd', return_value=(0, "", ""))
+	def test_running_master_not_restarted(self, mock_exec, mock_call, mock_exists):
+		executils.enable_ssh_connection_sharing('/tmp/deployertests-ssh', idle_timeout=60)
+		executils.run_cmd_by_ssh(self.host, ['ls'])
+		# After a command longer than the idle timeout, the master is still there
+		executils._ssh_connection_sharing._last_used[self.host] -= 120
+		executils.run_cmd_by_ssh(self.host, ['ls'])
+		for call in mock_call.call_args_list:
+			self.assertIn('check', call[0][0])
+			self.assertNotIn('ControlMaster=yes', call[0][0])
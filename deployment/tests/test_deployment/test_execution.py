@@ -5,8 +5,9 @@ import os
 import shutil
 import datetime
 import json
+import threading
 
-from deployment import samodels as m, execution, executils, database
+from deployment import samodels as m, execution, executils, database, haproxyapi
 
 from freezegun import freeze_time
 
@@ -67,9 +68,81 @@ class TestDeployment(unittest.TestCase):
     def test_run_step_no_abort_on_error(self):
         execution.run_step(self.deployment, self._dummy_step, raise_exception=False, log_error=True, _abort_on_error=False, _session=self.session)
 
+    @mock.patch('deployment.execution.run_step')
+    def test_cluster_orchestration_batches(self, mock_run_step):
+        clusters = [m.Cluster(id=i, name=str(i), haproxy_host="vip") for i in range(5)]
+        enabled = set(clusters)
+        drained = []
+
+        def run_step(deployment, step, step_clusters, haproxy_auth, *args):
+            if step == execution.disable_clusters:
+                enabled.difference_update(step_clusters)
+            elif step == execution.enable_clusters:
+                enabled.update(step_clusters)
+            elif step == execution.wait_clusters_drained:
+                drained.append(step_clusters)
+        mock_run_step.side_effect = run_step
+
+        batches = []
+        for batch in self.deployment._cluster_orchestration(clusters, "secret", batch_size=2):
+            # Some clusters are always serving, and they all run the same version
+            self.assertTrue(len(enabled) > 0)
+            updated = sum(batches, [])
+            self.assertTrue(all(c in updated for c in enabled) or all(c not in updated for c in enabled))
+            # The clusters to update have finished their sessions
+            self.assertEqual(batch, drained[-1])
+            batches.append(batch)
+        self.assertEqual([[clusters[4], clusters[3]], [clusters[2], clusters[1]], [clusters[0]]], batches)
+        self.assertEqual(set(clusters), enabled)
+
 
 class TestUtils(unittest.TestCase):
 
+    def test_rollout_batch_size(self):
+        self.assertEqual(1, m.rollout_batch_size('serial', 10))
+        self.assertEqual(3, m.rollout_batch_size('3', 10))
+        self.assertEqual(5, m.rollout_batch_size('50%', 10))
+        self.assertEqual(1, m.rollout_batch_size('10%', 4))
+        # At least one cluster keeps serving
+        self.assertEqual(9, m.rollout_batch_size('100%', 10))
+        self.assertEqual(1, m.rollout_batch_size('3', 1))
+        for invalid in ('parallel', '0', '-1', '150%'):
+            with self.assertRaises(ValueError):
+                m.rollout_batch_size(invalid, 10)
+
+    def _cluster(self):
+        cluster = m.Cluster(id=1, name="1", haproxy_host="fr-hq-vip-01,fr-hq-vip-02")
+        m.ClusterServerAssociation(server_def=m.Server(id=1, name='fr-hq-server-01'), cluster_def=cluster, haproxy_key="BACKEND,01")
+        return cluster
+
+    @mock.patch('deployment.haproxyapi.haproxy.snapshot', autospec=True)
+    def test_wait_clusters_up(self, mock_snapshot):
+        statuses = {'fr-hq-vip-01': ['MAINT', 'DOWN 1/2', 'UP'], 'fr-hq-vip-02': ['UP']}
+        mock_snapshot.side_effect = lambda con, max_age, timeout: haproxyapi.StatsSnapshot(
+            [{'pxname': 'BACKEND', 'svname': '01', 'status': statuses[con.url].pop(0)}])
+        list(execution.wait_clusters_up([self._cluster()], "secret", interval=0))
+        self.assertEqual({'fr-hq-vip-01': [], 'fr-hq-vip-02': []}, statuses)
+
+        mock_snapshot.side_effect = lambda con, max_age, timeout: haproxyapi.StatsSnapshot(
+            [{'pxname': 'BACKEND', 'svname': '01', 'status': 'MAINT'}])
+        with self.assertRaises(execution.UnexpectedHAproxyServerStatus):
+            list(execution.wait_clusters_up([self._cluster()], "secret", timeout=0.05, interval=0.01))
+
+    @mock.patch('deployment.haproxyapi.haproxy.snapshot', autospec=True)
+    def test_wait_clusters_drained(self, mock_snapshot):
+        sessions = ['12', '3', '0']
+        mock_snapshot.side_effect = lambda con, max_age, timeout: haproxyapi.StatsSnapshot(
+            [{'pxname': 'BACKEND', 'svname': '01', 'status': 'MAINT', 'scur': sessions.pop(0) if con.url == 'fr-hq-vip-01' else '0'}])
+        entries = list(execution.wait_clusters_drained([self._cluster()], "secret", max_sessions=1, interval=0))
+        self.assertEqual([], sessions)
+        self.assertEqual("info", entries[1].severity)
+
+        # Not drained in time: only a warning
+        mock_snapshot.side_effect = lambda con, max_age, timeout: haproxyapi.StatsSnapshot(
+            [{'pxname': 'BACKEND', 'svname': '01', 'status': 'MAINT', 'scur': '5'}])
+        entries = list(execution.wait_clusters_drained([self._cluster()], "secret", max_sessions=1, timeout=0.05, interval=0.01))
+        self.assertEqual("warn", entries[1].severity)
+
     def test_capture_only_stdout(self):
         entries = execution.capture("lambda", lambda x: 'stdout', 42)
         self.assertEqual(1, len(entries))
@@ -95,36 +168,80 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(execution.Severity.ERROR.format(), entries[1].severity)
         self.assertEqual(execution.Severity.ERROR.format(), entries[2].severity)
 
-    @mock.patch('deployment.haproxyapi.haproxy')
+    @mock.patch('deployment.execution.haproxy', autospec=True)
     def test_haproxy_action_unnormalized_keys(self, mock):
         with self.assertRaises(execution.InvalidHAProxyKeyFormat):
             execution.haproxy_action("fr-hq-vip-01", ["BADKEY"], "secret", "UP", execution.HAProxyAction.DISABLE)
 
+    def _snapshot(self, status):
+        return haproxyapi.StatsSnapshot([{'pxname': 'BACKEND', 'svname': server, 'status': status} for server in ('SERVER-01', 'SERVER-02')])
+
     @mock.patch('deployment.execution.haproxy', autospec=True)
     def test_haproxy_action_disable(self, mock):
-        mock(None, None).status.side_effect = lambda backend, server: {'status': 'UP'}
-        mock(None, None).disable.side_effect = lambda backend, server: "OK"
+        mock(None, None).snapshot.side_effect = [self._snapshot('UP'), self._snapshot('MAINT')]
+        mock(None, None).post_all.return_value = "OK"
         execution.haproxy_action("fr-hq-vip-01", ["BACKEND,SERVER-01", "BACKEND,SERVER-02"], "secret", "UP", execution.HAProxyAction.DISABLE)
+        # One request for the whole backend
+        mock(None, None).post_all.assert_called_once_with("BACKEND", ["SERVER-01", "SERVER-02"], "disable")
+        # The stats are downloaded once for the checks, and once to verify the result
+        self.assertEqual(2, mock(None, None).snapshot.call_count)
 
     @mock.patch('deployment.execution.haproxy', autospec=True)
     def test_haproxy_action_enable(self, mock):
-        mock(None, None).status.side_effect = lambda backend, server: {'status': 'MAINT'}
-        mock(None, None).enable.side_effect = lambda backend, server: "OK"
-        execution.haproxy_action("fr-hq-vip-01", ["BACKEND,SERVER-01", "BACKEND,SERVER-02"], "secret", "MAINT", execution.HAProxyAction.ENABLE)
+        mock(None, None).snapshot.side_effect = [self._snapshot('MAINT'), self._snapshot('UP')]
+        mock(None, None).post_all.return_value = "OK"
+        execution.haproxy_action("fr-hq-vip-01", [["BACKEND", "SERVER-01"], ["BACKEND", "SERVER-02"]], "secret", "MAINT", execution.HAProxyAction.ENABLE)
+        mock(None, None).post_all.assert_called_once_with("BACKEND", ["SERVER-01", "SERVER-02"], "enable")
+
+    @mock.patch('deployment.execution.haproxy', autospec=True)
+    def test_haproxy_action_nothing_to_do(self, mock):
+        mock(None, None).snapshot.return_value = self._snapshot('UP')
+        execution.haproxy_action("fr-hq-vip-01", ["BACKEND,SERVER-01", "BACKEND,SERVER-02"], "secret", "", execution.HAProxyAction.ENABLE)
+        self.assertFalse(mock(None, None).post_all.called)
+        self.assertEqual(1, mock(None, None).snapshot.call_count)
 
     @mock.patch('deployment.execution.haproxy', autospec=True)
     def test_haproxy_action_unexpected_status(self, mock):
-        mock(None, None).status.side_effect = lambda backend, server: {'status': 'MAINT'}
+        mock(None, None).snapshot.return_value = self._snapshot('MAINT')
         with self.assertRaises(execution.UnexpectedHAproxyServerStatus):
             execution.haproxy_action("fr-hq-vip-01", ["BACKEND,SERVER-01", "BACKEND,SERVER-02"], "secret", "UP", execution.HAProxyAction.ENABLE)
 
     @mock.patch('deployment.execution.haproxy', autospec=True)
     def test_haproxy_action_failed(self, mock):
-        mock(None, None).status.side_effect = lambda backend, server: {'status': 'MAINT'}
-        mock(None, None).enable.side_effect = lambda backend, server: "Error: 42"
+        mock(None, None).snapshot.return_value = self._snapshot('MAINT')
+        mock(None, None).post_all.return_value = "Error: 42"
         with self.assertRaises(execution.UnexpectedHAproxyServerStatus):
             execution.haproxy_action("fr-hq-vip-01", ["BACKEND,SERVER-01", "BACKEND,SERVER-02"], "secret", "MAINT", execution.HAProxyAction.ENABLE)
 
+    @mock.patch('deployment.execution.haproxy', autospec=True)
+    def test_haproxy_action_not_applied(self, mock):
+        # HAProxy answers DONE, but the servers are still UP
+        mock(None, None).snapshot.return_value = self._snapshot('UP')
+        mock(None, None).post_all.return_value = "OK"
+        with self.assertRaises(execution.UnexpectedHAproxyServerStatus):
+            execution.haproxy_action("fr-hq-vip-01", ["BACKEND,SERVER-01", "BACKEND,SERVER-02"], "secret", "UP", execution.HAProxyAction.DISABLE)
+
+    def test_on_haproxy_hosts(self):
+        started = []
+        barrier = threading.Event()
+
+        def action(host):
+            started.append(host)
+            if len(started) == 2:
+                barrier.set()
+            # Only returns if both hosts are handled at the same time
+            self.assertTrue(barrier.wait(5))
+            return host.upper()
+
+        self.assertEqual(["VIP-01", "VIP-02"], execution.on_haproxy_hosts("vip-01,vip-02", action))
+
+    def test_on_haproxy_hosts_error(self):
+        def action(host):
+            if host == "vip-02":
+                raise execution.UnexpectedHAproxyServerStatus("failed")
+        with self.assertRaises(execution.UnexpectedHAproxyServerStatus):
+            execution.on_haproxy_hosts("vip-01,vip-02", action)
+
 
 class TestSteps(unittest.TestCase):
 
@@ -173,7 +290,7 @@ class TestSteps(unittest.TestCase):
         database.drop_all()
         database.stop_engine()
 
-    # Returns the last value of a generator and the log entries it yielded. Asserts that the first value is a string, and all other (except maybe the last one) are of type LogEntry.
+    # Returns the last value of a generator and the log entries it yielded. Asserts that the first value is a string, and all other (except maybe the last one) are of type LogEntry (or OutputChunk, which are ignored).
     def _unwind(self, generator, assert_no_error=False):
         step_description = generator.next()
         self.assertTrue(isinstance(step_description, str) or isinstance(step_description, unicode))
@@ -183,6 +300,8 @@ class TestSteps(unittest.TestCase):
         try:
             while True:
                 entry = generator.next()
+                if isinstance(entry, execution.OutputChunk):
+                    continue
                 if not(isinstance(entry, m.LogEntry)):
                     with self.assertRaises(StopIteration):
                         out = generator.next()
@@ -303,43 +422,145 @@ class TestSteps(unittest.TestCase):
         ])
 
     @freeze_time('2015-11-25 23:00')
-    @mock.patch('deployment.executils.exec_cmd', autospec=True)
+    @mock.patch('deployment.execution.run_cmd_by_ssh', autospec=True)
     @mock.patch('deployment.execution.exec_cmd', autospec=True)
-    def test_sync(self, mock_func, mock_func_2):
-        mock_func.side_effect = lambda *args, **kwargs: (0, "stdout", "stderr")
-        mock_func_2.side_effect = lambda *args, **kwargs: (0, "stdout", "stderr")
+    @mock.patch('deployment.execution.run_cmds_by_ssh', autospec=True)
+    def test_sync(self, mock_batch, mock_exec, mock_ssh):
+        mock_batch.side_effect = lambda host, cmds: [(0, "", ""), (1, "", "No such file"), (0, "", "")]
+        mock_exec.side_effect = lambda *args, **kwargs: (0, "stdout", "stderr")
+        mock_ssh.side_effect = lambda *args, **kwargs: (0, "", "")
         host = executils.Host("fr-hq-deployment-01", "scaleweb", 22)
-        self._unwind(execution.parallel_sync("/home/scaleweb/project", "-cr --delete-after", "master", "abcde", "/home/deploy/project/", [host], 1))
-        mock_func.assert_has_calls([
-            mock.call(["rsync", "-e", "ssh -p 22", "--exclude=.git", "-cr", "--delete-after", "--exclude=.git_release", "/home/deploy/project/", "scaleweb@fr-hq-deployment-01:/home/scaleweb/project/"]),
+        entries = execution.sync("/home/scaleweb/project/", "-cr --delete-after --exclude=.git_release", "master", "abcde",
+                                 "/home/deploy/project/", host)
+        self.assertFalse(any(e.severity == m.Severity.ERROR.format() for e in entries))
+        # The destination is created, the previous release read and the release file written in a single session
+        mock_batch.assert_called_once_with(host, [
+            ['mkdir', '-p', "/home/scaleweb/project/"],
+            ['cat', '/home/scaleweb/project/.git_release'],
+            ['echo', "'master\nabcde\n2015-11-25T23:00:00.000000\n/home/scaleweb/project/\ndeployment in progress'", '>', '/home/scaleweb/project/.git_release'],
         ])
-        mock_func_2.assert_has_calls([
-            mock.call(['ssh', 'scaleweb@fr-hq-deployment-01', '-p', '22', 'mkdir', '-p', "/home/scaleweb/project/"], timeout=600),
-            mock.call(['ssh', 'scaleweb@fr-hq-deployment-01', '-p', '22', 'echo', "'master\nabcde\n2015-11-25T23:00:00.000000\n/home/scaleweb/project/'", '>', '/home/scaleweb/project/.git_release'], timeout=600)
-        ], any_order=True)  # TODO: investiguate the extra calls without parameters
-
-    @mock.patch('deployment.executils.exec_cmd', autospec=True)
-    def test_release_inplace(self, mock_func):
+        mock_exec.assert_called_once_with(["rsync", "-e", "ssh -p 22", "--exclude=.git", "-cr", "--delete-after", "--exclude=.git_release",
+                                           "/home/deploy/project/", "scaleweb@fr-hq-deployment-01:/home/scaleweb/project/"])
+        mock_ssh.assert_called_once_with(host, ['echo', "'master\nabcde\n2015-11-25T23:00:00.000000\n/home/scaleweb/project/'", '>',
+                                                '/home/scaleweb/project/.git_release'])
+
+    @mock.patch('deployment.execution.run_test', return_value=None)
+    @mock.patch('deployment.execution.run_cmds_by_ssh', side_effect=lambda host, cmds, **kwargs: [(0, "stdout", "")] * len(cmds))
+    @mock.patch('deployment.execution.sync', side_effect=lambda *args: [])
+    def test_parallel_rollout(self, mock_sync, mock_script, mock_test):
+        env = self.session.query(m.Environment).get(2)
+        servers = env.clusters[0].activated_servers
+        hosts_servers = [(executils.Host.from_server(s, "scaleweb"), s) for s in servers]
+        released = []
+        _, entries = self._unwind(execution.parallel_rollout(
+            env, "/path", "master", "abcde", "/tmp/project/", hosts_servers, 2,
+            lambda server, date: released.append(server), "deploy@withings.com", None), assert_no_error=True)
+        self.assertItemsEqual(servers, released)
+        self.assertEqual(2, mock_sync.call_count)
+        self.assertEqual(2, mock_script.call_count)
+        self.assertEqual(2, mock_test.call_count)
+
+    @mock.patch('deployment.execution.run_cmds_by_ssh', side_effect=lambda host, cmds, **kwargs: [(1, "", "deploy.sh failed"), (0, "", "")])
+    @mock.patch('deployment.execution.sync', side_effect=lambda *args: [])
+    def test_parallel_rollout_fail_fast(self, mock_sync, mock_script):
+        env = self.session.query(m.Environment).get(2)
+        servers = env.clusters[0].activated_servers
+        hosts_servers = [(executils.Host.from_server(s, "scaleweb"), s) for s in servers]
+        released = []
+        step = execution.parallel_rollout(
+            env, "/path", "master", "abcde", "/tmp/project/", hosts_servers, 1,
+            lambda server, date: released.append(server), "deploy@withings.com", None)
+        with self.assertRaises(execution.DeploymentError):
+            self._unwind(step)
+        # With a parallelism of 1, the second server is never touched
+        self.assertEqual(1, mock_sync.call_count)
+        self.assertEqual([servers[0]], released)
+
+    def test_capture_stream(self):
+        def command(on_output):
+            on_output('stdout', "building...\n")
+            on_output('stderr', "some warning\n")
+            on_output('stdout', "done\n")
+            return (2, "building...\ndone\n", "some warning\n")
+
+        outputs = list(execution.capture_stream("predeploy.sh", command))
+        chunks = [o for o in outputs if isinstance(o, execution.OutputChunk)]
+        entries = [o for o in outputs if isinstance(o, m.LogEntry)]
+        self.assertEqual("building...\nsome warning\ndone\n", "".join(c.data for c in chunks))
+        # The standard output is logged once, while it arrives
+        self.assertEqual(["predeploy.sh: building...\ndone\n", "predeploy.sh: some warning\n", "predeploy.sh: exited with code 2"],
+                         [e.message for e in entries])
+
+    def _release_and_deploy(self, method):
         host = executils.Host("some-server", "scaleweb", 22)
-        self._unwind(execution.release(host, "inplace", "/home/scaleweb", "/home/scaleweb/", "project"))
-        self.assertItemsEqual(mock_func.call_args_list, [])
-
-    @mock.patch('deployment.executils.exec_cmd', autospec=True)
-    def test_release_symlink(self, mock_func):
-        mock_func.side_effect = lambda *args, **kwargs: (0, "stdout", "stderr")
-        host = executils.Host("fr-hq-deployment-01", "scaleweb", 22)
-        self._unwind(execution.release(host, "symlink", "/home/scaleweb/", "production", "/home/scaleweb/production_releases/20151204_prod_abcde/"))
-        mock_func.assert_called_with(['ssh', 'scaleweb@fr-hq-deployment-01', '-p', '22', 'cd', '/home/scaleweb/', '&&', 'ln', '-s',  "/home/scaleweb/production_releases/20151204_prod_abcde/", 'tmp-link', '&&', 'mv', '-T', 'tmp-link', "/home/scaleweb/production"], timeout=600)
-
-    @mock.patch('deployment.execution.exec_script_remote', autospec=True)
-    @mock.patch('deployment.execution.run_cmd_by_ssh', autospec=True)
-    def test_run_deploy(self, mock_script_func, mock_ssh_func):
-        mock_script_func.side_effect = lambda *args, **kwargs: (0, "stdout", "stderr")
-        mock_ssh_func.side_effect = lambda *args, **kwargs: (0, "stdout", "stderr")
-        # Just run the method to catch obvious mistakes
-        # It's too complex to write a robust non-trivial test against this (very simple) method.
+        entries, released = [], None
+        for out in execution.release_and_deploy(host, method, "/home/scaleweb/", "production",
+                                                "/home/scaleweb/production_releases/20151204_prod_abcde/",
+                                                "/home/scaleweb/project", "dev", "abcde"):
+            if isinstance(out, m.LogEntry):
+                entries.append(out)
+            elif isinstance(out, bool):
+                released = out
+        return entries, released
+
+    @mock.patch('deployment.execution.run_cmds_by_ssh', side_effect=lambda host, cmds, **kwargs: [(0, "", "")] * len(cmds))
+    def test_release_and_deploy_symlink(self, mock_batch):
+        entries, released = self._release_and_deploy("symlink")
+        self.assertTrue(released)
+        self.assertFalse(any(e.severity == m.Severity.ERROR.format() for e in entries))
+        cmds = mock_batch.call_args[0][1]
+        self.assertEqual(2, len(cmds))
+        # Atomic switch of the link
+        self.assertEqual(['cd', '/home/scaleweb/', '&&', 'ln', '-s', "/home/scaleweb/production_releases/20151204_prod_abcde/", 'tmp-link',
+                          '&&', 'mv', '-T', 'tmp-link', "/home/scaleweb/production"], cmds[0])
+        self.assertEqual(execution.remote_script_cmd("/home/scaleweb/project", "deploy.sh", ["dev", "some-server", "abcde"]), cmds[1])
+        self.assertTrue(mock_batch.call_args[1]['stop_on_error'])
+        self.assertEqual(['cd', '/home/scaleweb/project', '&&', 'rm', '-f', 'deploy.sh'], mock_batch.call_args[1]['cleanup_cmd'])
+
+    @mock.patch('deployment.execution.run_cmds_by_ssh', side_effect=lambda host, cmds, **kwargs: [(0, "", "")] * len(cmds))
+    def test_release_and_deploy_inplace(self, mock_batch):
+        entries, released = self._release_and_deploy("inplace")
+        self.assertTrue(released)
+        # Nothing to release, only deploy.sh is run
+        cmds = mock_batch.call_args[0][1]
+        self.assertEqual([execution.remote_script_cmd("/home/scaleweb/project", "deploy.sh", ["dev", "some-server", "abcde"])], cmds)
+        self.assertFalse(any('ln' in cmd for cmd in cmds))
+        self.assertFalse(mock_batch.call_args[1]['stop_on_error'])
+        self.assertEqual(['cd', '/home/scaleweb/project', '&&', 'rm', '-f', 'deploy.sh'], mock_batch.call_args[1]['cleanup_cmd'])
+
+    @mock.patch('deployment.execution.run_cmds_by_ssh', side_effect=lambda host, cmds, **kwargs: [(1, "", "ln failed")])
+    def test_release_and_deploy_symlink_failure(self, mock_batch):
+        host = executils.Host("some-server", "scaleweb", 22)
+        entries, released = [], None
+        for out in execution.release_and_deploy(host, "symlink", "/home/scaleweb/", "production",
+                                                "/home/scaleweb/production_releases/20151204_prod_abcde/",
+                                                "/home/scaleweb/project", "dev", "abcde"):
+            if isinstance(out, m.LogEntry):
+                entries.append(out)
+            elif isinstance(out, bool):
+                released = out
+        self.assertFalse(released)
+        self.assertEqual(2, len(mock_batch.call_args[0][1]))
+        self.assertTrue(mock_batch.call_args[1]['stop_on_error'])
+        self.assertEqual(['cd', '/home/scaleweb/project', '&&', 'rm', '-f', 'deploy.sh'], mock_batch.call_args[1]['cleanup_cmd'])
+        self.assertTrue(any(e.severity == m.Severity.ERROR.format() for e in entries))
+
+    @mock.patch('deployment.execution.run_cmds_by_ssh', side_effect=lambda host, cmds, **kwargs: [(0, "", ""), (1, "", "deploy.sh failed")])
+    def test_release_and_deploy_script_failure(self, mock_batch):
         host = executils.Host("some-server", "scaleweb", 22)
-        self._unwind(execution.run_and_delete_deploy(host, '/home/scaleweb/project', 'dev', 'abcde'), assert_no_error=True)
+        entries, released = [], None
+        for out in execution.release_and_deploy(host, "symlink", "/home/scaleweb/", "production",
+                                                "/home/scaleweb/production_releases/20151204_prod_abcde/",
+                                                "/home/scaleweb/project", "dev", "abcde"):
+            if isinstance(out, m.LogEntry):
+                entries.append(out)
+            elif isinstance(out, bool):
+                released = out
+        self.assertTrue(released)
+        # deploy.sh is deleted even though it failed
+        self.assertEqual(['cd', '/home/scaleweb/project', '&&', 'rm', '-f', 'deploy.sh'], mock_batch.call_args[1]['cleanup_cmd'])
+        errors = [e.message for e in entries if e.severity == m.Severity.ERROR.format()]
+        self.assertTrue(any("deploy.sh failed" in message for message in errors))
 
     @mock.patch('deployment.executils.exec_cmd', autospec=True)
     def test_run_tests(self, mock_func):
@@ -348,12 +569,12 @@ class TestSteps(unittest.TestCase):
         host = executils.Host.from_server(env.servers[0], "scaleweb")
 
         # Remote
-        report = execution.run_test(env, "master", "abcde", host=host,
+        report = execution.run_test(env.repository.name, env.name, env.target_path, "master", "abcde", host=host,
                                     mail_sender="deploy@withings.com", local=False)
         self.assertEquals(False, report.failed)
 
         # Local
-        report = execution.run_test(env, "master", "abcde", host=host,
+        report = execution.run_test(env.repository.name, env.name, env.target_path, "master", "abcde", host=host,
                                     mail_sender="deploy@withings.com", local=True,
                                     local_repo_path="/home/deploy/project")
         self.assertIsNone(report)
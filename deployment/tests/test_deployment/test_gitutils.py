@@ -7,8 +7,9 @@ import os
 from datetime import datetime
 
 import git
+import mock
 
-from deployment import gitutils, filelock
+from deployment import gitutils, filelock, commitindex
 
 
 class TestGitUtils(unittest.TestCase):
@@ -19,6 +20,8 @@ class TestGitUtils(unittest.TestCase):
         self._create_bare_repo()
 
     def tearDown(self):
+        gitutils.configure_repository_layout('clone')
+        gitutils.close_repo_handles()
         shutil.rmtree(self.base_path)
 
     def _clone_repo(self):
@@ -69,6 +72,173 @@ class TestGitUtils(unittest.TestCase):
         self.assertEqual(2, len(commits))
         self.assertEqual(u"second commit œ", commits[0].message)
 
+    def test_list_commits_from_index(self):
+        self._commit_and_push_to_base_repo()
+        clone_path = self._clone_repo()
+        repo = gitutils.LocalRepository(clone_path)
+        self.assertTrue(repo._index.exists())
+        with repo._repo() as git_repo:
+            expected = [repo._format_commit(c) for c in git_repo.iter_commits("origin/master")]
+        for got, commit in zip(repo.list_commits("master"), expected):
+            self.assertEqual((commit.message, commit.committer, commit.hexsha, commit.authored_date),
+                             (got.message, got.committer, got.hexsha, got.authored_date))
+        self.assertEqual(expected[1].message, repo.get_commit(self.first_commit_sha[:10]).message)
+
+    @mock.patch('deployment.commitindex.RECORDS_CACHE_SIZE', 1)
+    def test_index_reads_records_on_demand(self):
+        self._commit_and_push_to_base_repo()
+        clone_path = self._clone_repo()
+        repo = gitutils.LocalRepository(clone_path)
+        with repo._repo() as git_repo:
+            expected = [c.message for c in git_repo.iter_commits("origin/master")]
+        self.assertEqual(expected, [c.message for c in repo.list_commits("master")])
+        # Only the last record read is kept in memory
+        self.assertEqual([self.first_commit_sha], list(repo._index._records.keys()))
+
+    def test_fetch_updates_index(self):
+        clone_path = self._clone_repo()
+        self._commit_and_push_to_base_repo()
+        index = commitindex.get_index(os.path.join(clone_path, '.git'))
+        self.assertEqual({}, index.refs())
+        with gitutils.lock_repository_fetch(clone_path) as repo:
+            repo.fetch()
+        self.assertEqual({'refs/remotes/origin/master': self.second_commit_sha}, index.refs())
+        self.assertEqual([self.second_commit_sha, self.first_commit_sha],
+                         [c.hexsha for c in index.walk(self.second_commit_sha)])
+        # Only the new commits are appended
+        with open(index.commits_path) as f:
+            lines = f.readlines()
+        with gitutils.lock_repository_fetch(clone_path) as repo:
+            repo.fetch()
+        with open(index.commits_path) as f:
+            self.assertEqual(lines, f.readlines())
+        commitindex.forget(clone_path)
+        self.assertIsNot(index, commitindex.get_index(os.path.join(clone_path, '.git')))
+
+    def test_repo_handles(self):
+        self._commit_and_push_to_base_repo()
+        clone_path = self._clone_repo()
+        pool = gitutils.RepoHandlePool(max_size=1)
+        with pool.borrow(clone_path) as first:
+            first.commit(self.first_commit_sha).message
+            # Not shared while lent
+            with pool.borrow(clone_path) as second:
+                self.assertIsNot(first, second)
+        # Only the most recently given back is kept
+        self.assertEqual(1, len(pool))
+        with pool.borrow(clone_path) as third:
+            self.assertIs(first, third)
+            # The cat-file process is still running
+            self.assertIsNotNone(third.git.cat_file_all)
+            pool.evict(clone_path)
+        # Lent before the eviction: closed when given back
+        self.assertEqual(0, len(pool))
+        with pool.borrow(clone_path) as fourth:
+            self.assertIsNot(third, fourth)
+        pool.close_all()
+        self.assertEqual(0, len(pool))
+
+    def test_worktree_layout(self):
+        self._commit_and_push_to_base_repo()
+        gitutils.configure_repository_layout('worktree')
+        paths = [os.path.join(self.base_path, name) for name in ("repo_prod", "repo_staging")]
+        for path in paths:
+            with gitutils.lock_repository_clone(self.base_repo_path, path) as repo:
+                self.assertTrue(repo.clone())
+        shared_repo_path = gitutils.mirror_path(paths[0], self.base_repo_path)
+        self.assertTrue(git.Repo(shared_repo_path).bare)
+        self.assertEqual([shared_repo_path] * 2, [gitutils.storage_path(path) for path in paths])
+        self.assertEqual(2, len(gitutils.LocalRepository(paths[1]).list_commits("master")))
+
+        # One fetch lock for all the worktrees, one write lock per worktree
+        with gitutils.lock_repository_fetch(paths[0]):
+            with self.assertRaises(filelock.AlreadyLocked):
+                with gitutils.lock_repository_fetch(paths[1], block=False):
+                    pass
+            with gitutils.lock_repository_write(paths[0]) as first, gitutils.lock_repository_write(paths[1]) as second:
+                first.switch_to(self.first_commit_sha)
+                second.switch_to(self.second_commit_sha)
+        with open(os.path.join(paths[0], "hi.txt")) as f:
+            self.assertEqual("hello there", f.read())
+        with open(os.path.join(paths[1], "hi.txt")) as f:
+            self.assertEqual("how do you do?", f.read())
+
+        # Fetched once for all the environments
+        gitutils.configure_repository_layout('clone')
+        self._commit_and_push_to_base_repo()
+        with gitutils.lock_repository_fetch(paths[0]) as repo:
+            repo.fetch()
+        self.assertEqual(4, len(gitutils.LocalRepository(paths[1]).list_commits("master")))
+
+        shutil.rmtree(paths[0])
+        self.assertEqual(1, gitutils.prune_worktrees(shared_repo_path))
+
+    def _clone_with_policy(self, policy):
+        clone_path = tempfile.mkdtemp(dir=self.base_path, prefix="clone")
+        os.rmdir(clone_path)
+        # Local clones ignore --depth and --filter
+        with gitutils.lock_repository_clone("file://" + self.base_repo_path, clone_path) as repo:
+            repo.clone(policy=policy)
+        return clone_path
+
+    def test_clone_policy(self):
+        self.assertEqual({'depth': 10, 'no_single_branch': True}, gitutils.ClonePolicy(depth=10).clone_kwargs())
+        self.assertEqual({'filter': 'blob:none', 'single_branch': True, 'branch': 'a'},
+                         gitutils.ClonePolicy(filter='blob:none', branches=['b', 'a']).clone_kwargs())
+        self.assertEqual(['+refs/heads/a:refs/remotes/origin/a', '+refs/heads/b:refs/remotes/origin/b'],
+                         gitutils.ClonePolicy(branches=['b', 'a']).refspecs())
+        with self.assertRaises(ValueError):
+            gitutils.ClonePolicy(depth=0)
+        with self.assertRaises(ValueError):
+            gitutils.ClonePolicy(filter='tree:0')
+
+    def test_shallow_clone(self):
+        self._commit_and_push_to_base_repo()
+        clone_path = self._clone_with_policy(gitutils.ClonePolicy(depth=1))
+        repo = gitutils.LocalRepository(clone_path)
+        self.assertEqual(1, len(repo.list_commits("master")))
+        self.assertFalse(repo.has_commit(self.first_commit_sha))
+        with gitutils.lock_repository_fetch(clone_path) as fetch_repo:
+            # Fetched by hexsha
+            self.assertTrue(fetch_repo.ensure_commit(self.first_commit_sha))
+        self.assertEqual("first commit", repo.get_commit(self.first_commit_sha).message)
+        self.assertIn("+how do you do", repo.diff(self.first_commit_sha, self.second_commit_sha))
+
+        clone_path = self._clone_with_policy(gitutils.ClonePolicy(depth=1))
+        repo = gitutils.LocalRepository(clone_path)
+        with gitutils.lock_repository_fetch(clone_path) as fetch_repo:
+            # Abbreviated, found by deepening the history
+            self.assertTrue(fetch_repo.ensure_commit(self.first_commit_sha[:10]))
+            self.assertFalse(fetch_repo.ensure_commit("0" * 40))
+        self.assertEqual(2, len(repo.list_commits("master")))
+        # No depth in the policy anymore
+        with gitutils.lock_repository_fetch(clone_path) as fetch_repo:
+            fetch_repo.fetch(gitutils.ClonePolicy())
+        self.assertFalse(os.path.exists(os.path.join(clone_path, '.git', 'shallow')))
+
+    def test_single_branch_clone(self):
+        self._commit_and_push_to_base_repo()
+        git.Repo(self.base_repo_path).create_head('feature', self.first_commit_sha)
+        clone_path = self._clone_with_policy(gitutils.ClonePolicy(branches=['feature']))
+        refs = [ref.name for ref in git.Repo(clone_path).remotes.origin.refs]
+        self.assertEqual(['origin/feature'], refs)
+        with gitutils.lock_repository_fetch(clone_path) as repo:
+            # Another environment deploys master
+            repo.fetch(gitutils.ClonePolicy(branches=['feature', 'master']))
+        self.assertEqual(2, len(gitutils.LocalRepository(clone_path).list_commits("master")))
+
+    def test_partial_clone(self):
+        self._commit_and_push_to_base_repo()
+        self.repo.git.config('uploadpack.allowFilter', 'true')
+        clone_path = self._clone_with_policy(gitutils.ClonePolicy(filter='blob:none'))
+        self.assertEqual('blob:none', git.Repo(clone_path).git.config('remote.origin.partialclonefilter'))
+        repo = gitutils.LocalRepository(clone_path)
+        self.assertIn("-hello there", repo.diff(self.first_commit_sha, self.second_commit_sha))
+        with gitutils.lock_repository_write(clone_path) as write_repo:
+            write_repo.switch_to(self.first_commit_sha)
+        with open(os.path.join(clone_path, "hi.txt")) as f:
+            self.assertEqual("hello there", f.read())
+
     def test_diff(self):
         self._commit_and_push_to_base_repo()
         clone_path = self._clone_repo()
@@ -0,0 +1,83 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import unittest
+
+from deployment import haproxyapi
+
+try:
+    from unittest import mock
+except ImportError as e:
+    import mock
+
+
+STATS_CSV = """# pxname,svname,scur,status,check_status,
+BACKEND,SERVER-01,3,UP,L7OK,
+BACKEND,SERVER-02,0,MAINT,,
+"""
+
+
+class TestHAProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.session.get.return_value = mock.MagicMock(status_code=200, text=STATS_CSV)
+        self.session.post.return_value = mock.MagicMock(status_code=303, headers={'location': '/;st=DONE'})
+        patcher = mock.patch('deployment.haproxyapi._session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(haproxyapi._snapshots.clear)
+
+    def test_snapshot_is_cached(self):
+        con = haproxyapi.haproxy("http://vip-01/stats", ("user", "password"))
+        self.assertEqual('UP', con.status('BACKEND', 'SERVER-01')['status'])
+        self.assertEqual('3', con.status('BACKEND', 'SERVER-01')['scur'])
+        self.assertEqual('MAINT', con.status('BACKEND', 'SERVER-02')['status'])
+        self.assertEqual("Not found", con.status('BACKEND', 'SERVER-03'))
+        # Shared by all the objects for the same HAProxy
+        haproxyapi.haproxy("http://vip-01/stats", ("user", "password")).status('BACKEND', 'SERVER-01')
+        self.assertEqual(1, self.session.get.call_count)
+        con.snapshot(max_age=0)
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_invalidate_after_action(self):
+        con = haproxyapi.haproxy("http://vip-01/stats", ("user", "password"))
+        con.status('BACKEND', 'SERVER-02')
+        self.assertEqual("OK", con.enable('BACKEND', 'SERVER-02'))
+        con.status('BACKEND', 'SERVER-02')
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_snapshot_error(self):
+        self.session.get.return_value = mock.MagicMock(status_code=401)
+        con = haproxyapi.haproxy("http://vip-01/stats", ("user", "password"))
+        with self.assertRaises(haproxyapi.HAProxyError):
+            con.snapshot()
+
+    def test_post_all(self):
+        con = haproxyapi.haproxy("http://vip-01/stats", ("user", "password"))
+        self.assertEqual("OK", con.disable_all('BACKEND', ['SERVER-01', 'SERVER-02']))
+        self.session.post.assert_called_once_with("http://vip-01/stats", auth=("user", "password"),
+                                                  data='s=SERVER-01&s=SERVER-02&action=disable&b=BACKEND',
+                                                  allow_redirects=False, timeout=haproxyapi.REQUEST_TIMEOUT)
+        self.session.post.return_value = mock.MagicMock(status_code=303, headers={'location': '/;st=PART'})
+        self.assertEqual("Error (/;st=PART)", con.enable_all('BACKEND', ['SERVER-01', 'SERVER-02']))
+
+    @mock.patch('deployment.haproxyapi.time')
+    def test_wait_for_backoff(self, mock_time):
+        now = [0]
+        mock_time.time.side_effect = lambda: now[0]
+
+        def sleep(delay):
+            now[0] += delay
+        mock_time.sleep.side_effect = sleep
+        con = haproxyapi.haproxy("http://vip-01/stats", ("user", "password"))
+        with self.assertRaises(haproxyapi.HAProxyTimeout) as cm:
+            con.wait_up([('BACKEND', 'SERVER-01'), ('BACKEND', 'SERVER-02')], 10, interval=1, backoff=2, max_interval=4)
+        self.assertEqual([1, 2, 4, 3], [c[0][0] for c in mock_time.sleep.call_args_list])
+        # The requests end before the deadline
+        self.assertEqual([10, 9, 7, 3, 1], [c[1]['timeout'] for c in self.session.get.call_args_list])
+        self.assertEqual(["BACKEND/SERVER-02 (MAINT, check none, 0 sessions)"], cm.exception.pending)
+
+    def test_wait_drained(self):
+        con = haproxyapi.haproxy("http://vip-01/stats", ("user", "password"))
+        con.wait_drained([('BACKEND', 'SERVER-01')], 4, 0)
+        with self.assertRaises(haproxyapi.HAProxyTimeout):
+            con.wait_drained([('BACKEND', 'SERVER-01')], 3, 0)
@@ -0,0 +1,87 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import datetime
+import threading
+import unittest
+
+from deployment import samodels as m, database, logbuffer
+
+try:
+    from unittest import mock
+except ImportError as e:
+    import mock
+
+
+class TestLogEntryBuffer(unittest.TestCase):
+
+    def setUp(self):
+        database.init_db("sqlite:////tmp/test_logbuffer.db")
+        database.drop_all()
+        database.create_all()
+        self.session = database.Session()
+        self.session.add(m.DeploymentView(id=1, repository_name="my repo", environment_name="dev", environment_id=1,
+                                          branch="master", commit="abcde", user_id=1, status="QUEUED",
+                                          queued_date=datetime.datetime.now()))
+        self.session.commit()
+        self.view = self.session.query(m.DeploymentView).get(1)
+
+    def tearDown(self):
+        self.session.rollback()
+        self.session.close()
+        database.drop_all()
+        database.stop_engine()
+
+    def _stored_messages(self):
+        with database.session_scope() as session:
+            return [e.message for e in session.query(m.LogEntry).filter_by(deploy_id=1).order_by(m.LogEntry.id)]
+
+    def test_flush(self):
+        insert_rows = mock.Mock(side_effect=logbuffer.insert_rows)
+        buf = logbuffer.LogEntryBuffer(self.view, insert_rows=insert_rows, max_delay=60)
+        for i in range(3):
+            buf.add(m.LogEntry("entry {}".format(i)))
+        # Visible in the view right away
+        self.assertEqual(["entry 0", "entry 1", "entry 2"], [e.message for e in self.view.log_entries])
+        buf.flush(wait=True)
+        self.assertEqual(1, insert_rows.call_count)
+        self.assertEqual(["entry 0", "entry 1", "entry 2"], self._stored_messages())
+        # The ORM does not insert the entries a second time
+        self.session.commit()
+        buf.close()
+        self.assertEqual(3, len(self._stored_messages()))
+
+    def test_max_entries(self):
+        written = threading.Event()
+
+        def insert_rows(rows):
+            logbuffer.insert_rows(rows)
+            written.set()
+
+        buf = logbuffer.LogEntryBuffer(self.view, insert_rows=insert_rows, max_entries=2, max_delay=60)
+        buf.add(m.LogEntry("entry 0"))
+        buf.add(m.LogEntry("entry 1"))
+        # Written without waiting for max_delay or a flush
+        self.assertTrue(written.wait(5))
+        self.assertEqual(["entry 0", "entry 1"], self._stored_messages())
+        buf.close()
+
+    @mock.patch('deployment.logbuffer.LogEntryBuffer.RETRY_DELAY', 0)
+    def test_retry(self):
+        insert_rows = mock.Mock(side_effect=[Exception("database is gone"), None])
+        buf = logbuffer.LogEntryBuffer(self.view, insert_rows=insert_rows)
+        buf.add(m.LogEntry("entry"))
+        buf.flush(wait=True)
+        self.assertEqual(2, insert_rows.call_count)
+        self.assertEqual(insert_rows.call_args_list[0], insert_rows.call_args_list[1])
+        buf.close()
+
+
+class TestLogWatcher(unittest.TestCase):
+
+    def test_wait(self):
+        watcher = logbuffer.LogWatcher()
+        sequence = watcher.sequence()
+        self.assertFalse(watcher.wait(sequence, 0.1))
+        threading.Timer(0.1, watcher.notify).start()
+        self.assertTrue(watcher.wait(sequence, 10))
+        # Already notified
+        self.assertTrue(watcher.wait(sequence, 0))
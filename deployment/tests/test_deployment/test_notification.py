@@ -2,6 +2,9 @@
 # -*- encoding: utf-8 -*
 
 import unittest
+
+import mock
+
 from deployment import notification
 
 
@@ -27,3 +30,9 @@ class TestNotifierCollection(unittest.TestCase):
     def test_graphite_sanitize(self):
         sanitized = notification.GraphiteNotifier.sanitize_for_graphite("ùgly/name~for+graphite")
         self.assertEqual("--gly-name-for-graphite", sanitized)
+
+    def test_remote_deployer_ignores_output(self):
+        n = notification.RemoteDeployerNotifier(['http://deployer2'], 'deployer', 'token')
+        with mock.patch('deployment.notification.requests') as mock_requests:
+            n.dispatch(notification.Notification('deployment.output', {}))
+        self.assertFalse(mock_requests.post.called)
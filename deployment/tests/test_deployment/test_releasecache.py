@@ -0,0 +1,75 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import datetime
+import threading
+import unittest
+
+from deployment import releasecache, execution, executils, gitutils, samodels as m
+from deployment.notification import Notification
+
+try:
+    from unittest import mock
+except ImportError as e:
+    import mock
+
+
+def _status(commit):
+    return execution.ReleaseStatus.release(gitutils.Release("master", commit, datetime.datetime(2016, 1, 1), "/path"))
+
+
+class TestReleaseStatusCache(unittest.TestCase):
+
+    def setUp(self):
+        self.hosts = [executils.Host("server-{}".format(i), "scaleweb") for i in range(2)]
+        self.targets = [(host, "/path") for host in self.hosts]
+        self.fetch = mock.Mock(side_effect=lambda targets, timeout: [_status("abcde") for _ in targets])
+        self.cache = releasecache.ReleaseStatusCache(self.fetch, ttl=60, max_stale=3600)
+
+    def test_fresh(self):
+        first = self.cache.get_many(self.targets)
+        self.assertEqual(["abcde", "abcde"], [e.status.get_release().commit for e in first])
+        self.assertEqual(self.targets, self.fetch.call_args[0][0])
+        second = self.cache.get_many(self.targets)
+        self.assertEqual(1, self.fetch.call_count)
+        self.assertEqual([e.fetched_at for e in first], [e.fetched_at for e in second])
+        # Force a refresh
+        self.cache.get_many(self.targets, refresh=True)
+        self.assertEqual(2, self.fetch.call_count)
+
+    def test_partial(self):
+        self.cache.put(self.hosts[0], "/path", _status("12345"))
+        out = self.cache.get_many(self.targets)
+        self.assertEqual(["12345", "abcde"], [e.status.get_release().commit for e in out])
+        self.assertEqual([self.targets[1]], self.fetch.call_args[0][0])
+
+    def test_stale_while_revalidate(self):
+        refreshed = threading.Event()
+
+        def fetch(targets, timeout):
+            refreshed.set()
+            return [_status("abcde") for _ in targets]
+        cache = releasecache.ReleaseStatusCache(fetch, ttl=60, max_stale=3600)
+        cache.put(self.hosts[0], "/path", _status("12345"), fetched_at=0)
+        # Too old: read on the server before answering
+        self.assertEqual("abcde", cache.get_many(self.targets[:1])[0].status.get_release().commit)
+        refreshed.clear()
+
+        with mock.patch('deployment.releasecache.time.time', return_value=cache.get(*self.targets[0]).fetched_at + 120):
+            # Stale: answered from the cache, refreshed in the background
+            self.assertEqual("abcde", cache.get_many(self.targets[:1])[0].status.get_release().commit)
+        self.assertTrue(refreshed.wait(5))
+
+    def test_put_keeps_newest(self):
+        self.cache.put(self.hosts[0], "/path", _status("new"), fetched_at=20)
+        self.cache.put(self.hosts[0], "/path", _status("old"), fetched_at=10)
+        self.assertEqual("new", self.cache.get(self.hosts[0], "/path").status.get_release().commit)
+
+    def test_notifier(self):
+        env = m.Environment(id=1, name="dev", target_path="/path", remote_user="scaleweb")
+        view = mock.Mock(environment=env)
+        server = m.Server(id=1, name="server-0", port=22)
+        notifier = releasecache.ReleaseCacheNotifier(self.cache)
+        notifier.dispatch(Notification.released_on_server(view, server, datetime.datetime(2016, 1, 2), "master", "fghij"))
+        entry = self.cache.get(self.hosts[0], "/path")
+        self.assertEqual("fghij", entry.status.get_release().commit)
+        self.assertEqual(0, self.fetch.call_count)
+        self.assertIn('fetched_at', entry.to_dict(1, 1))
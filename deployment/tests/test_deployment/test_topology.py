@@ -0,0 +1,191 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+from contextlib import contextmanager
+import datetime
+import threading
+import time
+import unittest
+
+from sqlalchemy import event
+
+from deployment import samodels as m, database, topology, execution
+from deployment.notification import WebSocketNotifier
+
+try:
+    from unittest import mock
+except ImportError as e:
+    import mock
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements run in the block, in the list it yields."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(database.engine(), "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(database.engine(), "before_cursor_execute", before_cursor_execute)
+
+
+class TestTopology(unittest.TestCase):
+
+    CLUSTERS = 5
+    SERVERS_PER_CLUSTER = 4
+
+    def setUp(self):
+        database.init_db("sqlite:////tmp/test_topology.db")
+        database.drop_all()
+        database.create_all()
+        topology.service.reset()
+        with database.session_scope() as session:
+            backend = m.HaproxyBackend(id=1, name="backend", haproxy_host="vip")
+            clusters = []
+            for i in range(self.CLUSTERS):
+                cluster = m.Cluster(id=i, name="cluster-{}".format(i), haproxy_host="vip", haproxy_backend_def=backend)
+                for j in range(self.SERVERS_PER_CLUSTER):
+                    server_id = i * self.SERVERS_PER_CLUSTER + j
+                    server = m.Server(id=server_id, name="server-{}".format(server_id), activated=(j != 0))
+                    m.ClusterServerAssociation(server_def=server, cluster_def=cluster, haproxy_key="backend,{}".format(server_id))
+                clusters.append(cluster)
+            repository = m.Repository(id=1, name="repo", git_server="git")
+            session.add(m.Environment(id=1, repository=repository, name="prod", target_path="/path", clusters=clusters))
+            session.add(m.User(id=1, email="admin@example.com", username="admin", accountid="a"))
+            session.add_all([
+                m.DeploymentView(id=1, repository_name="repo", environment_name="prod", environment_id=1, branch="master",
+                                 commit="abcde", user_id=1, status="QUEUED", queued_date=datetime.datetime.now()),
+                m.DeploymentView(id=2, repository_name="repo", environment_name="prod", environment_id=1, cluster_id=1, branch="master",
+                                 commit="abcde", user_id=1, status="QUEUED", queued_date=datetime.datetime.now()),
+                m.DeploymentView(id=3, repository_name="repo", environment_name="prod", environment_id=1, server_id=1, branch="master",
+                                 commit="abcde", user_id=1, status="QUEUED", queued_date=datetime.datetime.now()),
+            ])
+        self.session = database.Session()
+
+    def tearDown(self):
+        topology.service.notifier = None
+        topology.service.reset()
+        self.session.close()
+        database.drop_all()
+        database.stop_engine()
+
+    def _walk_environment(self, env):
+        env.repository.name
+        for cluster in env.clusters:
+            cluster.haproxy_backend_def.name
+            cluster.activated_servers
+            for association in cluster.servers:
+                association.server_def.name
+                [c.haproxy_key for c in association.server_def.clusters]
+        return env.servers
+
+    def test_load_environment(self):
+        with count_queries() as statements:
+            env = topology.load_environment(self.session, 1)
+            servers = self._walk_environment(env)
+            m.Environment.__marshmallow__().dump(env)
+            m.Server.__marshmallow__(many=True).dump(servers)
+        self.assertEqual(self.CLUSTERS * self.SERVERS_PER_CLUSTER, len(servers))
+        self.assertLessEqual(len(statements), 4)
+        self.assertIsNone(topology.load_environment(self.session, 42))
+
+    def test_load_environments(self):
+        with count_queries() as statements:
+            envs = topology.load_environments(
+                self.session.query(m.Environment).
+                join(m.Environment.clusters).
+                join(m.Cluster.servers).
+                filter(m.ClusterServerAssociation.server_id == 1))
+            for env in envs:
+                self._walk_environment(env)
+        self.assertEqual(1, len(envs))
+        self.assertLessEqual(len(statements), 4)
+
+    def test_load_deployment(self):
+        for deploy_id, expected_servers in [(1, 20), (2, 4), (3, 1)]:
+            self.session.expunge_all()
+            with count_queries() as statements:
+                view = topology.load_deployment(self.session, deploy_id)
+                # What the deployment does before connecting to the servers
+                list(execution.check_configuration(view))
+                self._walk_environment(view.environment)
+                for cluster in view.target_clusters:
+                    cluster.activated_servers
+                self.assertEqual(expected_servers, len(view.target_servers))
+                view.deactivated_servers
+            self.assertLessEqual(len(statements), 6, "deployment {}".format(deploy_id))
+
+    def test_snapshot(self):
+        snapshot = topology.service.current()
+        self.assertIs(snapshot, topology.service.current())
+        self.assertEqual(set(range(self.CLUSTERS)), set(snapshot.environments[1].cluster_ids))
+        self.assertEqual("repo", snapshot.environments[1].repository_name)
+        self.assertEqual(self.CLUSTERS * self.SERVERS_PER_CLUSTER, len(snapshot.environment_servers(1)))
+        self.assertEqual(((4, "backend,4"), (5, "backend,5"), (6, "backend,6"), (7, "backend,7")), snapshot.clusters[1].servers)
+        self.assertEqual("vip", snapshot.backends[snapshot.clusters[1].haproxy_backend_id].haproxy_host)
+
+    def test_snapshot_changes(self):
+        topology.service.notifier = mock.Mock()
+        before = topology.service.current()
+
+        cluster = self.session.query(m.Cluster).get(1)
+        cluster.name = "renamed"
+        self.session.delete(cluster.servers[0])
+        self.session.query(m.Server).get(0).activated = True
+        self.session.commit()
+
+        after = topology.service.current()
+        self.assertEqual(before.version + 1, after.version)
+        self.assertEqual("renamed", after.clusters[1].name)
+        self.assertEqual([5, 6, 7], [server_id for server_id, _ in after.clusters[1].servers])
+        self.assertTrue(after.servers[0].activated)
+        # Unchanged records are shared, and readers of the old snapshot are not affected
+        self.assertIs(before.clusters[2], after.clusters[2])
+        self.assertEqual("cluster-1", before.clusters[1].name)
+        self.assertEqual(4, len(before.clusters[1].servers))
+        # Other instances are notified, in the background
+        topology.service.wait_notifications()
+        event = topology.service.notifier.dispatch.call_args[0][0]
+        self.assertEqual("topology.changed", event.evt_type)
+        self.assertEqual(set([1]), event.payload['changes']['clusters'])
+        self.assertEqual(set([0]), event.payload['changes']['servers'])
+        self.assertEqual([1], WebSocketNotifier.event_to_websocket(event).payload['changes']['clusters'])
+
+    def test_snapshot_changes_do_not_wait_for_notifiers(self):
+        release = threading.Event()
+        topology.service.notifier = mock.Mock()
+        topology.service.notifier.dispatch.side_effect = lambda event: release.wait(5)
+        topology.service.current()
+        self.session.query(m.Cluster).get(1).name = "renamed"
+        start = time.time()
+        self.session.commit()
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual("renamed", topology.service.current().clusters[1].name)
+        release.set()
+        topology.service.wait_notifications()
+        self.assertEqual(1, topology.service.notifier.dispatch.call_count)
+
+    def test_snapshot_ignores_other_changes(self):
+        version = topology.service.current().version
+        # Rolled back
+        self.session.query(m.Cluster).get(1).name = "renamed"
+        self.session.flush()
+        self.session.rollback()
+        # Not part of the topology
+        env = self.session.query(m.Environment).get(1)
+        self.session.add(m.DeploymentView(id=4, repository_name="repo", environment_name="prod", environment=env, branch="master",
+                                          commit="abcde", user_id=1, status="QUEUED", queued_date=datetime.datetime.now()))
+        self.session.commit()
+        self.assertEqual(version, topology.service.current().version)
+
+    def test_snapshot_remote_change(self):
+        topology.service.notifier = mock.Mock()
+        version = topology.service.current().version
+        # Changed by another instance (hooks do not see it)
+        database.engine().execute(m.Server.__table__.update().where(m.Server.id == 0).values(name="new-name"))
+        topology.service.apply({'servers': [0]}, notify=False)
+        self.assertEqual("new-name", topology.service.current().servers[0].name)
+        self.assertEqual(version + 1, topology.service.current().version)
+        topology.service.wait_notifications()
+        self.assertFalse(topology.service.notifier.dispatch.called)
@@ -0,0 +1,98 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+import threading
+import time
+import unittest
+
+from deployment import worker
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = worker.FetchScheduler(min_interval=0)
+
+    def test_coalesce(self):
+        first = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        second = self.scheduler.request(2, "/nonexistent/repo_prod", "repo", "git", "master")
+        other = self.scheduler.request(3, "/nonexistent/other_prod", "other", "git", "master")
+        self.assertIs(first, second)
+        self.assertEqual([1, 2], list(first.environments.keys()))
+        self.assertEqual("git@git:repo", first.remote_url)
+        self.assertIs(first, self.scheduler.get(timeout=0))
+        self.assertIs(other, self.scheduler.get(timeout=0))
+        self.assertIsNone(self.scheduler.get(timeout=0))
+
+    def test_request_during_fetch(self):
+        fetch = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        self.assertIs(fetch, self.scheduler.get(timeout=0))
+        # The ongoing fetch may not see the new commits: one more fetch, shared by the new requests
+        follow_up = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        self.assertIs(follow_up, self.scheduler.request(2, "/nonexistent/repo_prod", "repo", "git", "master"))
+        self.assertIsNot(fetch, follow_up)
+        self.assertIsNone(self.scheduler.get(timeout=0))
+        self.scheduler.done(fetch)
+        self.assertTrue(fetch.wait(0))
+        self.assertIsNone(fetch.error)
+        self.assertIs(follow_up, self.scheduler.get(timeout=0))
+
+    def test_rate_limit(self):
+        self.scheduler.min_interval = 0.3
+        first = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        self.assertIs(first, self.scheduler.get(timeout=0))
+        self.scheduler.done(first)
+        # Same local repository
+        second = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        # Other local repository
+        other = self.scheduler.request(2, "/nonexistent/other_prod", "other", "git", "master")
+        self.assertIs(other, self.scheduler.get(timeout=0))
+        self.assertIsNone(self.scheduler.get(timeout=0.1))
+        self.assertIs(second, self.scheduler.get(timeout=1))
+
+    def test_one_fetch_per_remote(self):
+        # Clone layout: two local repositories of the same remote repository
+        prod = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        staging = self.scheduler.request(2, "/nonexistent/repo_staging", "repo", "git", "master")
+        other = self.scheduler.request(3, "/nonexistent/other_prod", "other", "git", "master")
+        self.assertIsNot(prod, staging)
+        self.assertIs(prod, self.scheduler.get(timeout=0))
+        # Other remote repositories are not delayed
+        self.assertIs(other, self.scheduler.get(timeout=0))
+        self.assertIsNone(self.scheduler.get(timeout=0.1))
+        results = []
+        t = threading.Thread(target=lambda: results.append(self.scheduler.get(timeout=5)))
+        t.start()
+        time.sleep(0.05)
+        self.scheduler.done(prod)
+        t.join(5)
+        self.assertEqual([staging], results)
+
+    def test_waiters(self):
+        fetch = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(fetch.wait(5))) for _ in range(3)]
+        for t in waiters:
+            t.start()
+        self.assertFalse(fetch.wait(0.05))
+        self.scheduler.get(timeout=0)
+        error = Exception("unreachable")
+        self.scheduler.done(fetch, error)
+        for t in waiters:
+            t.join(5)
+        self.assertEqual([True] * 3, results)
+        self.assertIs(error, fetch.error)
+
+    def test_wakeup(self):
+        results = []
+        t = threading.Thread(target=lambda: results.append(self.scheduler.get(timeout=5)))
+        t.start()
+        time.sleep(0.05)
+        fetch = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        t.join(5)
+        self.assertEqual([fetch], results)
+
+    def test_drain(self):
+        fetch = self.scheduler.request(1, "/nonexistent/repo_prod", "repo", "git", "master")
+        self.assertEqual([fetch], self.scheduler.drain())
+        self.assertTrue(fetch.wait(0))
+        self.assertIsNotNone(fetch.error)
+        self.assertIsNone(self.scheduler.get(timeout=0))
@@ -0,0 +1,320 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+"""
+Load the environment -> clusters -> servers graph in a fixed number of queries.
+
+Walking Environment.servers, DeploymentView.target_servers or Cluster.activated_servers on objects
+loaded with the default (lazy) relationships issues one query per cluster and per server.
+The functions below load the whole graph up front (one query per level, whatever the number
+of clusters and servers), so these properties no longer hit the database.
+"""
+from collections import namedtuple
+from logging import getLogger
+from Queue import Queue
+import threading
+
+import sqlalchemy as sa
+from sqlalchemy import event, orm
+
+from . import database, samodels as m
+from .notification import Notification
+
+logger = getLogger(__name__)
+
+
+def environment_options(load=None):
+    """Loader options for the repository, clusters, servers and HAProxy backends of environments.
+
+    Args:
+        load: loader of the relationship leading to the environments (for instance
+            orm.joinedload(m.DeploymentView.environment)), or None when querying m.Environment itself
+
+    Return:
+        a list of options, to pass to Query.options
+    """
+    if load is None:
+        load = orm.Load(m.Environment)
+    return [load.joinedload(m.Environment.repository)] + cluster_options(load.subqueryload(m.Environment.clusters))
+
+
+def cluster_options(load):
+    """Loader options for the servers and HAProxy backend of clusters.
+
+    The clusters of each server are loaded too, as the API returns them along with the servers.
+
+    Args:
+        load: loader of the relationship leading to the clusters
+    """
+    servers = load.subqueryload(m.Cluster.servers).joinedload(m.ClusterServerAssociation.server_def)
+    return [
+        load.joinedload(m.Cluster.haproxy_backend_def),
+        servers.subqueryload(m.Server.clusters),
+    ]
+
+
+def load_environment(session, environment_id):
+    """Return an environment with its whole topology loaded (4 queries), or None."""
+    return session.query(m.Environment).\
+        options(*environment_options()).\
+        filter(m.Environment.id == environment_id).\
+        one_or_none()
+
+
+def load_environments(query):
+    """Run a query on m.Environment, loading the whole topology of the environments (4 queries)."""
+    return query.options(*environment_options()).all()
+
+
+def load_deployment(session, deploy_id):
+    """Return a deployment with its user, and the whole topology of its environment and of its
+    target cluster or server loaded (6 queries), or None.
+    """
+    return session.query(m.DeploymentView).\
+        options(orm.joinedload(m.DeploymentView.user),
+                orm.joinedload(m.DeploymentView.server),
+                *(environment_options(orm.joinedload(m.DeploymentView.environment)) +
+                  cluster_options(orm.joinedload(m.DeploymentView.cluster)))).\
+        filter(m.DeploymentView.id == deploy_id).\
+        one_or_none()
+
+
+# Process-wide snapshot of the topology.
+#
+# The environments, clusters, servers and HAProxy backends change rarely, but are read constantly.
+# TopologyService keeps an immutable copy of them in memory (compact records, linked by IDs).
+# Each change committed to the database (by the API, the inventory synchronization...) is detected
+# by the session hooks below, and a new snapshot is built, reloading only the changed records.
+# Readers just take a reference to the current snapshot: they never lock, and never see a partial update.
+
+ServerRecord = namedtuple('ServerRecord', ['id', 'name', 'port', 'activated'])
+BackendRecord = namedtuple('BackendRecord', ['id', 'name', 'haproxy_host'])
+# servers is a tuple of (server ID, HAProxy key)
+ClusterRecord = namedtuple('ClusterRecord', ['id', 'name', 'haproxy_host', 'haproxy_backend_id', 'rollout_parallelism', 'servers'])
+EnvironmentRecord = namedtuple('EnvironmentRecord', ['id', 'name', 'repository_id', 'repository_name', 'target_path', 'remote_user', 'cluster_ids'])
+
+# Kinds of records, as used in the changes dicts ({kind: set of IDs})
+KINDS = ('environments', 'repositories', 'clusters', 'servers', 'backends')
+
+
+class TopologySnapshot(object):
+    """An immutable view of the topology, identified by its version.
+
+    Args:
+        environments, clusters, servers, backends (dict): records by ID
+    """
+
+    def __init__(self, version, environments, clusters, servers, backends):
+        self.version = version
+        self.environments = environments
+        self.clusters = clusters
+        self.servers = servers
+        self.backends = backends
+
+    def environment_clusters(self, environment_id):
+        env = self.environments.get(environment_id)
+        if env is None:
+            return []
+        return [self.clusters[cluster_id] for cluster_id in env.cluster_ids if cluster_id in self.clusters]
+
+    def environment_servers(self, environment_id):
+        return [self.servers[server_id] for cluster in self.environment_clusters(environment_id)
+                for server_id, _ in cluster.servers if server_id in self.servers]
+
+
+def _load_servers(session, ids=None):
+    q = session.query(m.Server.id, m.Server.name, m.Server.port, m.Server.activated)
+    if ids is not None:
+        q = q.filter(m.Server.id.in_(ids))
+    return dict((row[0], ServerRecord(row[0], row[1], row[2], bool(row[3]))) for row in q)
+
+
+def _load_backends(session, ids=None):
+    q = session.query(m.HaproxyBackend.id, m.HaproxyBackend.name, m.HaproxyBackend.haproxy_host)
+    if ids is not None:
+        q = q.filter(m.HaproxyBackend.id.in_(ids))
+    return dict((row[0], BackendRecord(*row)) for row in q)
+
+
+def _load_clusters(session, ids=None):
+    q = session.query(m.Cluster.id, m.Cluster.name, m.Cluster.haproxy_host, m.Cluster.haproxy_backend_id, m.Cluster.rollout_parallelism)
+    servers = session.query(m.ClusterServerAssociation.cluster_id, m.ClusterServerAssociation.server_id, m.ClusterServerAssociation.haproxy_key).\
+        order_by(m.ClusterServerAssociation.cluster_id, m.ClusterServerAssociation.server_id)
+    if ids is not None:
+        q = q.filter(m.Cluster.id.in_(ids))
+        servers = servers.filter(m.ClusterServerAssociation.cluster_id.in_(ids))
+    by_cluster = {}
+    for cluster_id, server_id, haproxy_key in servers:
+        by_cluster.setdefault(cluster_id, []).append((server_id, haproxy_key))
+    return dict((row[0], ClusterRecord(*(tuple(row) + (tuple(by_cluster.get(row[0], [])),)))) for row in q)
+
+
+def _load_environments(session):
+    links = session.query(m.environments_clusters.c.environment_id, m.environments_clusters.c.cluster_id).\
+        order_by(m.environments_clusters.c.environment_id, m.environments_clusters.c.cluster_id)
+    by_environment = {}
+    for environment_id, cluster_id in links:
+        by_environment.setdefault(environment_id, []).append(cluster_id)
+    q = session.query(m.Environment.id, m.Environment.name, m.Environment.repository_id, m.Repository.name,
+                      m.Environment.target_path, m.Environment.remote_user).\
+        join(m.Environment.repository)
+    return dict((row[0], EnvironmentRecord(*(tuple(row) + (tuple(by_environment.get(row[0], [])),)))) for row in q)
+
+
+def _reload(records, loaded, ids):
+    """Return a copy of records, where the records with the given IDs are replaced by the loaded ones (or removed)."""
+    out = dict(records)
+    for record_id in ids:
+        if record_id in loaded:
+            out[record_id] = loaded[record_id]
+        else:
+            out.pop(record_id, None)
+    return out
+
+
+class TopologyService(object):
+    """Hold the current TopologySnapshot, and build a new one when the topology changes.
+
+    The first snapshot is built on first read.
+    If notifier is set, a topology.changed notification is sent for each local change, so other deployer
+    instances can update their own snapshot. The notifications are dispatched by a background thread: apply
+    runs in the thread that committed the change (an API request, the inventory sync...), which must not wait
+    for the notifiers.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.notifier = None
+        self._notifications = Queue()
+        self._dispatcher = None
+
+    def current(self):
+        """Return the current TopologySnapshot."""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                with database.session_scope() as session:
+                    self._snapshot = TopologySnapshot(1, _load_environments(session), _load_clusters(session),
+                                                      _load_servers(session), _load_backends(session))
+            return self._snapshot
+
+    def apply(self, changes, notify=True):
+        """Build a new snapshot, reloading the changed records.
+
+        Args:
+            changes (dict): IDs of the changed records, by kind (see KINDS)
+            notify (bool): send a topology.changed notification (False for changes made by other deployers)
+        """
+        changes = dict((kind, set(changes.get(kind, ()))) for kind in KINDS)
+        version = None
+        with self._lock:
+            current = self._snapshot
+            if current is not None:
+                try:
+                    self._snapshot = self._rebuild(current, changes)
+                    version = self._snapshot.version
+                except Exception:
+                    logger.exception("Could not update the topology snapshot, it will be rebuilt on next read")
+                    self._snapshot = None
+        if notify and self.notifier is not None:
+            self._notify(Notification.topology_changed(version, changes))
+
+    def _notify(self, notification):
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_notifications, name="topology-notifier")
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+        self._notifications.put(notification)
+
+    def _dispatch_notifications(self):
+        while True:
+            notification = self._notifications.get()
+            try:
+                notifier = self.notifier
+                if notifier is not None:
+                    notifier.dispatch(notification)
+            except Exception:
+                logger.exception("Could not dispatch the topology change")
+            finally:
+                self._notifications.task_done()
+
+    def wait_notifications(self):
+        """Block until the pending notifications are dispatched (mostly for tests)."""
+        self._notifications.join()
+
+    def _rebuild(self, current, changes):
+        with database.session_scope() as session:
+            servers, backends, clusters, environments = current.servers, current.backends, current.clusters, current.environments
+            if changes['servers']:
+                servers = _reload(servers, _load_servers(session, changes['servers']), changes['servers'])
+            if changes['backends']:
+                backends = _reload(backends, _load_backends(session, changes['backends']), changes['backends'])
+            if changes['clusters']:
+                clusters = _reload(clusters, _load_clusters(session, changes['clusters']), changes['clusters'])
+            # There are few environments: reload them all when any environment, repository or link to a cluster changes
+            if changes['environments'] or changes['repositories'] or changes['clusters']:
+                environments = _load_environments(session)
+        return TopologySnapshot(current.version + 1, environments, clusters, servers, backends)
+
+    def reset(self):
+        """Forget the current snapshot (mostly for tests)."""
+        with self._lock:
+            self._snapshot = None
+
+
+service = TopologyService()
+
+
+_TRACKED_CLASSES = {
+    m.Environment: 'environments',
+    m.Repository: 'repositories',
+    m.Cluster: 'clusters',
+    m.Server: 'servers',
+    m.HaproxyBackend: 'backends',
+}
+# Relationships whose changes do not modify the topology
+_IGNORED_ATTRIBUTES = frozenset(['deployments'])
+
+
+def _is_modified(obj):
+    state = sa.inspect(obj)
+    return any(attr.history.has_changes() for attr in state.attrs if attr.key not in _IGNORED_ATTRIBUTES)
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    # The new, dirty and deleted collections still describe the flushed changes at this point
+    changes = session.info.setdefault('topology_changes', {})
+    for obj in session.new | session.deleted:
+        _record_change(changes, obj)
+    for obj in session.dirty:
+        if _is_tracked(obj) and _is_modified(obj):
+            _record_change(changes, obj)
+
+
+def _is_tracked(obj):
+    return type(obj) in _TRACKED_CLASSES or isinstance(obj, m.ClusterServerAssociation)
+
+
+def _record_change(changes, obj):
+    if isinstance(obj, m.ClusterServerAssociation):
+        if obj.cluster_id is not None:
+            changes.setdefault('clusters', set()).add(obj.cluster_id)
+        return
+    kind = _TRACKED_CLASSES.get(type(obj))
+    if kind is not None and obj.id is not None:
+        changes.setdefault(kind, set()).add(obj.id)
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('topology_changes', None)
+    if changes:
+        service.apply(changes)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('topology_changes', None)
@@ -8,11 +8,13 @@ import traceback
 import itertools
 import urlparse
 import datetime
+import threading
+import time
+from collections import OrderedDict
 import requests
 
 from . import execution, notification, gitutils, database, samodels as m
 
-from Queue import Queue, Empty
 
 DEPLOYMENT_JOBS_TUBE = "deployer-deployments"
 
@@ -87,9 +89,125 @@ def handle_autodeploy_notification(repository_name, branch, commit, beanstalk, n
                 logger.exception("Autodeploy: Caught exception when notifying {}:".format(url))
 
 
+class FetchRequest(object):
+    """A fetch (or clone) of a local repository, shared by all the environments that asked for it before it started.
+
+    Args:
+        key (str): see FetchScheduler
+        path (str): local repository to fetch (or to clone)
+        remote_url (str)
+        repository_name (str)
+        git_server (str)
+        clone_policy (gitutils.ClonePolicy)
+    """
+
+    def __init__(self, key, path, remote_url, repository_name, git_server, clone_policy=None):
+        self.key = key
+        self.path = path
+        self.remote_url = remote_url
+        self.repository_name = repository_name
+        self.git_server = git_server
+        self.clone_policy = clone_policy
+        self.environments = OrderedDict()  # environment ID -> (local repository path, deploy branch)
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block until the fetch is complete (or failed, see error), return False on timeout."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def _finish(self, error):
+        self.error = error
+        self._done.set()
+
+
+class FetchScheduler(object):
+    """Queue of the fetches to perform, with at most one fetch pending and one in progress per local repository.
+
+    Requests for a repository that is not being fetched yet are merged into its pending fetch. A request coming while
+    the repository is being fetched gets a new pending fetch (the ongoing one may have started before the commits
+    it expects were pushed), in which the next requests are merged.
+    Local repositories sharing their objects (worktree layout, see gitutils.storage_path) are the same repository here.
+    Fetches of a given local repository start at least min_interval seconds apart, and a given remote repository is
+    fetched by one local repository at a time (with the clone layout, each environment has its own local repository).
+
+    Args:
+        min_interval (float): seconds
+    """
+
+    def __init__(self, min_interval=5):
+        self.min_interval = min_interval
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()  # key -> FetchRequest, oldest first
+        self._in_progress = {}  # key -> FetchRequest
+        self._remotes_in_progress = set()  # remote URLs
+        self._last_started = {}  # key -> time
+
+    @staticmethod
+    def _key(path):
+        if os.path.exists(path):
+            return os.path.abspath(gitutils.storage_path(path))
+        return os.path.abspath(path)
+
+    def request(self, environment_id, path, repository_name, git_server, deploy_branch, clone_policy=None):
+        """Ask for a fetch of the local repository of an environment, and return the (maybe shared) FetchRequest."""
+        key = self._key(path)
+        with self._condition:
+            fetch = self._pending.get(key)
+            if fetch is None:
+                remote_url = gitutils.build_repo_url(repository_name, git_server)
+                fetch = self._pending[key] = FetchRequest(key, path, remote_url, repository_name, git_server, clone_policy)
+                self._condition.notify()
+            else:
+                logger.debug("Fetch of {} already pending, merged the request of environment {}".format(key, environment_id))
+            fetch.environments[environment_id] = (path, deploy_branch)
+            return fetch
+
+    def get(self, timeout):
+        """Return the next fetch to perform (it must then be given to done()), or None after timeout seconds."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                now = time.time()
+                wakeup = deadline
+                for key, fetch in self._pending.items():
+                    if key in self._in_progress or fetch.remote_url in self._remotes_in_progress:
+                        continue
+                    start = self._last_started.get(key, 0) + self.min_interval
+                    if start <= now:
+                        del self._pending[key]
+                        self._in_progress[key] = fetch
+                        self._remotes_in_progress.add(fetch.remote_url)
+                        self._last_started[key] = now
+                        return fetch
+                    wakeup = min(wakeup, start)
+                if now >= deadline:
+                    return None
+                self._condition.wait(wakeup - now)
+
+    def done(self, fetch, error=None):
+        """Mark a fetch as complete (or failed with this error), and wake up the callers waiting for it."""
+        with self._condition:
+            del self._in_progress[fetch.key]
+            self._remotes_in_progress.discard(fetch.remote_url)
+            # Its follow-up fetch, and the fetches of the same remote repository, may now start
+            self._condition.notify_all()
+        fetch._finish(error)
+
+    def drain(self):
+        """Remove and return the pending fetches."""
+        with self._condition:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for fetch in pending:
+            fetch._finish(RuntimeError("Cancelled"))
+        return pending
+
+
 class AsyncFetchWorker(object):
 
-    job_queue = Queue()
+    job_queue = FetchScheduler()
 
     def __init__(self, config, notifier, name):
         self.config = config
@@ -98,57 +216,59 @@ class AsyncFetchWorker(object):
         self.name = name
 
     @classmethod
-    def enqueue_job(klass, environment):
-        klass.job_queue.put((
+    def enqueue_job(klass, environment, base_repos_path):
+        """Return the FetchRequest of this environment (see FetchScheduler)."""
+        return klass.job_queue.request(
             environment.id,
-            environment.local_repo_directory_name,
+            os.path.join(base_repos_path, environment.local_repo_directory_name),
             environment.repository.name,
             environment.repository.git_server,
-            environment.deploy_branch
-        ))
+            environment.deploy_branch,
+            environment.repository.clone_policy()
+        )
 
     def start(self):
         while self._running:
+            fetch = self.job_queue.get(timeout=2)
+            if fetch is None:
+                continue
+            error = None
             try:
-                try:
-                    job = self.job_queue.get(block=True, timeout=2)
-                except Empty:
-                    continue
-                environment_id, local_repo_directory_name, repository_name, git_server, deploy_branch = job
-                base_repos_path = self.config.get("general", "local_repo_path")
-                path = os.path.join(base_repos_path, local_repo_directory_name)
-                if not os.path.exists(path):
-                    logger.info("AsyncFetchWorker: cloning {}".format(path))
-                    remote_url = gitutils.build_repo_url(repository_name, git_server)
-                    with gitutils.lock_repository_clone(remote_url, path) as repo:
-                        repo.clone()
-                else:
-                    logger.info("AsyncFetchWorker: fetching {}".format(path))
-                    with gitutils.lock_repository_fetch(path) as repo:
-                        repo.fetch()
-                logger.debug("AsyncFetchWorker: fetching {}: done".format(path))
-                self.notifier.dispatch(notification.Notification.commits_fetched(
-                    environment_id=environment_id,
-                    local_repo_path=path,
-                    deployment_id=None,
-                    repository=repository_name,
-                    git_server=git_server,
-                    deploy_branch=deploy_branch
-                ))
-            except Exception:
+                self._perform(fetch)
+            except Exception as e:
+                error = e
                 logger.exception("AsyncFetchWorker: unhandled error when fetching from git:")
+            finally:
+                self.job_queue.done(fetch, error)
         try:
             self._shutdown()
         except Exception:
             logger.exception("AsyncFetchWorker: unhandled exception during shutdown.")
 
+    def _perform(self, fetch):
+        path = fetch.path
+        if not os.path.exists(path):
+            logger.info("AsyncFetchWorker: cloning {}".format(path))
+            with gitutils.lock_repository_clone(fetch.remote_url, path) as repo:
+                repo.clone(policy=fetch.clone_policy)
+        else:
+            logger.info("AsyncFetchWorker: fetching {} (for {} environments)".format(path, len(fetch.environments)))
+            with gitutils.lock_repository_fetch(path) as repo:
+                repo.fetch(fetch.clone_policy)
+        logger.debug("AsyncFetchWorker: fetching {}: done".format(path))
+        for environment_id, (local_repo_path, deploy_branch) in fetch.environments.items():
+            self.notifier.dispatch(notification.Notification.commits_fetched(
+                environment_id=environment_id,
+                local_repo_path=local_repo_path,
+                deployment_id=None,
+                repository=fetch.repository_name,
+                git_server=fetch.git_server,
+                deploy_branch=deploy_branch
+            ))
+
     def _shutdown(self):
-        try:
-            while True:
-                job = self.job_queue.get(block=False)
-                logger.warn("Because of shutdown, will not perform git fetch for {}".format(job))
-        except Empty:
-            pass
+        for fetch in self.job_queue.drain():
+            logger.warn("Because of shutdown, will not perform git fetch for {}".format(fetch.path))
 
     def stop(self):
         self._running = False
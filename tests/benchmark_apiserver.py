@@ -0,0 +1,99 @@
+# Copyright (C) 2016 Nokia Corporation and/or its subsidiary(-ies).
+"""
+Compare the API servers under load.
+
+Each server serves a small WSGI app (simulating a few milliseconds of work per request) on localhost,
+while many clients send requests, with or without keep-alive. For each server, prints the throughput,
+the latency percentiles, the number of errors and the maximum number of threads of the process.
+
+Usage: python tests/benchmark_apiserver.py [--clients 50] [--requests 200] [--work-ms 5]
+"""
+import argparse
+import threading
+import time
+
+import requests
+
+from deployment import apiserver
+
+
+def build_app(work_ms):
+    def app(environ, start_response):
+        time.sleep(work_ms / 1000.0)
+        body = '{"status": "ok"}'
+        start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+    return app
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run_clients(url, clients, requests_per_client, keep_alive):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    max_threads = [threading.active_count()]
+
+    def client():
+        session = requests.Session() if keep_alive else requests
+        for _ in range(requests_per_client):
+            start = time.time()
+            try:
+                session.get(url, timeout=30).raise_for_status()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+                max_threads[0] = max(max_threads[0], threading.active_count())
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - start
+    # The client threads are part of the count
+    return latencies, errors[0], duration, max_threads[0] - clients
+
+
+def benchmark(backend, args):
+    server_config = apiserver.ServerConfig(backend, threads=args.threads, backlog=args.backlog)
+    server = apiserver.build_server("127.0.0.1", 0, build_app(args.work_ms), server_config)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        while server.port is None:
+            time.sleep(0.1)
+        url = "http://127.0.0.1:{}/api/status".format(server.port)
+        for keep_alive in (False, True):
+            latencies, errors, duration, max_threads = run_clients(url, args.clients, args.requests, keep_alive)
+            print("{:<10} keep-alive={:<5} {:>8.0f} req/s  p50={:>6.1f}ms  p99={:>7.1f}ms  errors={:<4} max threads={}".format(
+                backend, str(keep_alive), len(latencies) / duration,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, errors, max_threads))
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50, help="concurrent clients")
+    parser.add_argument('--requests', type=int, default=200, help="requests per client")
+    parser.add_argument('--work-ms', type=float, default=5, help="time spent in the app for each request")
+    parser.add_argument('--threads', type=int, default=20, help="threads of the cherrypy server")
+    parser.add_argument('--backlog', type=int, default=64, help="backlog of the cherrypy server")
+    args = parser.parse_args()
+    for backend in apiserver.ServerConfig.BACKENDS:
+        benchmark(backend, args)
+
+
+if __name__ == '__main__':
+    main()